@@ -36,3 +36,13 @@ logger = logging.getLogger('iotccsdk')
 from .camera import * # noqa
 from .frame_iterators import * # noqa
 from .ipcprovider import * # noqa
+from .camera_state import * # noqa
+from .metrics import * # noqa
+from .commands import * # noqa
+from .fleet import * # noqa
+from .frame_sync import * # noqa
+from .clips import * # noqa
+from .resolution import * # noqa
+from .burst import * # noqa
+from .overlay import * # noqa
+from .startup import * # noqa
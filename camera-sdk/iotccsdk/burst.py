@@ -0,0 +1,161 @@
+# Copyright (c) 2018-2019, The Linux Foundation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials provided
+#      with the distribution.
+#    * Neither the name of The Linux Foundation nor the names of its
+#      contributors may be used to endorse or promote products derived
+#      from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NON-INFRINGEMENT
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+This module provides the burst capture of snapshots.
+
+"""
+
+import binascii
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+CAPTURE_PATH = "/captureimage"
+BURST_IN_FLIGHT = 4
+BURST_WRITERS = 2
+
+
+class BurstCapture():
+    """
+    This is a class for capturing snapshots at a high rate.
+
+    `in_flight` /captureimage requests are kept running at all times and
+    every response is handed to a pool of `writers` threads which decode
+    and store it, so the camera is never waiting on the disk. The number
+    of responses waiting for a writer is bounded, a slow disk slows the
+    capture down instead of filling the memory.
+
+    Attributes
+    ----------
+    ipc_provider : IpcProvider
+        Connected `IpcProvider` of the camera.
+    folder : str
+        Directory the snapshots are stored in, created when missing.
+    prefix : str
+        File name prefix, files are named <prefix>_<timestamp>_<index>.jpg.
+    in_flight : int
+        Number of concurrent /captureimage requests.
+    writers : int
+        Number of threads decoding and storing the snapshots.
+    sink : callable
+        Optional callable taking (index, timestamp, jpeg bytes) which
+        replaces the file writes, e.g. to upload the images.
+
+    """
+
+    def __init__(self, ipc_provider, folder=".", prefix="snapshot",
+                 in_flight=BURST_IN_FLIGHT, writers=BURST_WRITERS, sink=None):
+        """
+        This is the constructor for `BurstCapture` class.
+
+        """
+        self.ipc_provider = ipc_provider
+        self.folder = folder
+        self.prefix = prefix
+        self.in_flight = max(int(in_flight), 1)
+        self.writers = max(int(writers), 1)
+        self.sink = sink
+        self.logger = logging.getLogger("iotccsdk")
+
+    def run(self, count):
+        """
+        Capture `count` snapshots.
+
+        Parameters
+        ----------
+        count : int
+            Number of snapshots to capture.
+
+        Returns
+        -------
+        dict
+            requested, captured and failed snapshot counts, written count,
+            files (stored file names, in capture order), seconds spent
+            capturing, total seconds including the writes and the achieved
+            captures_per_second.
+
+        """
+        if self.sink is None:
+            os.makedirs(self.folder, exist_ok=True)
+        stats = {"requested": count, "captured": 0, "failed": 0, "written": 0}
+        files = [None] * count
+        lock = threading.Lock()
+        # responses waiting for a writer, beyond this the capture waits
+        backlog = threading.BoundedSemaphore(self.in_flight + 2 * self.writers)
+
+        def store(index, timestamp, data):
+            try:
+                image = binascii.a2b_base64(data)
+                if self.sink is not None:
+                    self.sink(index, timestamp, image)
+                else:
+                    file_name = os.path.join(
+                        self.folder, "%s_%s_%05d.jpg" % (self.prefix, timestamp, index))
+                    with open(file_name, "wb") as f:
+                        f.write(image)
+                    files[index] = file_name
+                with lock:
+                    stats["written"] += 1
+            except Exception as e:
+                self.logger.error("Failed to store snapshot %d: %s", index, e)
+            finally:
+                backlog.release()
+
+        def capture(index):
+            try:
+                response = self.ipc_provider.post(CAPTURE_PATH, {})
+                if response.get("Error") != "none":
+                    raise RuntimeError(response.get("Error"))
+            except Exception as e:
+                self.logger.error("Snapshot %d failed: %s", index, e)
+                with lock:
+                    stats["failed"] += 1
+                return
+            with lock:
+                stats["captured"] += 1
+            backlog.acquire()
+            writer_pool.submit(store, index, response["Timestamp"], response["Data"])
+
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.writers) as writer_pool:
+            with ThreadPoolExecutor(max_workers=self.in_flight) as capture_pool:
+                wait([capture_pool.submit(capture, index) for index in range(count)])
+            capture_seconds = time.monotonic() - start
+        stats["seconds"] = capture_seconds
+        stats["total_seconds"] = time.monotonic() - start
+        stats["captures_per_second"] = (stats["captured"] / capture_seconds
+                                        if capture_seconds > 0 else 0.0)
+        stats["files"] = [file_name for file_name in files if file_name]
+        self.logger.info("Burst of %d snapshots: %d captured, %d failed in %.2fs "
+                         "(%.1f/s), %d written in %.2fs",
+                         count, stats["captured"], stats["failed"], capture_seconds,
+                         stats["captures_per_second"], stats["written"],
+                         stats["total_seconds"])
+        return stats
@@ -30,12 +30,22 @@ This module contains the high level client APIs.
 
 """
 
-import base64
+import binascii
+import io
 import logging
 import os
+import threading
 from contextlib import contextmanager
 from .ipcprovider import IpcProvider
-from .frame_iterators import VideoInferenceIterator
+from .frame_iterators import VideoInferenceIterator, VideoFrameIterator, FRAME_BUFFERS
+from .camera_state import CameraState
+from .commands import CommandSerializer
+from .frame_sync import (FrameInferenceSynchronizer, SYNC_WINDOW, SYNC_TOLERANCE_MS,
+                         SYNC_FRAME_WIDTH)
+from .clips import ClipRecorder, DetectionRule, CLIP_PRE_ROLL, CLIP_POST_ROLL
+from .burst import BurstCapture, BURST_IN_FLIGHT, BURST_WRITERS
+from .resolution import Resolution, describe, COORDINATES_PIXEL
+from .overlay import OverlayUpdater, OVERLAY_UPDATE_INTERVAL
 
 DOCKER_IP_PREFIX = "172.17"
 NULL_IP = "0.0.0.0"
@@ -84,7 +94,8 @@ class CameraClient():
 
     @classmethod
     @contextmanager
-    def connect(self, ip_address, ipc_provider=None, username=None, password=None):
+    def connect(self, ip_address, ipc_provider=None, username=None, password=None,
+                session_file=None):
         """
         This method is used to create CameraClient handle for application.
 
@@ -98,6 +109,9 @@ class CameraClient():
             username for the camera.
         password : str
             password for the camera.
+        session_file : str, optional
+            Path for persisting the session token across restarts,
+            see `IpcProvider`.
 
         Yields
         ------
@@ -107,7 +121,8 @@ class CameraClient():
         """
         if ipc_provider is None:
             ipc_provider = IpcProvider(
-                ip=ip_address, username=username, password=password)
+                ip=ip_address, username=username, password=password,
+                session_file=session_file)
 
         ipc_provider.connect()
         try:
@@ -118,20 +133,44 @@ class CameraClient():
         finally:
             ipc_provider.logout()
 
-    def __init__(self, ipc_provider):
+    def __init__(self, ipc_provider, executor=None):
         """
         The constructor for `CameraClient` class
 
         Parameters
         ----------
         ipc_provider : `IpcProvider` object
+        executor : Executor, optional
+            Pool running the queued commands, shared by the cameras of a
+            `CameraFleet`. A thread is started on demand when not given.
 
         """
         self.ipc_provider = ipc_provider
+        #: CommandSerializer: Runs the camera commands one at a time so
+        #:                    concurrent callers do not interleave.
+        self._commands = CommandSerializer(executor=executor)
+        #: RLock: Guards the current preview settings.
+        self._lock = threading.RLock()
+        #: CameraState: Live cache of the camera state, updated from the
+        #:              REST responses and the /async notifications.
+        self._state = CameraState()
+        self.ipc_provider.add_event_listener(self._state.apply_event)
+        #: dict: Settings applied to the camera, re-applied by
+        #:       `_restore_state` after a heartbeat loss.
+        self._applied = {}
+        #: list: Running `VideoInferenceIterator` objects.
+        self._iterators = []
+        #: list: Running `VideoFrameIterator` objects.
+        self._frame_iterators = []
+        #: dict: `Resolution` of every resolution name seen.
+        self._resolutions = {}
+        self.ipc_provider.add_recovery_listener(self._restore_state)
         self.preview_running = False
-        self.preview_url = ""
+        #: str: Cached `preview_url`, "" until fetched.
+        self._preview_url = ""
         self.vam_running = False
-        self.vam_url = ""
+        #: str: Cached `vam_url`, "" until fetched.
+        self._vam_url = ""
         self.record_running = False
         self.resolutions = []
         self.encodetype = []
@@ -144,13 +183,171 @@ class CameraClient():
         self.display_out = 0
         self._get_supported_params()
 
+    @property
+    def preview_running(self):
+        """bool: Flag for preview status."""
+        return self._state.get("preview_running")
+
+    @preview_running.setter
+    def preview_running(self, value):
+        self._state.update(preview_running=value)
+
+    @property
+    def vam_running(self):
+        """bool: Flag for vam status."""
+        return self._state.get("vam_running")
+
+    @vam_running.setter
+    def vam_running(self, value):
+        self._state.update(vam_running=value)
+
+    @property
+    def preview_url(self):
+        """str: Preview RTSP url, fetched from the camera when not known."""
+        if self._preview_url == "":
+            self._get_preview_info()
+        return self._preview_url
+
+    @preview_url.setter
+    def preview_url(self, value):
+        self._preview_url = value
+
+    @property
+    def vam_url(self):
+        """str: VA RTSP url, fetched from the camera when not known."""
+        if self._vam_url == "":
+            self._get_vam_info()
+        return self._vam_url
+
+    @vam_url.setter
+    def vam_url(self, value):
+        self._vam_url = value
+
+    @property
+    def record_running(self):
+        """bool: Flag for recording status."""
+        return self._state.get("record_running")
+
+    @record_running.setter
+    def record_running(self, value):
+        self._state.update(record_running=value)
+
+    @property
+    def overlay_running(self):
+        """bool: Flag for overlay status."""
+        return self._state.get("overlay_running")
+
+    @property
+    def state(self):
+        """dict: Snapshot of the cached camera state."""
+        return self._state.snapshot()
+
+    @property
+    def preview_settings(self):
+        """dict: Consistent snapshot of the current preview settings."""
+        with self._lock:
+            return {
+                "resolution": self.cur_resolution,
+                "codec": self.cur_codec,
+                "bitrate": self.cur_bitrate,
+                "framerate": self.cur_framerate,
+                "display_out": self.display_out,
+            }
+
+    def submit(self, command, *args, **kwargs):
+        """
+        Queue a camera command without waiting for it.
+
+        Use this from callbacks which must not block, e.g. IoT Hub method
+        handlers. A queued switch or overlay command is coalesced with a
+        newer one of the same kind, see `CommandSerializer`.
+
+        Parameters
+        ----------
+        command : str
+            Name of a command method, e.g. "set_overlay_state".
+        args, kwargs
+            Arguments of the command.
+
+        Returns
+        -------
+        Future
+            Resolved with the result of the command, or of the newer
+            command it was coalesced with.
+
+        Raises
+        ------
+        ValueError
+            If `command` is not a command method.
+
+        """
+        keys = {
+            "configure_preview": None,
+            "set_preview_state": "preview",
+            "set_analytics_state": "analytics",
+            "set_recording_state": "recording",
+            "configure_overlay": "overlay_config",
+            "set_overlay_state": "overlay",
+            "captureimage": None,
+            "capture_image_bytes": None,
+        }
+        if command not in keys:
+            raise ValueError("command must be in %s" % list(keys))
+        return self._commands.submit(keys[command], getattr(self, "_%s" % command),
+                                     *args, **kwargs)
+
+    def wait_for(self, timeout=None, **expected):
+        """
+        Wait for the camera to reach a state.
+
+        This wakes up as soon as the camera reports the transition over the
+        /async websocket instead of sleeping in fixed steps. When the wait
+        times out the state is refreshed once from the camera before giving up.
+
+        Parameters
+        ----------
+        timeout : float, optional
+            Maximum time to wait in seconds (the default is None, wait forever).
+        expected : dict
+            State fields to wait for, e.g. ``preview_running=False``.
+            See `CameraState` for the known fields.
+
+        Returns
+        -------
+        bool
+            True if the camera reached the state, False on timeout.
+
+        Examples
+        --------
+        >>> camera_client.set_preview_state("off")
+        >>> camera_client.wait_for(preview_running=False, timeout=5)
+        True
+
+        """
+        if self._state.wait_for(timeout, **expected):
+            return True
+        if "preview_running" in expected:
+            self._get_preview_info()
+        if "vam_running" in expected:
+            self._get_vam_info()
+        return self._state.matches(**expected)
+
     @contextmanager
-    def get_inferences(self):
+    def get_inferences(self, source_cmd=None, coordinates=COORDINATES_PIXEL):
         """
         Inference generator for the application.
 
         This inference generator gives inferences from the VA metadata stream.
 
+        Parameters
+        ----------
+        source_cmd : str, optional
+            Command used instead of the gstreamer pipeline to read the VA
+            metadata, see `VideoInferenceIterator`.
+        coordinates : str
+            "pixel" for object positions in preview pixels, the default,
+            or "normalized" for 0.0 - 1.0 of the frame.
+
         Yields
         ------
         AiCameraInference: `AiCameraInference` class object
@@ -164,31 +361,27 @@ class CameraClient():
             Or if the vam is not started.
 
         """
-        if not self.preview_running:
+        if not self._preview_started():
             raise EOFError("preview not started")
 
-        if not self.vam_running:
+        if not self._vam_started():
             raise EOFError("VAM not started")
 
-        if self.cur_resolution == "4K":
-            preview_width = 3840
-            preview_height = 2160
-        elif self.cur_resolution == "1080P":
-            preview_width = 1920
-            preview_height = 1080
-        elif self.cur_resolution == "720P":
-            preview_width = 1280
-            preview_height = 720
-        elif self.cur_resolution == "480P":
-            preview_width = 640
-            preview_height = 480
-
+        preview_width, preview_height = self._get_preview_size()
         inference_iterator = VideoInferenceIterator(
-            preview_width, preview_height)
+            preview_width, preview_height, source_cmd, coordinates)
+        with self._run_inference_iterator(inference_iterator) as inferences:
+            yield inferences
+
+    @contextmanager
+    def _run_inference_iterator(self, inference_iterator):
+        """
+        Private context manager starting `inference_iterator` on the VA
+        stream and stopping it on exit.
 
+        """
+        self._iterators.append(inference_iterator)
         try:
-            if self.vam_url == "":
-                self._get_vam_info()
             if NULL_IP in self.vam_url:
                 self.vam_url.replace(NULL_IP, LOOPBACK_IP)
 
@@ -197,8 +390,356 @@ class CameraClient():
             self.logger.exception(e)
             raise
         finally:
+            self._iterators.remove(inference_iterator)
             inference_iterator.stop()
 
+    @contextmanager
+    def get_frames(self, width=None, height=None, fps=None, source_cmd=None,
+                   buffers=FRAME_BUFFERS):
+        """
+        Frame generator for the application.
+
+        This frame generator gives the decoded frames of the preview
+        stream as NumPy arrays. This requires numpy and gstreamer.
+
+        Parameters
+        ----------
+        width : int, optional
+            Width to scale the frames to at decode time
+            (the default is the preview width).
+        height : int, optional
+            Height to scale the frames to at decode time
+            (the default is the preview height).
+        fps : int, optional
+            Frame rate to decode at (the default is the stream frame rate).
+        source_cmd : str, optional
+            Command used instead of the gstreamer pipeline to produce the
+            raw frames, see `VideoFrameIterator`.
+        buffers : int
+            Number of reused frame buffers, a yielded frame is overwritten
+            `buffers` frames later.
+
+        Yields
+        ------
+        generator of numpy.ndarray
+            height x width x 3 BGR frames from `VideoFrameIterator.start()`.
+
+        Raises
+        ------
+        EOFError
+            If the preview is not started.
+
+        Examples
+        --------
+        >>> with camera_client.get_frames(width=640, height=360, fps=5) as frames:
+        ...     for frame in frames:
+        ...         crop = frame[100:200, 100:200].copy()
+
+        """
+        if not self._preview_started():
+            raise EOFError("preview not started")
+
+        preview_width, preview_height = self._get_preview_size()
+        frame_iterator = VideoFrameIterator(
+            width or preview_width, height or preview_height, fps, source_cmd, buffers)
+        with self._run_frame_iterator(frame_iterator) as frames:
+            yield frames
+
+    @contextmanager
+    def _run_frame_iterator(self, frame_iterator):
+        """
+        Private context manager starting `frame_iterator` on the preview
+        stream and stopping it on exit.
+
+        """
+        self._frame_iterators.append(frame_iterator)
+        try:
+            yield frame_iterator.start(self.preview_url.replace(NULL_IP, LOOPBACK_IP))
+        except Exception as e:
+            self.logger.exception(e)
+            raise
+        finally:
+            self._frame_iterators.remove(frame_iterator)
+            frame_iterator.stop()
+
+    @contextmanager
+    def get_synchronized_inferences(self, width=None, height=None, fps=None,
+                                    window=SYNC_WINDOW, tolerance_ms=SYNC_TOLERANCE_MS,
+                                    frame_source_cmd=None, inference_source_cmd=None,
+                                    copy=True, **kwargs):
+        """
+        Generator of inferences joined with their preview frame.
+
+        The preview frames and the VA inferences are read at the same time
+        and every inference is matched to the frame nearest to its
+        timestamp, see `FrameInferenceSynchronizer`. This requires numpy
+        and gstreamer.
+
+        The frames are buffered for matching, ``height * width * 3`` bytes
+        each: up to `window` frames and at most ``max_buffer_bytes``, 32 MiB
+        by default. The frames are decoded at `SYNC_FRAME_WIDTH` pixels
+        wide unless a size is given, so the full window fits; at 1080P
+        only 6 frames, 200 ms at 30 fps, would.
+
+        Parameters
+        ----------
+        width, height : int, optional
+            Size to decode the frames at, the object positions are in
+            these pixels. When only one is given the other keeps the
+            preview aspect ratio (the default is `SYNC_FRAME_WIDTH` wide).
+        fps : int, optional
+            Frame rate to decode at, see `get_frames`.
+        window : int
+            Number of frames buffered for matching.
+        tolerance_ms : float
+            Largest distance between an inference and its frame.
+        frame_source_cmd : str, optional
+            Command used instead of the preview pipeline, see `get_frames`.
+        inference_source_cmd : str, optional
+            Command used instead of the VA pipeline, see `get_inferences`.
+        copy : bool
+            Yield a copy of every matched frame. Without it the frame is a
+            view of the buffer, overwritten `window` frames later.
+        kwargs : dict
+            Other `FrameInferenceSynchronizer` arguments, e.g.
+            ``max_buffer_bytes``, ``timestamp_scale`` or ``clock_offset``.
+
+        Yields
+        ------
+        generator of tuple
+            (frame, inference) pairs.
+
+        Raises
+        ------
+        EOFError
+            If the preview is not started.
+            Or if the vam is not started.
+
+        Examples
+        --------
+        >>> with camera_client.get_synchronized_inferences(fps=15) as pairs:
+        ...     for frame, inference in pairs:
+        ...         for obj in inference.objects:
+        ...             p = obj.position
+        ...             crop = frame[int(p.y):int(p.y + p.height), int(p.x):int(p.x + p.width)]
+
+        """
+        if not self._preview_started():
+            raise EOFError("preview not started")
+
+        if not self._vam_started():
+            raise EOFError("VAM not started")
+
+        preview_width, preview_height = self._get_preview_size()
+        if not width and not height:
+            width = min(SYNC_FRAME_WIDTH, preview_width)
+        if not height:
+            height = max(int(preview_height * width / preview_width) // 2 * 2, 2)
+        elif not width:
+            width = max(int(preview_width * height / preview_height) // 2 * 2, 2)
+        # the iterators are built here rather than taken from get_frames
+        # and get_inferences, other threads may be starting their own
+        frame_iterator = VideoFrameIterator(width, height, fps, frame_source_cmd)
+        # positions in frame pixels rather than preview pixels
+        inference_iterator = VideoInferenceIterator(width, height, inference_source_cmd)
+        synchronizer = FrameInferenceSynchronizer(window, tolerance_ms, **kwargs)
+        with self._run_frame_iterator(frame_iterator) as frames:
+            with self._run_inference_iterator(inference_iterator) as inferences:
+                try:
+                    yield synchronizer.start(frame_iterator, frames, inferences, copy)
+                finally:
+                    synchronizer.stop()
+
+    @contextmanager
+    def record_clips(self, folder=".", pre_roll=CLIP_PRE_ROLL, post_roll=CLIP_POST_ROLL,
+                     labels=None, min_confidence=0, rule=None, on_clip=None,
+                     source_cmd=None):
+        """
+        Event triggered clip recorder for the application.
+
+        Unlike `set_recording_state` this records only around the events:
+        the preview stream is buffered on the host and a clip with
+        `pre_roll` seconds before and `post_roll` seconds after the event
+        is written when an inference matches the rule, see `ClipRecorder`.
+        This requires gstreamer.
+
+        Parameters
+        ----------
+        folder : str
+            Directory the clips are written to.
+        pre_roll : float
+            Seconds recorded before the event.
+        post_roll : float
+            Seconds recorded after the last event.
+        labels : list of str, optional
+            Labels triggering a clip (the default is None, any label).
+        min_confidence : int
+            Minimum confidence in % of a triggering object.
+        rule : callable, optional
+            Takes a `CameraInference` and returns a truthy value to trigger
+            a clip, replaces `labels` and `min_confidence`.
+        on_clip : callable, optional
+            Called with the path of every finished clip.
+        source_cmd : str, optional
+            Command used instead of the gstreamer pipeline to produce the
+            MPEG-TS stream, see `ClipRecorder`.
+
+        Yields
+        ------
+        ClipRecorder
+            The running recorder. Feed it inferences with `watch` or
+            `feed`, or call `trigger` directly.
+
+        Raises
+        ------
+        EOFError
+            If the preview is not started.
+
+        Examples
+        --------
+        >>> with camera_client.record_clips("clips", labels=["person"], min_confidence=60) as recorder:
+        ...     with camera_client.get_inferences() as inferences:
+        ...         for inference in recorder.watch(inferences):
+        ...             pass
+
+        """
+        if not self._preview_started():
+            raise EOFError("preview not started")
+
+        recorder = ClipRecorder(folder, pre_roll=pre_roll, post_roll=post_roll,
+                                codec=self.preview_settings["codec"],
+                                rule=rule or DetectionRule(labels, min_confidence),
+                                on_clip=on_clip, source_cmd=source_cmd)
+        try:
+            recorder.start(self.preview_url.replace(NULL_IP, LOOPBACK_IP))
+            yield recorder
+        except Exception as e:
+            self.logger.exception(e)
+            raise
+        finally:
+            recorder.stop()
+
+    @property
+    def preview_resolution(self):
+        """
+        `Resolution`: Resolution of the preview.
+
+        It is parsed from the resolution name of the camera, or read from
+        the SDP of the preview stream for a name it does not understand.
+        The result is cached per resolution name. Only when the stream
+        does not tell either is the size guessed from the name, with a
+        warning, and not cached.
+
+        """
+        name = self.preview_settings["resolution"]
+        resolution = self._resolutions.get(name)
+        if resolution is None:
+            resolution = Resolution.parse(name) or self._get_stream_resolution()
+            if resolution is None:
+                resolution = Resolution.guess(name)
+                if resolution is None:
+                    raise ValueError("Unknown preview resolution: %s" % name)
+                self.logger.warning("Preview resolution %s guessed as %dx%d",
+                                    name, resolution.width, resolution.height)
+                return resolution
+            resolution.name = name
+            self._resolutions[name] = resolution
+        return resolution
+
+    def _get_stream_resolution(self):
+        """
+        Private method reading the resolution from the preview stream SDP.
+
+        Returns
+        -------
+        Resolution
+            The stream resolution, None if the stream cannot be asked or
+            its SDP does not tell.
+
+        """
+        url = self.preview_url
+        if not url:
+            return None
+        try:
+            return Resolution.from_sdp(describe(url.replace(NULL_IP, LOOPBACK_IP)))
+        except OSError as e:
+            self.logger.warning("Cannot read the preview resolution from %s: %s", url, e)
+            return None
+
+    def _get_preview_size(self):
+        """
+        Private method for the preview width and height.
+
+        Returns
+        -------
+        tuple of int
+            (width, height) of the current preview resolution.
+
+        """
+        resolution = self.preview_resolution
+        return resolution.width, resolution.height
+
+    def _preview_started(self):
+        """
+        Private method checking that the preview runs.
+
+        The state kept from the /async notifications is trusted when it
+        says running, otherwise it is confirmed with the camera, which
+        also fetches the preview url.
+
+        """
+        if not self.preview_running:
+            self._get_preview_info()
+        return self.preview_running
+
+    def _vam_started(self):
+        """
+        Private method checking that the VA runs, see `_preview_started`.
+
+        """
+        if not self.vam_running:
+            self._get_vam_info()
+        return self.vam_running
+
+    def _restore_state(self):
+        """
+        Private method re-applying the camera settings after a heartbeat loss.
+
+        It is registered as `IpcProvider` recovery listener. The settings
+        applied through this client are sent again in their original order
+        and the running inference and frame iterators are restarted on the
+        VA and preview streams.
+
+        Raises
+        ------
+        ConnectionError
+            If the preview or the VA did not come back.
+
+        """
+        applied = dict(self._applied)
+        self.logger.info("Restoring camera state: %s", applied)
+        if "preview_config" in applied:
+            self.configure_preview(**applied["preview_config"])
+        if "preview" in applied:
+            self.set_preview_state(applied["preview"])
+        if "analytics" in applied:
+            self.set_analytics_state(applied["analytics"])
+        if "overlay_config" in applied:
+            self.configure_overlay(**applied["overlay_config"])
+        if "overlay" in applied:
+            self.set_overlay_state(applied["overlay"])
+        if "recording" in applied:
+            self.set_recording_state(applied["recording"])
+
+        if applied.get("preview") == "on" and not self._preview_started():
+            raise ConnectionError("preview did not restart")
+        if applied.get("analytics") == "on" and not self._vam_started():
+            raise ConnectionError("VAM did not restart")
+        for inference_iterator in list(self._iterators):
+            inference_iterator.restart(self.vam_url)
+        for frame_iterator in list(self._frame_iterators):
+            frame_iterator.restart(self.preview_url.replace(NULL_IP, LOOPBACK_IP))
+
     @contextmanager
     def configure_preview(self, resolution=None, encode=None,
                           bitrate=None, framerate=None, display_out=None):
@@ -229,6 +770,16 @@ class CameraClient():
         Exception
             Any exception raised by ipc provider post
 
+        """
+        # not coalesced, the parameters left to None keep the current value
+        return self._commands.call(None, self._configure_preview,
+                                   resolution, encode, bitrate, framerate, display_out)
+
+    def _configure_preview(self, resolution=None, encode=None,
+                           bitrate=None, framerate=None, display_out=None):
+        """
+        Private method for `configure_preview`, run by the command serializer.
+
         """
         if resolution and self.resolutions and resolution in self.resolutions:
             res = self.resolutions.index(resolution)
@@ -262,21 +813,29 @@ class CameraClient():
         }
         response = self.ipc_provider.post(path, payload)
         if response["status"]:
-            if self.cur_resolution != self.resolutions[res]:
-                self.cur_resolution = self.resolutions[res]
-                self.logger.info("resolution now: %s" % self.cur_resolution)
-            if self.cur_codec != self.encodetype[enc]:
-                self.cur_codec = self.encodetype[enc]
-                self.logger.info("encodetype now: %s" % self.cur_codec)
-            if self.cur_bitrate != self.bitrates[bit]:
-                self.cur_bitrate = self.bitrates[bit]
-                self.logger.info("bitrate now : %s" % self.cur_bitrate)
-            if self.cur_framerate != self.framerates[fps]:
-                self.cur_framerate = self.framerates[fps]
-                self.logger.info("framerate now: %s" % self.cur_framerate)
-            if self.display_out != display_out:
-                self.display_out = display_out
-                self.logger.info("display_out now: %s" % self.display_out)
+            self._applied["preview_config"] = {
+                "resolution": self.resolutions[res],
+                "encode": self.encodetype[enc],
+                "bitrate": self.bitrates[bit],
+                "framerate": self.framerates[fps],
+                "display_out": display_out,
+            }
+            with self._lock:
+                if self.cur_resolution != self.resolutions[res]:
+                    self.cur_resolution = self.resolutions[res]
+                    self.logger.info("resolution now: %s" % self.cur_resolution)
+                if self.cur_codec != self.encodetype[enc]:
+                    self.cur_codec = self.encodetype[enc]
+                    self.logger.info("encodetype now: %s" % self.cur_codec)
+                if self.cur_bitrate != self.bitrates[bit]:
+                    self.cur_bitrate = self.bitrates[bit]
+                    self.logger.info("bitrate now : %s" % self.cur_bitrate)
+                if self.cur_framerate != self.framerates[fps]:
+                    self.cur_framerate = self.framerates[fps]
+                    self.logger.info("framerate now: %s" % self.cur_framerate)
+                if self.display_out != display_out:
+                    self.display_out = display_out
+                    self.logger.info("display_out now: %s" % self.display_out)
         return response["status"]
 
     def _get_supported_params(self):
@@ -296,19 +855,20 @@ class CameraClient():
         payload = {}
         response = self.ipc_provider.get(path, payload)
         if response["status"]:
-            self.resolutions = response["resolution"]
-            r_idx = response["resolutionSelectVal"]
-            self.cur_resolution = self.resolutions[r_idx]
-            self.encodetype = response["encodeMode"]
-            e_idx = response["encodeModeSelectVal"]
-            self.cur_codec = self.encodetype[e_idx]
-            self.bitrates = response["bitRate"]
-            b_idx = response["bitRateSelectVal"]
-            self.cur_bitrate = self.bitrates[b_idx]
-            self.framerates = response["fps"]
-            f_idx = response["fpsSelectVal"]
-            self.cur_framerate = self.framerates[f_idx]
-            self.display_out = response["displayOut"]
+            with self._lock:
+                self.resolutions = response["resolution"]
+                r_idx = response["resolutionSelectVal"]
+                self.cur_resolution = self.resolutions[r_idx]
+                self.encodetype = response["encodeMode"]
+                e_idx = response["encodeModeSelectVal"]
+                self.cur_codec = self.encodetype[e_idx]
+                self.bitrates = response["bitRate"]
+                b_idx = response["bitRateSelectVal"]
+                self.cur_bitrate = self.bitrates[b_idx]
+                self.framerates = response["fps"]
+                f_idx = response["fpsSelectVal"]
+                self.cur_framerate = self.framerates[f_idx]
+                self.display_out = response["displayOut"]
 
             self.logger.info("resolutions: %s" % self.resolutions)
             self.logger.info("encodetype: %s" % self.encodetype)
@@ -341,6 +901,13 @@ class CameraClient():
         bool
             True if the request was successful. False on failure.
 
+        """
+        return self._commands.call(None, self._set_preview_state, state)
+
+    def _set_preview_state(self, state):
+        """
+        Private method for `set_preview_state`, run by the command serializer.
+
         """
         if state.lower() == "on":
             status = True
@@ -352,7 +919,11 @@ class CameraClient():
         payload = {"switchStatus": status}
         response = self.ipc_provider.post(path, payload)
         was_success = response["status"]
-        self._get_preview_info()
+        if was_success:
+            self._applied["preview"] = state.lower()
+            # preview_running follows the /async notification, the url is
+            # fetched again when it is next read
+            self._preview_url = ""
         return was_success
 
     @contextmanager
@@ -376,12 +947,12 @@ class CameraClient():
             if DOCKER_IP_PREFIX not in self.ipc_provider.ip_address:
                 url = "rtsp://%s%s" % (
                     self.ipc_provider.ip_address, url[e_idx:])
-            self.preview_url = url
+            self._preview_url = url
         else:
-            self.preview_url = None
-        self.logger.info("preview url: %s" % self.preview_url)
+            self._preview_url = None
+        self.logger.info("preview url: %s" % self._preview_url)
         self.preview_running = response["status"]
-        return self.preview_url
+        return self._preview_url
 
     @contextmanager
     def set_analytics_state(self, state):
@@ -400,6 +971,13 @@ class CameraClient():
         bool
             True if the request was successful. False on failure.
 
+        """
+        return self._commands.call(None, self._set_analytics_state, state)
+
+    def _set_analytics_state(self, state):
+        """
+        Private method for `set_analytics_state`, run by the command serializer.
+
         """
         if state.lower() == "on":
             status = True
@@ -411,7 +989,11 @@ class CameraClient():
         path = "/vam"
         response = self.ipc_provider.post(path, payload)
         was_success = response["status"]
-        self._get_vam_info()
+        if was_success:
+            self._applied["analytics"] = state.lower()
+            # vam_running follows the /async notification, the url is
+            # fetched again when it is next read
+            self._vam_url = ""
         return was_success
 
     @contextmanager
@@ -436,13 +1018,13 @@ class CameraClient():
             if DOCKER_IP_PREFIX not in self.ipc_provider.ip_address:
                 url = "rtsp://%s%s" % (
                     self.ipc_provider.ip_address, url[e_idx:])
-            self.vam_url = url
+            self._vam_url = url
         else:
-            self.vam_url = None
+            self._vam_url = None
 
         self.vam_running = response["status"]
-        self.logger.info("vam url: %s" % self.vam_url)
-        return self.vam_url
+        self.logger.info("vam url: %s" % self._vam_url)
+        return self._vam_url
 
     @contextmanager
     def set_recording_state(self, state):
@@ -461,6 +1043,13 @@ class CameraClient():
         bool
             True if the request was successful. False on failure.
 
+        """
+        return self._commands.call(None, self._set_recording_state, state)
+
+    def _set_recording_state(self, state):
+        """
+        Private method for `set_recording_state`, run by the command serializer.
+
         """
         if state.lower() == "on":
             status = True
@@ -471,6 +1060,8 @@ class CameraClient():
         path = "/recording"
         payload = {"switchStatus": status}
         response = self.ipc_provider.post(path, payload)
+        if response["status"]:
+            self._applied["recording"] = state.lower()
         self.record_running = response["status"]
         return self.record_running
 
@@ -490,13 +1081,24 @@ class CameraClient():
             True if the configuration was successful.
             False on failure.
 
+        """
+        return self._commands.call(None, self._configure_overlay, type, text)
+
+    def _configure_overlay(self, type=None, text=None):
+        """
+        Private method for `configure_overlay`, run by the command serializer.
+
         """
         if type == "inference":
-            return self._configure_inference_overlay()
+            was_success = self._configure_inference_overlay()
         elif type == "text":
-            return self._configure_text_overlay(text)
+            was_success = self._configure_text_overlay(text)
         else:
             self.logger.error("Invalid overlay type use (inference/text)")
+            return None
+        if was_success:
+            self._applied["overlay_config"] = {"type": type, "text": text}
+        return was_success
 
     def _configure_inference_overlay(self):
         """
@@ -552,6 +1154,32 @@ class CameraClient():
         response = self.ipc_provider.post(path, payload)
         return response["status"]
 
+    def overlay_updater(self, interval=OVERLAY_UPDATE_INTERVAL):
+        """
+        Create an updater for live text on the overlay.
+
+        Unlike `configure_overlay` its `update` never blocks: texts are
+        coalesced to the latest one and sent at most once per `interval`,
+        see `OverlayUpdater`.
+
+        Parameters
+        ----------
+        interval : float
+            Minimum seconds between two overlay configurations.
+
+        Returns
+        -------
+        OverlayUpdater
+            The updater, call its `stop` when done.
+
+        Examples
+        --------
+        >>> updater = camera_client.overlay_updater(interval=0.5)
+        >>> updater.update("people: %d" % count)
+
+        """
+        return OverlayUpdater(self, interval)
+
     @contextmanager
     def set_overlay_state(self, state=None):
         """
@@ -569,6 +1197,13 @@ class CameraClient():
         bool
             True if the request was successful. False on failure.
 
+        """
+        return self._commands.call(None, self._set_overlay_state, state)
+
+    def _set_overlay_state(self, state=None):
+        """
+        Private method for `set_overlay_state`, run by the command serializer.
+
         """
         if state.lower() == "on":
             status = True
@@ -579,6 +1214,9 @@ class CameraClient():
         path = "/overlay"
         payload = {"switchStatus": status}
         response = self.ipc_provider.post(path, payload)
+        if response["status"]:
+            self._applied["overlay"] = state.lower()
+            self._state.update(overlay_running=status)
         return response["status"]
 
     @contextmanager
@@ -594,6 +1232,13 @@ class CameraClient():
         bool
             True if the request was successful. False on failure.
 
+        """
+        return self._commands.call(None, self._captureimage)
+
+    def _captureimage(self):
+        """
+        Private method for `captureimage`, run by the command serializer.
+
         """
         path = "/captureimage"
         payload = {}
@@ -607,9 +1252,111 @@ class CameraClient():
         full_file_name = os.path.join(dir_name, file_name)
         self.logger.info("Storing snapshot: %s" % full_file_name)
         with open(file_name, "wb") as f:
-            f.write(base64.b64decode(response["Data"]))
+            f.write(self._decode_snapshot(response["Data"]))
         return True
 
+    def capture_image_bytes(self, as_array=False):
+        """
+        This method is for taking a snapshot in memory.
+
+        Unlike `captureimage` nothing is written to the filesystem.
+
+        Parameters
+        ----------
+        as_array : bool
+            Return the decoded image as a height x width x 3 RGB NumPy
+            array. This requires numpy and Pillow.
+
+        Returns
+        -------
+        bytes or numpy.ndarray
+            The JPEG image, or its pixels with `as_array`. None on failure.
+
+        Examples
+        --------
+        >>> image = camera_client.capture_image_bytes()
+        >>> requests.post(url, data=image)
+
+        """
+        return self._commands.call(None, self._capture_image_bytes, as_array)
+
+    def _capture_image_bytes(self, as_array=False):
+        """
+        Private method for `capture_image_bytes`, run by the command serializer.
+
+        """
+        path = "/captureimage"
+        payload = {}
+        response = self.ipc_provider.post(path, payload)
+        if response["Error"] != "none":
+            self.logger.error(response["Error"])
+            return None
+
+        image = self._decode_snapshot(response["Data"])
+        if as_array:
+            import numpy
+            from PIL import Image
+            with Image.open(io.BytesIO(image)) as decoded:
+                return numpy.asarray(decoded.convert("RGB"))
+        return image
+
+    def capture_burst(self, count, folder=".", prefix="snapshot",
+                      in_flight=BURST_IN_FLIGHT, writers=BURST_WRITERS, sink=None):
+        """
+        This method is for taking many snapshots as fast as possible.
+
+        Several /captureimage requests are kept in flight while a writer
+        pool decodes and stores the images, see `BurstCapture`. The burst
+        does not go through the command queue, other commands keep running.
+
+        Parameters
+        ----------
+        count : int
+            Number of snapshots to capture.
+        folder : str
+            Directory the snapshots are stored in.
+        prefix : str
+            File name prefix, files are named <prefix>_<timestamp>_<index>.jpg.
+        in_flight : int
+            Number of concurrent /captureimage requests.
+        writers : int
+            Number of threads decoding and storing the snapshots.
+        sink : callable, optional
+            Callable taking (index, timestamp, jpeg bytes) used instead of
+            the file writes.
+
+        Returns
+        -------
+        dict
+            Capture statistics including captures_per_second,
+            see `BurstCapture.run`.
+
+        Examples
+        --------
+        >>> camera_client.capture_burst(200, folder="pictures/cat")["captures_per_second"]
+        14.2
+
+        """
+        return BurstCapture(self.ipc_provider, folder, prefix, in_flight, writers,
+                            sink).run(count)
+
+    def _decode_snapshot(self, data):
+        """
+        Private method for base64 decoding a snapshot.
+
+        Parameters
+        ----------
+        data : str
+            Base64 "Data" field of the /captureimage response.
+
+        Returns
+        -------
+        bytes
+            The JPEG image, a new object on every call.
+
+        """
+        return binascii.a2b_base64(data)
+
     @contextmanager
     def logout(self):
         """
@@ -620,6 +1367,13 @@ class CameraClient():
         bool
             True if the request was successful. False on failure.
 
+        """
+        return self._commands.call("logout", self._logout)
+
+    def _logout(self):
+        """
+        Private method for `logout`, run by the command serializer.
+
         """
         status = self.ipc_provider.logout()
         return status
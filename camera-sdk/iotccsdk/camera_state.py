@@ -0,0 +1,231 @@
+# Copyright (c) 2018-2019, The Linux Foundation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials provided
+#      with the distribution.
+#    * Neither the name of The Linux Foundation nor the names of its
+#      contributors may be used to endorse or promote products derived
+#      from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NON-INFRINGEMENT
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+This module provides a live cache of the camera state.
+
+The cache is fed by the responses of the REST calls made by `CameraClient`
+and by the notifications pushed by the QMMF IPC webserver over the
+``/async`` websocket, so callers can wait for a state transition instead
+of polling the camera.
+"""
+
+import json
+import logging
+import threading
+
+#: dict: Maps the keys found in the /async notifications to the state fields.
+ASYNC_EVENT_FIELDS = {
+    "preview": "preview_running",
+    "vam": "vam_running",
+    "recording": "record_running",
+    "overlay": "overlay_running",
+}
+#: list of str: Keys which may carry the switch status of a notification.
+ASYNC_STATUS_KEYS = ["switchStatus", "status", "Status", "running"]
+#: list of str: Keys which may carry the name of the notified component.
+ASYNC_NAME_KEYS = ["type", "event", "Event", "module"]
+
+
+class CameraState():
+    """
+    This is a thread safe cache of the camera state.
+
+    Attributes
+    ----------
+    fields : dict
+        Current value of every known state field.
+        Fields are `preview_running`, `vam_running`, `record_running`
+        and `overlay_running`.
+
+    """
+
+    def __init__(self):
+        """
+        This is the constructor for `CameraState` class.
+
+        """
+        self._cond = threading.Condition()
+        self.fields = {
+            "preview_running": False,
+            "vam_running": False,
+            "record_running": False,
+            "overlay_running": False,
+        }
+        self.logger = logging.getLogger("iotccsdk")
+
+    def get(self, name):
+        """
+        Get the cached value of a state field.
+
+        Parameters
+        ----------
+        name : str
+            Name of the state field.
+
+        Returns
+        -------
+        object
+            Cached value of the field, None if it is unknown.
+
+        """
+        with self._cond:
+            return self.fields.get(name)
+
+    def snapshot(self):
+        """
+        Get a copy of all the cached state fields.
+
+        Returns
+        -------
+        dict
+            Copy of `fields`.
+
+        """
+        with self._cond:
+            return dict(self.fields)
+
+    def update(self, **fields):
+        """
+        Update state fields and wake up the waiters.
+
+        Parameters
+        ----------
+        fields : dict
+            Key value pairs of state fields to update.
+
+        """
+        with self._cond:
+            changed = {k: v for k, v in fields.items()
+                       if self.fields.get(k) != v}
+            self.fields.update(fields)
+            if changed:
+                self.logger.debug("camera state changed: %s", changed)
+            self._cond.notify_all()
+
+    def matches(self, **expected):
+        """
+        Check whether the cached state matches the expected values.
+
+        Parameters
+        ----------
+        expected : dict
+            Key value pairs of state fields to compare.
+
+        Returns
+        -------
+        bool
+            True if all the expected fields have the given values.
+
+        """
+        with self._cond:
+            return self._matches(expected)
+
+    def _matches(self, expected):
+        return all(self.fields.get(k) == v for k, v in expected.items())
+
+    def wait_for(self, timeout=None, **expected):
+        """
+        Block until the state matches the expected values.
+
+        The waiter is woken up as soon as a state update arrives, so the
+        call returns after the actual transition time of the camera.
+
+        Parameters
+        ----------
+        timeout : float, optional
+            Maximum time to wait in seconds (the default is None, wait forever).
+        expected : dict
+            Key value pairs of state fields to wait for,
+            e.g. ``preview_running=False``.
+
+        Returns
+        -------
+        bool
+            True if the state matches, False if the wait timed out.
+
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: self._matches(expected),
+                                       timeout)
+
+    def apply_event(self, message):
+        """
+        Update the state from a notification of the /async websocket.
+
+        Notifications are JSON objects either keyed by component, e.g.
+        ``{"preview": {"switchStatus": false}}`` or ``{"vam": true}``,
+        or naming the component, e.g. ``{"type": "vam", "status": true}``.
+        Unknown notifications are ignored.
+
+        Parameters
+        ----------
+        message : str or dict
+            Notification received from the camera.
+
+        Returns
+        -------
+        dict
+            State fields updated by the notification.
+
+        """
+        if isinstance(message, (str, bytes)):
+            try:
+                message = json.loads(message)
+            except ValueError:
+                self.logger.debug("ignoring non JSON notification: %s", message)
+                return {}
+        if not isinstance(message, dict):
+            return {}
+
+        fields = {}
+        for name_key in ASYNC_NAME_KEYS:
+            name = message.get(name_key)
+            if isinstance(name, str) and name.lower() in ASYNC_EVENT_FIELDS:
+                status = self._get_status(message)
+                if status is not None:
+                    fields[ASYNC_EVENT_FIELDS[name.lower()]] = status
+        for key, value in message.items():
+            field = ASYNC_EVENT_FIELDS.get(key.lower())
+            if field is None:
+                continue
+            status = value if isinstance(value, bool) else self._get_status(value)
+            if status is not None:
+                fields[field] = status
+
+        if fields:
+            self.update(**fields)
+        return fields
+
+    def _get_status(self, value):
+        if not isinstance(value, dict):
+            return None
+        for key in ASYNC_STATUS_KEYS:
+            if key in value and isinstance(value[key], bool):
+                return value[key]
+        return None
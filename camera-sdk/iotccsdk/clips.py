@@ -0,0 +1,527 @@
+# Copyright (c) 2018-2019, The Linux Foundation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials provided
+#      with the distribution.
+#    * Neither the name of The Linux Foundation nor the names of its
+#      contributors may be used to endorse or promote products derived
+#      from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NON-INFRINGEMENT
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+This module provides the event triggered recording of preview clips.
+
+"""
+
+import collections
+import logging
+import os
+import queue
+import subprocess
+import threading
+import time
+
+TS_PACKET_SIZE = 188
+TS_SYNC_BYTE = 0x47
+# PID of the program association table
+TS_PAT_PID = 0
+# MPEG-TS packets read from the pipe at once
+TS_PACKETS_PER_READ = 64
+CLIP_PRE_ROLL = 5.0
+CLIP_POST_ROLL = 5.0
+# Upper bound of the pre-roll buffer whatever the bitrate, 64 MiB
+CLIP_MAX_BUFFER_BYTES = 64 * 1024 * 1024
+# gstreamer depayloader and parser of every preview encode type
+CODEC_ELEMENTS = {
+    "AVC/H.264": "rtph264depay ! h264parse config-interval=-1",
+    "HEVC/H.265": "rtph265depay ! h265parse config-interval=-1",
+}
+
+
+def _is_keyframe(data, offset):
+    """
+    Check whether the MPEG-TS packet at `offset` starts a keyframe.
+
+    mpegtsmux sets the random access indicator of the adaptation field on
+    the packets starting a keyframe.
+
+    """
+    return bool(data[offset + 3] & 0x20 and data[offset + 4] > 0
+                and data[offset + 5] & 0x40)
+
+
+def _packet_pid(data, offset):
+    """
+    Get the PID of the MPEG-TS packet at `offset`.
+
+    """
+    return ((data[offset + 1] & 0x1F) << 8) | data[offset + 2]
+
+
+def _pmt_pids(packet):
+    """
+    Find the program map table PIDs listed in a PAT packet.
+
+    Parameters
+    ----------
+    packet : bytes
+        MPEG-TS packet of PID 0 starting a program association section.
+
+    Returns
+    -------
+    set of int
+        PIDs of the PMTs, empty if the packet does not start a section.
+
+    """
+    if not packet[1] & 0x40:
+        return set()
+    start = 4
+    if packet[3] & 0x20:
+        start += 1 + packet[4]
+    if start >= TS_PACKET_SIZE:
+        return set()
+    # pointer field, then the section header up to the first program
+    start += 1 + packet[start]
+    if start + 8 > TS_PACKET_SIZE:
+        return set()
+    length = ((packet[start + 1] & 0x0F) << 8) | packet[start + 2]
+    # the section length counts the 4 byte CRC
+    end = min(start + 3 + length - 4, TS_PACKET_SIZE)
+    pids = set()
+    for entry in range(start + 8, end - 3, 4):
+        # program 0 points to the network information table
+        if packet[entry] or packet[entry + 1]:
+            pids.add(((packet[entry + 2] & 0x1F) << 8) | packet[entry + 3])
+    return pids
+
+
+class DetectionRule(object):
+    """
+    This is a class for the inferences triggering a clip.
+
+    Attributes
+    ----------
+    labels : set of str
+        Labels of interest, None for any label.
+    min_confidence : int
+        Minimum confidence in % of a triggering object.
+
+    """
+
+    def __init__(self, labels=None, min_confidence=0):
+        """
+        This is the constructor for `DetectionRule` class.
+
+        """
+        self.labels = set(labels) if labels else None
+        self.min_confidence = min_confidence
+
+    def __call__(self, inference):
+        """
+        Check an inference.
+
+        Parameters
+        ----------
+        inference : CameraInference
+            Inference from the camera.
+
+        Returns
+        -------
+        CameraInferenceObject
+            The first matching object, None if there is none.
+
+        """
+        for obj in inference.objects or []:
+            if ((self.labels is None or obj.label in self.labels)
+                    and float(obj.confidence) >= self.min_confidence):
+                return obj
+        return None
+
+
+class ClipRecorder(object):
+    """
+    This is a class for recording clips around events.
+
+    The encoded preview stream is remuxed to MPEG-TS by a gstreamer child
+    process, without decoding. The last `pre_roll` seconds are kept in
+    memory starting at a keyframe. When `trigger` is called they are
+    written to a new clip file followed by `post_roll` seconds of live
+    stream. A trigger during the post-roll extends the same clip. The
+    files are written by a writer thread so neither the inference thread
+    calling `trigger` nor the stream reader waits on the disk.
+
+    Attributes
+    ----------
+    folder : str
+        Directory the clips are written to, created when missing.
+    prefix : str
+        File name prefix, clips are named <prefix>_<timestamp>.ts.
+    pre_roll : float
+        Seconds recorded before the trigger.
+    post_roll : float
+        Seconds recorded after the last trigger.
+    codec : str
+        Preview encode type, a key of `CODEC_ELEMENTS`.
+    rule : callable
+        Takes a `CameraInference` and returns a truthy value to trigger
+        a clip, see `DetectionRule` and `watch`.
+    on_clip : callable
+        Optional callable taking the path of every finished clip.
+    source_cmd : str, optional
+        Command writing the MPEG-TS stream to its stdout. ``{url}`` is
+        replaced. Use this to run against a synthetic source, the default
+        is the gstreamer RTSP pipeline.
+    clips : list of str
+        Paths of the finished clips.
+
+    """
+
+    def __init__(self, folder=".", prefix="clip", pre_roll=CLIP_PRE_ROLL,
+                 post_roll=CLIP_POST_ROLL, codec="AVC/H.264", rule=None,
+                 on_clip=None, source_cmd=None, max_buffer_bytes=CLIP_MAX_BUFFER_BYTES):
+        """
+        This is the constructor for `ClipRecorder` class.
+
+        """
+        self.folder = folder
+        self.prefix = prefix
+        self.pre_roll = pre_roll
+        self.post_roll = post_roll
+        self.codec = codec
+        self.rule = rule or DetectionRule()
+        self.on_clip = on_clip
+        self.source_cmd = source_cmd
+        self.max_buffer_bytes = max_buffer_bytes
+        self.clips = []
+        #: deque: (host time, MPEG-TS bytes, keyframe offset or None,
+        #: PAT and PMT packets preceding the keyframe)
+        self._buffer = collections.deque()
+        self._buffer_bytes = 0
+        #: bytes: Latest PAT packet, written at the start of every clip.
+        self._pat = None
+        #: set: PIDs of the PMTs listed in the latest PAT.
+        self._pmt_pids = set()
+        #: dict: Latest PMT packet by PID.
+        self._pmts = {}
+        self._clip_path = None
+        self._clip_until = None
+        self._lock = threading.Lock()
+        #: Queue: ("open", path, chunks), ("data", bytes) or ("close", path)
+        self._writes = queue.Queue()
+        self._writer = None
+        self._sub_proc = None
+        self._reader = None
+        self._stopped = threading.Event()
+        self.logger = logging.getLogger('iotccsdk')
+
+    @property
+    def recording(self):
+        """bool: True while a clip is being written."""
+        return self._clip_path is not None
+
+    def start(self, frame_src):
+        """
+        Start buffering the preview stream.
+
+        Parameters
+        ----------
+        frame_src : str
+            Preview RTSP stream url.
+
+        """
+        self._stopped.clear()
+        self._sub_proc = subprocess.Popen(self._build_cmd(frame_src), shell=True,
+                                          stdout=subprocess.PIPE,
+                                          stderr=subprocess.DEVNULL)
+        self._reader = threading.Thread(target=self._read, name="clip-recorder")
+        self._reader.daemon = True
+        self._reader.start()
+
+    def stop(self):
+        """
+        Stop the stream and finish the clip being written.
+
+        """
+        self._stopped.set()
+        if self._sub_proc and self._sub_proc.poll() is None:
+            self._sub_proc.terminate()
+        if self._reader and self._reader is not threading.current_thread():
+            self._reader.join()
+        with self._lock:
+            self._close_clip()
+        # the clip is finished once the writer caught up
+        self._writes.join()
+
+    def trigger(self, reason=None):
+        """
+        Record a clip around now.
+
+        Parameters
+        ----------
+        reason : object, optional
+            Logged with the clip, e.g. the triggering object label.
+
+        Returns
+        -------
+        str
+            Path of the clip being written.
+
+        """
+        with self._lock:
+            self._clip_until = time.monotonic() + self.post_roll
+            if self._clip_path is None:
+                self._clip_path = os.path.join(
+                    self.folder, "%s_%d.ts" % (self.prefix, time.time() * 1000))
+                self.logger.info("Recording clip %s: %s", self._clip_path, reason)
+                # only the references are copied, the writer does the I/O;
+                # the clip starts with the program tables so that players
+                # can decode the pre-roll
+                chunks = [data for _, data, _, _ in self._buffer]
+                if chunks:
+                    _, first, keyframe, tables = self._buffer[0]
+                    chunks[0:1] = [tables, first[keyframe:]]
+                self._write(("open", self._clip_path, chunks))
+            return self._clip_path
+
+    def feed(self, inference):
+        """
+        Check an inference against `rule` and trigger a clip on a match.
+
+        Parameters
+        ----------
+        inference : CameraInference
+            Inference from the camera.
+
+        Returns
+        -------
+        bool
+            True if the inference triggered a clip.
+
+        """
+        match = self.rule(inference)
+        if match:
+            self.trigger(getattr(match, "label", match))
+            return True
+        return False
+
+    def watch(self, inferences):
+        """
+        Feed inferences to the recorder while passing them through.
+
+        Parameters
+        ----------
+        inferences : generator of CameraInference
+            Inferences from `CameraClient.get_inferences`.
+
+        Yields
+        ------
+        CameraInference
+            The same inferences.
+
+        """
+        for inference in inferences:
+            self.feed(inference)
+            yield inference
+
+    def _read(self):
+        """
+        Private method reading the MPEG-TS stream on the reader thread.
+
+        """
+        chunk_size = TS_PACKET_SIZE * TS_PACKETS_PER_READ
+        pipe = self._sub_proc.stdout
+        pending = b""
+        try:
+            while not self._stopped.is_set():
+                data = pipe.read1(chunk_size) if hasattr(pipe, "read1") else pipe.read(chunk_size)
+                if not data:
+                    break
+                # keep whole packets only, the rest waits for the next read
+                data = pending + data
+                end = len(data) - len(data) % TS_PACKET_SIZE
+                data, pending = data[:end], data[end:]
+                if data:
+                    self._append(data)
+        except Exception as e:
+            self.logger.exception(e)
+        finally:
+            with self._lock:
+                self._close_clip()
+
+    def _append(self, data):
+        """
+        Private method adding packets to the pre-roll and the open clip.
+
+        """
+        now = time.monotonic()
+        keyframe, tables = self._scan(data)
+        with self._lock:
+            if self._clip_path is not None:
+                self._write(("data", data))
+                if now >= self._clip_until:
+                    self._close_clip()
+            if keyframe is None and not self._buffer:
+                # the pre-roll must start on a keyframe
+                return
+            self._buffer.append((now, data, keyframe, tables))
+            self._buffer_bytes += len(data)
+            self._trim(now)
+
+    def _scan(self, data):
+        """
+        Private method finding the first keyframe of whole MPEG-TS packets.
+
+        The latest PAT and PMT packets are kept on the way, the tables in
+        effect at the keyframe are returned with it. mpegtsmux writes them
+        just before every keyframe, often in the same read.
+
+        Returns
+        -------
+        tuple
+            (offset of the keyframe packet, PAT and PMT packets), both
+            None if there is no keyframe.
+
+        """
+        keyframe = tables = None
+        for offset in range(0, len(data) - TS_PACKET_SIZE + 1, TS_PACKET_SIZE):
+            if data[offset] != TS_SYNC_BYTE:
+                continue
+            pid = _packet_pid(data, offset)
+            if pid == TS_PAT_PID:
+                self._pat = data[offset:offset + TS_PACKET_SIZE]
+                self._pmt_pids = _pmt_pids(self._pat) or self._pmt_pids
+            elif pid in self._pmt_pids:
+                self._pmts[pid] = data[offset:offset + TS_PACKET_SIZE]
+            elif keyframe is None and _is_keyframe(data, offset):
+                keyframe = offset
+                tables = b"".join([self._pat or b""] + [
+                    self._pmts[pid] for pid in sorted(self._pmt_pids) if pid in self._pmts])
+        return keyframe, tables
+
+    def _trim(self, now):
+        """
+        Private method dropping the pre-roll older than `pre_roll`.
+
+        The buffer always starts on a keyframe, so it is only trimmed up
+        to the last keyframe older than the pre-roll.
+
+        """
+        cutoff = now - self.pre_roll
+        while True:
+            drop = 0
+            for index, (timestamp, data, keyframe, _) in enumerate(self._buffer):
+                if index == 0:
+                    continue
+                if timestamp > cutoff and self._buffer_bytes <= self.max_buffer_bytes:
+                    break
+                if keyframe is not None:
+                    drop = index
+                    break
+            if not drop:
+                return
+            for _ in range(drop):
+                self._buffer_bytes -= len(self._buffer.popleft()[1])
+
+    def _close_clip(self):
+        """
+        Private method closing the clip being written, with `_lock` held.
+
+        """
+        if self._clip_path is None:
+            return
+        self._write(("close", self._clip_path))
+        self._clip_path = None
+
+    def _write(self, op):
+        """
+        Private method queueing a file operation, with `_lock` held.
+
+        """
+        if self._writer is None or not self._writer.is_alive():
+            self._writer = threading.Thread(target=self._write_loop, name="clip-writer")
+            self._writer.daemon = True
+            self._writer.start()
+        self._writes.put(op)
+
+    def _write_loop(self):
+        """
+        Private method writing the clips on the writer thread.
+
+        """
+        clip_file = None
+        while True:
+            op = self._writes.get()
+            try:
+                if op[0] == "open":
+                    os.makedirs(self.folder, exist_ok=True)
+                    clip_file = open(op[1], "wb")
+                    for data in op[2]:
+                        clip_file.write(data)
+                elif op[0] == "data":
+                    if clip_file is not None:
+                        clip_file.write(op[1])
+                elif clip_file is not None:
+                    clip_file.close()
+                    clip_file = None
+                    self.clips.append(op[1])
+                    self.logger.info("Clip finished: %s", op[1])
+                    if self.on_clip:
+                        self.on_clip(op[1])
+            except Exception as e:
+                self.logger.exception(e)
+                if clip_file is not None and op[0] == "open":
+                    clip_file.close()
+                    clip_file = None
+            finally:
+                self._writes.task_done()
+
+    def _build_cmd(self, frame_src):
+        """
+        Private method for building the remuxing pipeline command.
+
+        Parameters
+        ----------
+        frame_src : str
+            Preview RTSP stream url.
+
+        Returns
+        -------
+        str
+            Shell command writing the MPEG-TS stream to stdout.
+
+        """
+        cmd = ['gst-launch-1.0 ',
+               ' -q ',
+               ' rtspsrc ',
+               ' location=%s' % frame_src,
+               ' protocols=tcp ',
+               ' ! ',
+               ' %s ' % CODEC_ELEMENTS.get(self.codec, CODEC_ELEMENTS["AVC/H.264"]),
+               ' ! ',
+               ' mpegtsmux ',
+               ' ! ',
+               ' fdsink ',
+               ' fd=1']
+        cmd = ''.join(cmd)
+        if self.source_cmd:
+            cmd = self.source_cmd.format(url=frame_src)
+        self.logger.info('frame_src: %s' % frame_src)
+        self.logger.info('gstreamer cmd: %s' % str(cmd))
+        return cmd
@@ -0,0 +1,175 @@
+# Copyright (c) 2018-2019, The Linux Foundation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials provided
+#      with the distribution.
+#    * Neither the name of The Linux Foundation nor the names of its
+#      contributors may be used to endorse or promote products derived
+#      from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NON-INFRINGEMENT
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+This module serializes the control commands sent to the camera.
+"""
+
+import collections
+import logging
+import threading
+from concurrent.futures import Future
+
+
+class CommandSerializer():
+    """
+    This is a class running camera commands one at a time.
+
+    Commands are queued from any thread and run in order on a worker
+    thread. A queued command is coalesced with a newer command of the same
+    key: only the newest one runs, at the position of the newest one, and
+    every caller gets its result. For example repeated overlay on/off
+    requests queued behind a slow preview change collapse into one call.
+    Only fire-and-forget commands should share a key: a caller waiting
+    on a coalesced command gets the result of another caller's command.
+
+    Attributes
+    ----------
+    name : str
+        Name of the worker thread.
+    executor : Executor
+        Optional pool running the queue instead of a dedicated thread,
+        see `CameraFleet`.
+    coalesced : int
+        Number of commands dropped in favour of a newer one.
+
+    """
+
+    def __init__(self, name="camera-commands", executor=None):
+        """
+        This is the constructor for `CommandSerializer` class.
+
+        """
+        self.name = name
+        self.executor = executor
+        self.coalesced = 0
+        #: OrderedDict: key -> (callable, args, kwargs, list of Future)
+        self._pending = collections.OrderedDict()
+        self._lock = threading.Lock()
+        #: bool: True while a worker is draining the queue.
+        self._draining = False
+        self._worker = None
+        self.logger = logging.getLogger("iotccsdk")
+
+    def submit(self, key, fn, *args, **kwargs):
+        """
+        Queue a command.
+
+        Parameters
+        ----------
+        key : hashable
+            Coalescing key, None for a command never coalesced.
+        fn : callable
+            Command to run.
+        args, kwargs
+            Arguments of `fn`.
+
+        Returns
+        -------
+        Future
+            Resolved with the result of the command that ran for `key`.
+
+        """
+        future = Future()
+        if threading.current_thread() is self._worker:
+            # nested command from a running one, run it in place
+            self._run(fn, args, kwargs, [future])
+            return future
+        if key is None:
+            key = object()
+        with self._lock:
+            futures = [future]
+            if key in self._pending:
+                futures = self._pending.pop(key)[3] + futures
+                self.coalesced += 1
+                self.logger.debug("coalesced queued command: %s", key)
+            self._pending[key] = (fn, args, kwargs, futures)
+            if not self._draining:
+                self._draining = True
+                if self.executor is not None:
+                    self.executor.submit(self._drain)
+                else:
+                    worker = threading.Thread(target=self._drain, name=self.name)
+                    worker.daemon = True
+                    worker.start()
+        return future
+
+    def call(self, key, fn, *args, **kwargs):
+        """
+        Queue a command and wait for its result.
+
+        Parameters
+        ----------
+        key : hashable
+            Coalescing key, None for a command never coalesced.
+        fn : callable
+            Command to run.
+        args, kwargs
+            Arguments of `fn`.
+
+        Returns
+        -------
+        object
+            Result of the command.
+
+        Raises
+        ------
+        Exception
+            Any exception raised by the command.
+
+        """
+        return self.submit(key, fn, *args, **kwargs).result()
+
+    @property
+    def queue_depth(self):
+        """int: Number of queued commands."""
+        with self._lock:
+            return len(self._pending)
+
+    def _drain(self):
+        # the worker only lives while there are queued commands, so idle
+        # cameras cost no thread
+        self._worker = threading.current_thread()
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._worker = None
+                    self._draining = False
+                    return
+                _, (fn, args, kwargs, futures) = self._pending.popitem(last=False)
+            self._run(fn, args, kwargs, futures)
+
+    def _run(self, fn, args, kwargs, futures):
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+        else:
+            for future in futures:
+                future.set_result(result)
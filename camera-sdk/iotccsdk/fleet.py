@@ -0,0 +1,755 @@
+# Copyright (c) 2018-2019, The Linux Foundation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials provided
+#      with the distribution.
+#    * Neither the name of The Linux Foundation nor the names of its
+#      contributors may be used to endorse or promote products derived
+#      from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NON-INFRINGEMENT
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+This module provides APIs for driving many cameras from one gateway.
+
+"""
+
+import collections
+import logging
+import os
+import selectors
+import socket
+import threading
+import time
+import websocket
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait
+from .camera import CameraClient
+from .ipcprovider import (IpcProvider, HEARTBEAT_MAX_FAILURES,
+                          HEARTBEAT_BACKOFF_INITIAL, HEARTBEAT_BACKOFF_MAX)
+
+# Threads shared by the logins and the commands of all the cameras
+FLEET_MAX_WORKERS = 8
+HEARTBEAT_PING_INTERVAL = 11
+HEARTBEAT_PING_TIMEOUT = 10
+
+
+class SharedHeartbeat():
+    """
+    This class keeps the /async websockets of many cameras open on one thread.
+
+    The sockets are multiplexed with a selector. Connecting, which blocks
+    on the TCP and websocket handshakes, runs on `executor` so one
+    unreachable camera does not stall the others. `register` is called like
+    `HeartBeatManager` and can be given to `IpcProvider` as
+    `heartbeat_factory`.
+
+    Attributes
+    ----------
+    executor : Executor
+        Pool running the connection attempts.
+    ping_interval : float
+        Seconds between two pings on a connection.
+    ping_timeout : float
+        Seconds to wait for the pong before dropping a connection.
+
+    """
+
+    def __init__(self, executor, ping_interval=HEARTBEAT_PING_INTERVAL,
+                 ping_timeout=HEARTBEAT_PING_TIMEOUT):
+        """
+        This is the constructor for `SharedHeartbeat` class.
+
+        """
+        self.executor = executor
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self._channels = []
+        #: deque: Callables run on the heartbeat thread, see `_call_soon`.
+        self._calls = collections.deque()
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ)
+        self._stopped = threading.Event()
+        self.logger = logging.getLogger("iotccsdk")
+        self._thread = threading.Thread(target=self.run, name="camera-heartbeat")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def register(self, host=None, cookie=None, on_event=None, on_lost=None,
+                 on_restored=None, max_failures=HEARTBEAT_MAX_FAILURES):
+        """
+        Start the heartbeat of a camera.
+
+        Parameters
+        ----------
+        host : str
+            "<ip>:<port>" of the QMMF IPC webserver.
+        cookie : str
+            Session token of the camera.
+        on_event, on_lost, on_restored : callable
+            Same as for `HeartBeatManager`.
+        max_failures : int
+            Consecutive failures before the camera is reported as failed.
+
+        Returns
+        -------
+        HeartbeatChannel
+            Handle of the heartbeat, with the `HeartBeatManager` methods.
+
+        """
+        channel = HeartbeatChannel(self, host, cookie, on_event, on_lost,
+                                   on_restored, max_failures)
+        self._call_soon(self._add, channel)
+        return channel
+
+    def _call_soon(self, fn, *args):
+        """
+        Private method for running `fn` on the heartbeat thread.
+
+        """
+        self._calls.append((fn, args))
+        try:
+            self._wakeup_w.send(b"\0")
+        except OSError:
+            pass
+
+    def _add(self, channel):
+        self._channels.append(channel)
+        channel._connect()
+
+    def _remove(self, channel):
+        channel._close()
+        if channel in self._channels:
+            self._channels.remove(channel)
+
+    def _attach(self, channel, ws):
+        """
+        Private method for adopting a connected websocket.
+
+        """
+        if channel._stopped or self._stopped.is_set():
+            ws.close()
+            return
+        channel._ws = ws
+        channel._sock = ws.sock
+        self._selector.register(channel._sock, selectors.EVENT_READ, channel)
+        channel._on_open()
+
+    def _detach(self, channel):
+        """
+        Private method for unregistering the websocket of a channel.
+
+        """
+        ws, sock = channel._ws, channel._sock
+        channel._ws = channel._sock = None
+        if ws is None:
+            return
+        try:
+            # websocket-client may already have dropped ws.sock on an error
+            self._selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+        try:
+            ws.close(timeout=0)
+        except Exception:
+            pass
+        finally:
+            ws.shutdown()
+
+    def run(self):
+        while not self._stopped.is_set():
+            now = time.monotonic()
+            timeout = min([channel._next_deadline(now) for channel in self._channels] +
+                          [1.0])
+            for key, _ in self._selector.select(max(timeout, 0)):
+                if key.data is None:
+                    try:
+                        while self._wakeup_r.recv(4096):
+                            pass
+                    except OSError:
+                        pass
+                else:
+                    key.data._on_readable()
+            while self._calls:
+                fn, args = self._calls.popleft()
+                try:
+                    fn(*args)
+                except Exception as e:
+                    self.logger.exception(e)
+            now = time.monotonic()
+            for channel in list(self._channels):
+                channel._tick(now)
+        for channel in list(self._channels):
+            self._remove(channel)
+        self._selector.close()
+        self._wakeup_r.close()
+        self._wakeup_w.close()
+
+    def stop(self):
+        """
+        Close all the heartbeats and stop the heartbeat thread.
+
+        """
+        self._stopped.set()
+        self._call_soon(lambda: None)
+        if threading.current_thread() is not self._thread:
+            self._thread.join(self.ping_timeout)
+
+
+class HeartbeatChannel():
+    """
+    This class is the heartbeat of one camera in a `SharedHeartbeat`.
+
+    It behaves like `HeartBeatManager`, except that running out of
+    `max_failures` marks the camera as failed instead of restarting the
+    services and exiting: the other cameras of the gateway keep running
+    and this one keeps being retried at the maximum backoff.
+
+    Attributes
+    ----------
+    host : str
+        "<ip>:<port>" of the QMMF IPC webserver.
+    failures : int
+        Consecutive connection failures since the last recovery.
+    max_failures : int
+        Failures tolerated before the camera is reported as failed.
+    failed : bool
+        True once `max_failures` was reached, until the next recovery.
+
+    """
+
+    def __init__(self, heartbeat, host, cookie, on_event, on_lost, on_restored,
+                 max_failures):
+        """
+        This is the constructor for `HeartbeatChannel` class.
+
+        """
+        self.host = host
+        self.max_failures = max_failures
+        self.failures = 0
+        self.failed = False
+        self.logger = logging.getLogger("iotccsdk")
+        self._heartbeat = heartbeat
+        self._cookie = cookie
+        self._on_event = on_event
+        self._on_lost = on_lost
+        self._on_restored = on_restored
+        self._ws = None
+        self._sock = None
+        self._connecting = False
+        self._lost = False
+        self._stopped = False
+        self._reconnect_at = None
+        self._ping_at = None
+        self._pong_deadline = None
+        self._last_message = None
+        self._opened = threading.Event()
+
+    @property
+    def connected(self):
+        """bool: True while the websocket is open."""
+        return self._ws is not None
+
+    def health(self):
+        """
+        Get the heartbeat health.
+
+        Returns
+        -------
+        dict
+            connected, failures, failed and the seconds since the last
+            message from the camera (None before the first message).
+
+        """
+        last_message = self._last_message
+        return {
+            "connected": self.connected,
+            "failures": self.failures,
+            "failed": self.failed,
+            "last_message_age": (None if last_message is None
+                                 else time.monotonic() - last_message),
+        }
+
+    def _connect(self):
+        """
+        Private method for starting a connection attempt on the executor.
+
+        """
+        if self._stopped or self._connecting:
+            return
+        self._connecting = True
+        self._reconnect_at = None
+        uri = "ws://%s/async" % self.host
+        self.logger.info("Connecting to: %s" % uri)
+
+        def connect():
+            try:
+                ws = websocket.create_connection(
+                    uri, timeout=self._heartbeat.ping_timeout)
+            except Exception as e:
+                self.logger.warning("Heartbeat error: %s: %s", self.host, e)
+                self._heartbeat._call_soon(self._on_connect_failed)
+            else:
+                self._heartbeat._call_soon(self._heartbeat._attach, self, ws)
+        try:
+            self._heartbeat.executor.submit(connect)
+        except RuntimeError:
+            # executor shut down, the fleet is closing
+            self._connecting = False
+
+    def _on_open(self):
+        self.logger.info("Starting heartbeat: %s", self.host)
+        self._connecting = False
+        self._opened.set()
+        now = time.monotonic()
+        self._last_message = now
+        self._ping_at = now + self._heartbeat.ping_interval
+        self._pong_deadline = None
+        if self._lost and self._on_restored:
+            self._lost = False
+            self._on_restored()
+        else:
+            self._lost = False
+            self.failures = 0
+
+    def _on_connect_failed(self):
+        self._connecting = False
+        self._on_dropped()
+
+    def _on_dropped(self):
+        """
+        Private method for scheduling the next attempt after a failure.
+
+        """
+        self._opened.clear()
+        self._heartbeat._detach(self)
+        if self._stopped:
+            return
+        self.failures += 1
+        if not self._lost:
+            self._lost = True
+            self.logger.error("Heartbeat lost: %s, reconnecting", self.host)
+            if self._on_lost:
+                self._on_lost()
+        if self.failures >= self.max_failures and not self.failed:
+            self.escalate()
+        delay = min(HEARTBEAT_BACKOFF_INITIAL * 2 ** (self.failures - 1),
+                    HEARTBEAT_BACKOFF_MAX)
+        self.logger.info("Heartbeat reconnect %s %d/%d in %ss",
+                         self.host, self.failures, self.max_failures, delay)
+        self._reconnect_at = time.monotonic() + delay
+
+    def _on_readable(self):
+        if self._ws is None:
+            # dropped earlier in the same select round
+            return
+        try:
+            opcode, frame = self._ws.recv_data_frame(True)
+        except Exception as e:
+            self.logger.warning("Heartbeat error: %s: %s", self.host, e)
+            self._on_dropped()
+            return
+        self._last_message = time.monotonic()
+        if opcode == websocket.ABNF.OPCODE_CLOSE:
+            self._on_dropped()
+        elif opcode == websocket.ABNF.OPCODE_PONG:
+            self._pong_deadline = None
+        elif opcode in (websocket.ABNF.OPCODE_TEXT, websocket.ABNF.OPCODE_BINARY):
+            message = frame.data
+            if isinstance(message, bytes) and opcode == websocket.ABNF.OPCODE_TEXT:
+                message = message.decode("utf-8")
+            self.logger.debug(message)
+            if self._on_event:
+                self._on_event(message)
+
+    def _next_deadline(self, now):
+        """
+        Private method for the seconds until `_tick` has work to do.
+
+        """
+        deadlines = [self._reconnect_at, self._ping_at if self._ws else None,
+                     self._pong_deadline]
+        deadlines = [deadline - now for deadline in deadlines if deadline is not None]
+        return min(deadlines) if deadlines else 1.0
+
+    def _tick(self, now):
+        """
+        Private method for the timers: reconnect, ping and pong timeout.
+
+        """
+        if self._ws is None:
+            if self._reconnect_at is not None and now >= self._reconnect_at:
+                self._connect()
+            return
+        if self._pong_deadline is not None and now >= self._pong_deadline:
+            self.logger.warning("Heartbeat error: %s: ping timeout", self.host)
+            self._on_dropped()
+        elif now >= self._ping_at:
+            try:
+                self._ws.ping()
+            except Exception as e:
+                self.logger.warning("Heartbeat error: %s: %s", self.host, e)
+                self._on_dropped()
+                return
+            self._ping_at = now + self._heartbeat.ping_interval
+            self._pong_deadline = now + self._heartbeat.ping_timeout
+
+    def _close(self):
+        self._stopped = True
+        self._opened.clear()
+        self._heartbeat._detach(self)
+
+    def wait_connected(self, timeout=None):
+        """
+        Wait for the connection to be open, see `HeartBeatManager`.
+
+        """
+        return self._opened.wait(timeout)
+
+    def reconnect(self):
+        """
+        Drop the connection so the heartbeat goes through a reconnect.
+
+        """
+        def drop():
+            self._lost = True
+            if self._ws is not None:
+                self._on_dropped()
+        self._heartbeat._call_soon(drop)
+
+    def mark_recovered(self):
+        """
+        Reset the failure count after a successful recovery.
+
+        """
+        self.failures = 0
+        self.failed = False
+
+    def escalate(self):
+        """
+        Report the camera as failed, it keeps being retried.
+
+        """
+        self.failed = True
+        self.logger.error("Camera %s not recovering after %d attempts!",
+                          self.host, self.failures)
+
+    def stop(self):
+        self.logger.info("Stopping heartbeat: %s", self.host)
+        self._stopped = True
+        self._heartbeat._call_soon(self._heartbeat._remove, self)
+
+
+class CameraFleet():
+    """
+    This is a class for driving many cameras from one gateway.
+
+    The cameras share a small thread pool for their logins and commands and
+    a single heartbeat thread, instead of a heartbeat thread per camera.
+
+    Attributes
+    ----------
+    username : str
+        Default username of the cameras.
+    password : str
+        Default password of the cameras.
+    session_dir : str
+        Optional directory where the session token of every camera is
+        persisted, see `IpcProvider`.
+    clients : OrderedDict
+        `CameraClient` of every connected camera, keyed by IP address.
+    heartbeat : SharedHeartbeat
+        Heartbeat of all the cameras.
+
+    """
+    logger = logging.getLogger("iotccsdk")
+
+    @classmethod
+    @contextmanager
+    def connect(cls, ip_addresses, username=None, password=None, session_dir=None,
+                max_workers=FLEET_MAX_WORKERS):
+        """
+        This method is used to create CameraFleet handle for application.
+
+        The cameras are connected concurrently. A camera failing to connect
+        does not fail the others, see `health`.
+
+        Parameters
+        ----------
+        ip_addresses : list of str
+            IP addresses of the cameras.
+        username : str
+            username for the cameras.
+        password : str
+            password for the cameras.
+        session_dir : str, optional
+            Directory for persisting the session tokens across restarts.
+        max_workers : int
+            Size of the thread pool shared by the cameras.
+
+        Yields
+        ------
+        CameraFleet
+            `CameraFleet` handle for the application.
+
+        """
+        fleet = CameraFleet(username, password, session_dir, max_workers)
+        try:
+            fleet.add_all(ip_addresses)
+            yield fleet
+        except Exception as e:
+            cls.logger.exception(e)
+            raise
+        finally:
+            fleet.close()
+
+    def __init__(self, username=None, password=None, session_dir=None,
+                 max_workers=FLEET_MAX_WORKERS):
+        """
+        The constructor for `CameraFleet` class
+
+        """
+        self.username = username
+        self.password = password
+        self.session_dir = session_dir
+        self.clients = collections.OrderedDict()
+        self._errors = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.heartbeat = SharedHeartbeat(self._executor)
+
+    def __getitem__(self, ip_address):
+        return self.clients[ip_address]
+
+    def __len__(self):
+        return len(self.clients)
+
+    def add(self, ip_address, username=None, password=None):
+        """
+        Connect a camera and add it to the fleet.
+
+        Parameters
+        ----------
+        ip_address : str
+            IP address of the camera.
+        username : str, optional
+            username of the camera, defaults to the fleet username.
+        password : str, optional
+            password of the camera, defaults to the fleet password.
+
+        Returns
+        -------
+        Future
+            Resolved with the `CameraClient` of the camera.
+
+        """
+        return self._executor.submit(self._add, ip_address, username, password)
+
+    def add_all(self, ip_addresses, timeout=None):
+        """
+        Connect cameras concurrently and wait for them.
+
+        Parameters
+        ----------
+        ip_addresses : list of str
+            IP addresses of the cameras.
+        timeout : float, optional
+            Maximum time to wait in seconds (the default is None, wait forever).
+
+        Returns
+        -------
+        dict
+            True or the connection error, keyed by IP address.
+
+        """
+        futures = collections.OrderedDict(
+            (ip_address, self.add(ip_address)) for ip_address in ip_addresses)
+        return self._collect(futures, timeout)
+
+    def _add(self, ip_address, username=None, password=None):
+        """
+        Private method for `add`, run on the thread pool.
+
+        """
+        session_file = None
+        if self.session_dir:
+            session_file = os.path.join(self.session_dir, "%s.json" % ip_address)
+        ipc_provider = IpcProvider(
+            ip=ip_address, username=username or self.username,
+            password=password or self.password, session_file=session_file,
+            heartbeat_factory=self.heartbeat.register)
+        try:
+            ipc_provider.connect()
+            try:
+                client = CameraClient(ipc_provider, executor=self._executor)
+            except Exception:
+                ipc_provider.logout()
+                raise
+        except Exception as e:
+            self.logger.error("Failed to connect camera %s: %s", ip_address, e)
+            with self._lock:
+                self._errors[ip_address] = e
+            raise
+        with self._lock:
+            self._errors.pop(ip_address, None)
+            self.clients[ip_address] = client
+        return client
+
+    def remove(self, ip_address):
+        """
+        Logout a camera and remove it from the fleet.
+
+        Parameters
+        ----------
+        ip_address : str
+            IP address of the camera.
+
+        Returns
+        -------
+        bool
+            True if the logout was successful.
+
+        """
+        with self._lock:
+            client = self.clients.pop(ip_address, None)
+            self._errors.pop(ip_address, None)
+        if client is None:
+            return False
+        return client.ipc_provider.logout()
+
+    def broadcast(self, command, *args, ip_addresses=None, timeout=None, **kwargs):
+        """
+        Run a camera command on many cameras concurrently.
+
+        Parameters
+        ----------
+        command : str
+            Name of a `CameraClient` command method, see `CameraClient.submit`.
+        args, kwargs
+            Arguments of the command.
+        ip_addresses : list of str, optional
+            Cameras to run the command on (the default is None, all cameras).
+        timeout : float, optional
+            Maximum time to wait in seconds (the default is None, wait forever).
+
+        Returns
+        -------
+        dict
+            Result or exception of the command, keyed by IP address.
+            A camera still running the command at `timeout` gets a
+            `TimeoutError`.
+
+        Examples
+        --------
+        >>> fleet.broadcast("set_analytics_state", "off")
+        {'192.168.1.10': True, '192.168.1.11': True}
+
+        """
+        with self._lock:
+            if ip_addresses is None:
+                ip_addresses = list(self.clients)
+            clients = [(ip_address, self.clients.get(ip_address))
+                       for ip_address in ip_addresses]
+        futures = collections.OrderedDict()
+        for ip_address, client in clients:
+            if client is None:
+                futures[ip_address] = KeyError("unknown camera: %s" % ip_address)
+            else:
+                futures[ip_address] = client.submit(command, *args, **kwargs)
+        return self._collect(futures, timeout)
+
+    def _collect(self, futures, timeout):
+        """
+        Private method for waiting for futures keyed by IP address.
+
+        """
+        pending = [future for future in futures.values()
+                   if not isinstance(future, Exception)]
+        wait(pending, timeout)
+        results = collections.OrderedDict()
+        for ip_address, future in futures.items():
+            if isinstance(future, Exception):
+                results[ip_address] = future
+            elif not future.done():
+                results[ip_address] = TimeoutError(
+                    "camera %s did not answer in %ss" % (ip_address, timeout))
+            elif future.exception() is not None:
+                results[ip_address] = future.exception()
+            else:
+                results[ip_address] = future.result()
+        return results
+
+    def health(self):
+        """
+        Get the health of every camera.
+
+        Returns
+        -------
+        dict
+            Per camera dict keyed by IP address with:
+            healthy (session and heartbeat up), heartbeat (see
+            `HeartbeatChannel.health`), state (see `CameraClient.state`),
+            requests and request_errors (IPC requests so far),
+            recoveries and recovery_errors (after heartbeat losses) and
+            error (last connection error).
+
+        """
+        with self._lock:
+            clients = list(self.clients.items())
+            errors = dict(self._errors)
+        health = collections.OrderedDict()
+        for ip_address, client in clients:
+            ipc_provider = client.ipc_provider
+            heartbeat = ipc_provider._heartbeat_manager
+            heartbeat_health = heartbeat.health() if heartbeat else None
+            endpoints = ipc_provider.metrics.snapshot().values()
+            recovery = ipc_provider.metrics.recovery_snapshot()
+            health[ip_address] = {
+                "healthy": bool(ipc_provider.session_token and heartbeat_health
+                                and heartbeat_health["connected"]),
+                "heartbeat": heartbeat_health,
+                "state": client.state,
+                "requests": sum(endpoint["count"] for endpoint in endpoints),
+                "request_errors": sum(endpoint["errors"] for endpoint in endpoints),
+                "recoveries": recovery["count"],
+                "recovery_errors": recovery["errors"],
+                "error": None,
+            }
+        for ip_address, error in errors.items():
+            health[ip_address] = {"healthy": False, "heartbeat": None, "state": None,
+                                  "requests": 0, "request_errors": 0,
+                                  "recoveries": 0, "recovery_errors": 0,
+                                  "error": str(error)}
+        return health
+
+    def close(self):
+        """
+        Logout all the cameras and stop the heartbeat and the thread pool.
+
+        """
+        with self._lock:
+            ip_addresses = list(self.clients)
+        futures = collections.OrderedDict(
+            (ip_address, self._executor.submit(self.remove, ip_address))
+            for ip_address in ip_addresses)
+        self._collect(futures, None)
+        self.heartbeat.stop()
+        self._executor.shutdown(wait=False)
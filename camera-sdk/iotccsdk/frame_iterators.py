@@ -29,11 +29,58 @@
 This module provides iterator for getting frame and inference.
 """
 
+import collections
 import json
 import logging
 import os
 import subprocess
 import sys
+import threading
+import time
+from .resolution import get_scale, COORDINATES_PIXEL
+
+#: int: Bytes per pixel of the decoded frames, BGR.
+FRAME_CHANNELS = 3
+#: int: Frame buffers in rotation, a yielded frame stays valid until
+#:      this many more frames were read.
+FRAME_BUFFERS = 3
+#: int: Last stderr lines of a pipeline kept for the log.
+STDERR_LINES = 20
+
+
+class _StderrTail(object):
+    """
+    This is a class reading the stderr of a pipeline on a daemon thread.
+
+    A pipeline logging to a pipe nobody reads blocks once the pipe buffer
+    is full, which would stall its stdout. The pipe is read as it is
+    written and only the last `STDERR_LINES` lines are kept.
+
+    """
+
+    def __init__(self, pipe):
+        self._lines = collections.deque(maxlen=STDERR_LINES)
+        self._thread = threading.Thread(target=self._read, args=(pipe,),
+                                        name="pipeline-stderr")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _read(self, pipe):
+        try:
+            for line in pipe:
+                self._lines.append(line)
+        except (OSError, ValueError):
+            # the pipe was closed under the reader
+            pass
+
+    def text(self, timeout=1.0):
+        """
+        Get the last lines, once the pipe is closed or after `timeout`.
+
+        """
+        self._thread.join(timeout)
+        return "".join(line.decode(errors="replace") if isinstance(line, bytes) else line
+                       for line in list(self._lines)).strip()
 
 
 class CameraInference(object):
@@ -130,23 +177,70 @@ class VideoInferenceIterator(object):
     preview_height: int
         Preview stream height. This is required for object location
         calculation.
+    source_cmd: str, optional
+        Command printing the VA metadata in the gst-launch fakesink dump
+        format. ``{url}`` is replaced by the VA stream url. Use this to run
+        against a synthetic metadata source, the default is the gstreamer
+        RTSP pipeline.
+    coordinates: str
+        "pixel" for object positions in preview pixels, the default, or
+        "normalized" for 0.0 - 1.0 of the frame.
 
     """
 
-    def __init__(self, preview_width, preview_height):
+    def __init__(self, preview_width, preview_height, source_cmd=None,
+                 coordinates=COORDINATES_PIXEL):
         """
         This is the constructor for `VideoInferenceIterator` class.
 
         """
-        self.preview_width = preview_width
-        self.preview_height = preview_height
+        self._preview_width = preview_width
+        self._preview_height = preview_height
+        self._coordinates = coordinates
+        #: tuple of float: Factors converting the VA coordinates.
+        self._scale = get_scale(preview_width, preview_height, coordinates)
+        self.source_cmd = source_cmd
         #: str: Holds the JSON inference metadata obtained from the camera
         self._json_str = ""
         #: subprocess: object where gstreamer pipeline for capture inference
         #:             stream is run.
         self._sub_proc = None
+        #: str: VA stream url of the running pipeline.
+        self._result_src = None
+        #: str: VA stream url to restart the pipeline with, None if no
+        #:      restart is pending.
+        self._restart_src = None
+        #: tuple: (VA stream url, subprocess) spawned by `prestart`.
+        self._prestarted = None
         self.logger = logging.getLogger('iotccsdk')
 
+    @property
+    def preview_width(self):
+        return self._preview_width
+
+    @preview_width.setter
+    def preview_width(self, value):
+        self._preview_width = value
+        self._scale = get_scale(value, self._preview_height, self._coordinates)
+
+    @property
+    def preview_height(self):
+        return self._preview_height
+
+    @preview_height.setter
+    def preview_height(self, value):
+        self._preview_height = value
+        self._scale = get_scale(self._preview_width, value, self._coordinates)
+
+    @property
+    def coordinates(self):
+        return self._coordinates
+
+    @coordinates.setter
+    def coordinates(self, value):
+        self._scale = get_scale(self._preview_width, self._preview_height, value)
+        self._coordinates = value
+
     def start(self, result_src):
         """
         This is the inference generator method
@@ -170,19 +264,6 @@ class VideoInferenceIterator(object):
             Any exception that occurs during inference handling.
 
         """
-        cmd = ['gst-launch-1.0 ',
-               ' -q ',
-               ' rtspsrc ',
-               ' location=%s' % result_src,
-               ' protocols=tcp ',
-               ' ! ',
-               ' application/x-rtp, media=application ',
-               ' ! ',
-               ' fakesink ',
-               ' dump=true']
-        cmd = ''.join(cmd)
-        self.logger.info('result_src: %s' % result_src)
-        self.logger.info('gstreamer cmd: %s' % str(cmd))
         platform = sys.platform
         platform = platform.lower()
         self.logger.info('Platform: %s' % platform)
@@ -192,42 +273,138 @@ class VideoInferenceIterator(object):
             data_idx = 72
 
         try:
-            self._sub_proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
-                                              stderr=subprocess.PIPE, bufsize=1,
-                                              universal_newlines=True)
-            for line in self._sub_proc.stdout:
-                if 'ERROR' in line or 'error' in line:
-                    raise Exception(line)
-                l_str = line[data_idx:]
-                l_str = l_str.strip(os.linesep)
-                self.logger.debug(l_str)
-                if ":[" in self._json_str and "] }" in self._json_str + l_str:
-                    # Only yield if objects are present in the inferences
-                    self._json_str = self._json_str + l_str
-                    s_idx = self._json_str.index('{ "')
-                    e_idx = self._json_str.index("] }") + 3
-                    self._json_str = self._json_str[s_idx:e_idx]
-                    self.logger.debug(self._json_str)
-                    result = self._get_inference_result()
-                    self._json_str = ""
-                    yield result
-                elif (":[" not in self._json_str
-                      and '{ "' in self._json_str
-                      and " }" in self._json_str + l_str):
-                    self._json_str = ""
+            while True:
+                if self._prestarted is not None and self._prestarted[0] == result_src:
+                    self._sub_proc, stderr = self._prestarted[1:]
                 else:
-                    self._json_str = self._json_str + l_str
+                    self._sub_proc, stderr = self._spawn(result_src)
+                self._prestarted = None
+                for line in self._sub_proc.stdout:
+                    if 'ERROR' in line or 'error' in line:
+                        raise Exception(line)
+                    l_str = line[data_idx:]
+                    l_str = l_str.strip(os.linesep)
+                    self.logger.debug(l_str)
+                    if ":[" in self._json_str and "] }" in self._json_str + l_str:
+                        # Only yield if objects are present in the inferences
+                        self._json_str = self._json_str + l_str
+                        s_idx = self._json_str.index('{ "')
+                        e_idx = self._json_str.index("] }") + 3
+                        self._json_str = self._json_str[s_idx:e_idx]
+                        self.logger.debug(self._json_str)
+                        result = self._get_inference_result()
+                        self._json_str = ""
+                        yield result
+                    elif (":[" not in self._json_str
+                          and '{ "' in self._json_str
+                          and " }" in self._json_str + l_str):
+                        self._json_str = ""
+                    else:
+                        self._json_str = self._json_str + l_str
+                if self._restart_src is None:
+                    error = stderr.text()
+                    if error:
+                        self.logger.error(error)
+                    break
+                result_src, self._restart_src = self._restart_src, None
+                self._json_str = ""
+                self.logger.info('Restarting inference stream')
         except (Exception, subprocess.CalledProcessError) as e:
             self.logger.exception(e)
             raise
 
+    def prestart(self, result_src):
+        """
+        This method spawns the VA stream pipeline ahead of `start`.
+
+        The gstreamer start up and the RTSP setup then overlap with
+        whatever the caller does before iterating.
+
+        Parameters
+        ----------
+        result_src : str
+            VA RTSP stream url, `start` must be called with the same url.
+
+        """
+        self._prestarted = (result_src,) + self._spawn(result_src)
+
+    def _spawn(self, result_src):
+        """
+        Private method starting the VA stream pipeline process.
+
+        Returns
+        -------
+        tuple
+            (process, `_StderrTail` of its stderr)
+
+        """
+        sub_proc = subprocess.Popen(self._build_cmd(result_src), shell=True,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE, bufsize=1,
+                                    universal_newlines=True)
+        return sub_proc, _StderrTail(sub_proc.stderr)
+
+    def restart(self, result_src=None):
+        """
+        This method restarts the VA stream pipeline.
+
+        The running generator keeps yielding from the new pipeline,
+        e.g. after the camera recovered from a webserver restart.
+
+        Parameters
+        ----------
+        result_src : str, optional
+            New VA RTSP stream url (the default is the current one).
+
+        """
+        self._restart_src = result_src or self._result_src
+        if self._sub_proc:
+            self._sub_proc.terminate()
+
     def stop(self):
         """
         This method stops the inference generator.
 
         """
+        self._restart_src = None
         if self._sub_proc:
             self._sub_proc.terminate()
+        if self._prestarted is not None:
+            self._prestarted[1].terminate()
+            self._prestarted = None
+
+    def _build_cmd(self, result_src):
+        """
+        Private method for building the VA stream pipeline command.
+
+        Parameters
+        ----------
+        result_src : str
+            VA RTSP stream url.
+
+        Returns
+        -------
+        str
+            Shell command printing the VA metadata.
+
+        """
+        self._result_src = result_src
+        cmd = ['gst-launch-1.0 ',
+               ' -q ',
+               ' rtspsrc ',
+               ' location=%s' % result_src,
+               ' protocols=tcp ',
+               ' ! ',
+               ' application/x-rtp, media=application ',
+               ' ! ',
+               ' fakesink ',
+               ' dump=true']
+        cmd = ''.join(cmd)
+        if self.source_cmd:
+            cmd = self.source_cmd.format(url=result_src)
+        self.logger.info('result_src: %s' % result_src)
+        self.logger.info('gstreamer cmd: %s' % str(cmd))
+        return cmd
 
     def _get_inference_result(self):
         """
@@ -247,13 +424,12 @@ class VideoInferenceIterator(object):
         try:
             j = json.loads(self._json_str)
             objects = []
+            scale_x, scale_y = self._scale
             for object in j["objects"]:
-                x = (object["position"]["x"] * self.preview_width) / 10000
-                y = (object["position"]["y"] * self.preview_height) / 10000
-                w = (object["position"]["width"] * self.preview_width) / 10000
-                h = (object["position"]["height"]
-                     * self.preview_height) / 10000
-                position = CameraInferenceObjectPosition(x, y, w, h)
+                p = object["position"]
+                position = CameraInferenceObjectPosition(
+                    p["x"] * scale_x, p["y"] * scale_y,
+                    p["width"] * scale_x, p["height"] * scale_y)
                 result_object = CameraInferenceObject(
                     object["id"], object["display_name"], object["confidence"], position)
                 objects.append(result_object)
@@ -264,3 +440,201 @@ class VideoInferenceIterator(object):
         except Exception as e:
             self.logger.exception(e)
             raise
+
+
+class VideoFrameIterator(object):
+    """
+    This is a class for frame generator.
+
+    Provides a generator method which can be used to get the decoded
+    frames of the RTSP preview stream from the camera. The stream is
+    decoded by a gstreamer child process writing raw BGR frames to a pipe,
+    the frames are read into preallocated buffers without copying.
+
+    Attributes
+    ----------
+    width : int
+        Width of the decoded frames, the stream is scaled at decode time.
+    height : int
+        Height of the decoded frames.
+    fps : int, optional
+        Frame rate of the decoded frames, frames are dropped or duplicated
+        at decode time. None keeps the stream frame rate.
+    source_cmd : str, optional
+        Command writing raw BGR frames to its stdout. ``{url}``,
+        ``{width}``, ``{height}`` and ``{fps}`` are replaced. Use this to
+        run against a synthetic video source, the default is the gstreamer
+        RTSP pipeline.
+    buffers : int
+        Number of frame buffers in rotation.
+    frame_count : int
+        Number of frames read so far.
+    last_timestamp : int
+        Host time in milliseconds at which the last frame was read.
+
+    """
+
+    def __init__(self, width, height, fps=None, source_cmd=None,
+                 buffers=FRAME_BUFFERS):
+        """
+        This is the constructor for `VideoFrameIterator` class.
+
+        """
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.source_cmd = source_cmd
+        self.buffers = max(int(buffers), 1)
+        self.frame_count = 0
+        self.last_timestamp = None
+        #: subprocess: object where the decoding gstreamer pipeline is run.
+        self._sub_proc = None
+        #: str: Preview stream url of the running pipeline.
+        self._frame_src = None
+        #: str: Preview stream url to restart the pipeline with, None if no
+        #:      restart is pending.
+        self._restart_src = None
+        self.logger = logging.getLogger('iotccsdk')
+
+    def start(self, frame_src):
+        """
+        This is the frame generator method
+
+        It decodes the RTSP preview stream from the camera.
+
+        Parameters
+        ----------
+        frame_src : str
+            Preview RTSP stream url.
+
+        Yields
+        ------
+        numpy.ndarray
+            height x width x 3 BGR frame. The array is a view of a reused
+            buffer, it is overwritten `buffers` frames later; copy it to
+            keep it longer.
+
+        Raises
+        ------
+        Exception
+            Any exception that occurs during decoding.
+
+        """
+        import numpy
+
+        frame_size = self.width * self.height * FRAME_CHANNELS
+        buffers = [bytearray(frame_size) for _ in range(self.buffers)]
+        frames = [numpy.frombuffer(buffer, dtype=numpy.uint8).reshape(
+            self.height, self.width, FRAME_CHANNELS) for buffer in buffers]
+        index = 0
+        try:
+            while True:
+                self._sub_proc = subprocess.Popen(self._build_cmd(frame_src), shell=True,
+                                                  stdout=subprocess.PIPE,
+                                                  stderr=subprocess.PIPE,
+                                                  bufsize=frame_size)
+                stderr = _StderrTail(self._sub_proc.stderr)
+                while self._read_frame(self._sub_proc.stdout, memoryview(buffers[index])):
+                    self.frame_count += 1
+                    self.last_timestamp = int(time.time() * 1000)
+                    yield frames[index]
+                    index = (index + 1) % self.buffers
+                self._sub_proc.wait()
+                if self._restart_src is None:
+                    error = stderr.text()
+                    if error:
+                        self.logger.error(error)
+                    break
+                frame_src, self._restart_src = self._restart_src, None
+                self.logger.info('Restarting preview stream')
+        except Exception as e:
+            self.logger.exception(e)
+            raise
+        finally:
+            self.stop()
+
+    def _read_frame(self, pipe, view):
+        """
+        Private method for reading one frame into `view`.
+
+        Returns
+        -------
+        bool
+            False when the stream ended before a complete frame.
+
+        """
+        offset = 0
+        while offset < len(view):
+            count = pipe.readinto(view[offset:])
+            if not count:
+                return False
+            offset += count
+        return True
+
+    def restart(self, frame_src=None):
+        """
+        This method restarts the decoding pipeline.
+
+        Parameters
+        ----------
+        frame_src : str, optional
+            New preview RTSP stream url (the default is the current one).
+
+        """
+        self._restart_src = frame_src or self._frame_src
+        if self._sub_proc:
+            self._sub_proc.terminate()
+
+    def stop(self):
+        """
+        This method stops the frame generator.
+
+        """
+        self._restart_src = None
+        if self._sub_proc and self._sub_proc.poll() is None:
+            self._sub_proc.terminate()
+
+    def _build_cmd(self, frame_src):
+        """
+        Private method for building the decoding pipeline command.
+
+        Parameters
+        ----------
+        frame_src : str
+            Preview RTSP stream url.
+
+        Returns
+        -------
+        str
+            Shell command writing raw BGR frames to stdout.
+
+        """
+        self._frame_src = frame_src
+        caps = 'video/x-raw,format=BGR,width=%d,height=%d' % (self.width, self.height)
+        if self.fps:
+            caps = '%s,framerate=%d/1' % (caps, self.fps)
+        cmd = ['gst-launch-1.0 ',
+               ' -q ',
+               ' rtspsrc ',
+               ' location=%s' % frame_src,
+               ' protocols=tcp ',
+               ' ! ',
+               ' decodebin ',
+               ' ! ',
+               ' videorate ',
+               ' ! ',
+               ' videoscale ',
+               ' ! ',
+               ' videoconvert ',
+               ' ! ',
+               ' %s ' % caps,
+               ' ! ',
+               ' fdsink ',
+               ' fd=1']
+        cmd = ''.join(cmd)
+        if self.source_cmd:
+            cmd = self.source_cmd.format(url=frame_src, width=self.width,
+                                         height=self.height, fps=self.fps or 0)
+        self.logger.info('frame_src: %s' % frame_src)
+        self.logger.info('gstreamer cmd: %s' % str(cmd))
+        return cmd
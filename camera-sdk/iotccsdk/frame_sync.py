@@ -0,0 +1,266 @@
+# Copyright (c) 2018-2019, The Linux Foundation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials provided
+#      with the distribution.
+#    * Neither the name of The Linux Foundation nor the names of its
+#      contributors may be used to endorse or promote products derived
+#      from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NON-INFRINGEMENT
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+This module provides the join of preview frames and VA inferences.
+
+"""
+
+import bisect
+import logging
+import threading
+import time
+
+#: int: Frames kept for matching, about 2 seconds at 30 fps.
+SYNC_WINDOW = 60
+#: int: Upper bound of the ring buffer whatever the frame size, 32 MiB.
+#:      About 48 frames at 640x360, 6 at 1080P.
+SYNC_MAX_BUFFER_BYTES = 32 * 1024 * 1024
+#: int: Default width of the synchronized frames, the height keeps the
+#:      preview aspect ratio.
+SYNC_FRAME_WIDTH = 640
+#: int: Largest distance in milliseconds between an inference and its frame.
+SYNC_TOLERANCE_MS = 100
+#: float: Seconds to wait for the frame of an inference newer than the
+#:        buffered frames.
+SYNC_MAX_WAIT = 0.5
+
+
+class FrameInferenceSynchronizer(object):
+    """
+    This is a class for matching VA inferences to preview frames.
+
+    The frames are read on a background thread into a ring buffer of
+    preallocated slots, so the memory stays bounded whatever the rates of
+    the two streams. Every inference is matched to the buffered frame
+    nearest to its timestamp.
+
+    The buffer is allocated on the first frame and holds `window` frames
+    or as many as fit in `max_buffer_bytes`, whichever is fewer; a
+    height x width BGR frame takes ``height * width * 3`` bytes, 6 MB at
+    1080P and 25 MB at 4K. Decode the frames downscaled to keep more of
+    them, the timestamps are matched the same way.
+
+    The frames are stamped with the host time at which they were read,
+    see `VideoFrameIterator.last_timestamp`. The inference timestamps are
+    mapped to the host clock with ``timestamp * timestamp_scale +
+    clock_offset``. When `clock_offset` is None it is estimated as the
+    smallest difference seen between the arrival time and the scaled
+    timestamp of the inferences, i.e. the offset of the fastest delivery.
+
+    Attributes
+    ----------
+    window : int
+        Number of frames kept in the ring buffer, lowered to what fits in
+        `max_buffer_bytes` on the first frame.
+    max_buffer_bytes : int
+        Upper bound of the ring buffer in bytes, at least one frame is
+        kept.
+    tolerance_ms : float
+        Largest distance between an inference and its frame, inferences
+        without a frame that close are dropped.
+    max_wait : float
+        Seconds to wait for the frame of an inference newer than the
+        buffered frames.
+    timestamp_scale : float
+        Milliseconds per unit of the inference timestamps.
+    clock_offset : float
+        Milliseconds added to the scaled inference timestamps.
+    matched : int
+        Number of inferences matched to a frame.
+    dropped : int
+        Number of inferences without a frame within `tolerance_ms`.
+
+    """
+
+    def __init__(self, window=SYNC_WINDOW, tolerance_ms=SYNC_TOLERANCE_MS,
+                 max_wait=SYNC_MAX_WAIT, timestamp_scale=1.0, clock_offset=None,
+                 max_buffer_bytes=SYNC_MAX_BUFFER_BYTES):
+        """
+        This is the constructor for `FrameInferenceSynchronizer` class.
+
+        """
+        self.window = max(int(window), 1)
+        self.max_buffer_bytes = max_buffer_bytes
+        self.tolerance_ms = tolerance_ms
+        self.max_wait = max_wait
+        self.timestamp_scale = timestamp_scale
+        self.clock_offset = clock_offset
+        self.matched = 0
+        self.dropped = 0
+        self._estimate_offset = clock_offset is None
+        #: ndarray: window x height x width x 3 frame slots.
+        self._frames = None
+        #: list: Timestamp of every slot, None while empty.
+        self._timestamps = [None] * self.window
+        #: int: Slot the next frame is written to.
+        self._next = 0
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._reader = None
+        self.logger = logging.getLogger("iotccsdk")
+
+    def start(self, frame_iterator, frames, inferences, copy=True):
+        """
+        This is the synchronized generator method.
+
+        Parameters
+        ----------
+        frame_iterator : VideoFrameIterator
+            Iterator producing `frames`, for the frame timestamps.
+        frames : generator of numpy.ndarray
+            Frames from `VideoFrameIterator.start()`.
+        inferences : generator of CameraInference
+            Inferences from `VideoInferenceIterator.start()`.
+        copy : bool
+            Yield a copy of the frame, one frame allocated per matched
+            inference. Without it the frame is a view of a ring buffer
+            slot, overwritten `window` frames later.
+
+        Yields
+        ------
+        tuple
+            (frame, inference) with the frame nearest to the inference.
+
+        """
+        self._reader = threading.Thread(target=self._read_frames,
+                                        args=(frame_iterator, frames),
+                                        name="frame-sync")
+        self._reader.daemon = True
+        self._reader.start()
+        try:
+            for inference in inferences:
+                if self._stopped:
+                    break
+                if inference.timestamp is None:
+                    continue
+                frame = self._match(inference, copy)
+                if frame is None:
+                    self.dropped += 1
+                    continue
+                self.matched += 1
+                yield frame, inference
+        finally:
+            self.stop()
+
+    def stop(self):
+        """
+        This method stops the frame reader.
+
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def _read_frames(self, frame_iterator, frames):
+        """
+        Private method copying the frames into the ring buffer.
+
+        """
+        import numpy
+
+        try:
+            for frame in frames:
+                with self._cond:
+                    if self._stopped:
+                        break
+                    if self._frames is None:
+                        self._allocate(numpy, frame)
+                    self._frames[self._next] = frame
+                    self._timestamps[self._next] = frame_iterator.last_timestamp
+                    self._next = (self._next + 1) % self.window
+                    self._cond.notify_all()
+        except Exception as e:
+            self.logger.exception(e)
+        finally:
+            with self._cond:
+                self._stopped = True
+                self._cond.notify_all()
+
+    def _allocate(self, numpy, frame):
+        """
+        Private method allocating the ring buffer for frames like `frame`.
+
+        Called with the condition held before the first frame is stored.
+
+        """
+        fit = max(self.max_buffer_bytes // max(frame.nbytes, 1), 1)
+        if fit < self.window:
+            self.logger.info("frame sync window lowered to %d frames of %d bytes",
+                             fit, frame.nbytes)
+            self.window = fit
+            self._timestamps = [None] * self.window
+        self._frames = numpy.empty((self.window,) + frame.shape, dtype=frame.dtype)
+
+    def _to_host_time(self, inference):
+        """
+        Private method mapping an inference timestamp to the host clock.
+
+        """
+        scaled = inference.timestamp * self.timestamp_scale
+        if self._estimate_offset:
+            offset = time.time() * 1000 - scaled
+            if self.clock_offset is None or offset < self.clock_offset:
+                self.clock_offset = offset
+        return scaled + self.clock_offset
+
+    def _match(self, inference, copy):
+        """
+        Private method for the frame nearest to an inference.
+
+        Returns
+        -------
+        numpy.ndarray
+            The frame, None if no frame is within `tolerance_ms`.
+
+        """
+        target = self._to_host_time(inference)
+        deadline = time.monotonic() + self.max_wait
+        with self._cond:
+            # wait for a frame at or past the inference, its frame may
+            # still be in the decoder
+            while not self._stopped:
+                newest = self._timestamps[(self._next - 1) % self.window]
+                remaining = deadline - time.monotonic()
+                if (newest is not None and newest >= target) or remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            slots = [(timestamp, slot) for slot, timestamp in enumerate(self._timestamps)
+                     if timestamp is not None]
+            if not slots:
+                return None
+            slots.sort()
+            index = bisect.bisect_left(slots, (target,))
+            candidates = slots[max(index - 1, 0):index + 1]
+            timestamp, slot = min(candidates, key=lambda item: abs(item[0] - target))
+            if abs(timestamp - target) > self.tolerance_ms:
+                self.logger.debug("no frame within %sms of inference %s",
+                                  self.tolerance_ms, inference.timestamp)
+                return None
+            frame = self._frames[slot]
+            return frame.copy() if copy else frame
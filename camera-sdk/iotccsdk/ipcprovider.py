@@ -29,22 +29,34 @@
 This module provides APIs for communicating with QMMF IPC webserver.
 """
 
+import itertools
 import json
 import logging
 import os
 import subprocess
 import requests
 import threading
+import time
 import traceback
 import websocket
+from .metrics import IpcMetrics
 
 # Port over which the camera/QMMF IPC webserver
 IPC_WEBSERVER_PORT = "1080"
 LOGIN_PATH = "login"
 LOGOUT_PATH = "logout"
+# Cheap authenticated call used to check a persisted session token
+SESSION_CHECK_PATH = "video"
+# Consecutive heartbeat failures before restarting the camera services
+HEARTBEAT_MAX_FAILURES = 8
+# Seconds before the first heartbeat reconnect, doubled on every failure
+HEARTBEAT_BACKOFF_INITIAL = 0.5
+HEARTBEAT_BACKOFF_MAX = 30
 POST_METHOD = "post"
 GET_METHOD = "get"
 ALL_METHODS = [POST_METHOD, GET_METHOD]
+# Log one request payload out of this many at INFO level, the rest at DEBUG
+LOG_SAMPLE_RATE = 50
 
 
 class IpcProvider():
@@ -59,10 +71,22 @@ class IpcProvider():
         password of the camera.
     ip_address : str
         IP address of the camera.
+    metrics : IpcMetrics
+        Per endpoint count, error count and latency of the requests.
+    log_sample_rate : int
+        One request payload out of `log_sample_rate` is logged at INFO
+        level, the others at DEBUG level.
+    session_file : str
+        Optional path where the session token is persisted, so a restarted
+        process can reuse it instead of logging in again.
+    heartbeat_factory : callable
+        Creates the heartbeat of the session, called like `HeartBeatManager`.
+        `CameraFleet` uses it to share one heartbeat thread between cameras.
 
     """
 
-    def __init__(self, ip, username=None, password=None):
+    def __init__(self, ip, username=None, password=None, session_file=None,
+                 heartbeat_factory=None):
         """
         This is the constructor for `IpcProvider` class
 
@@ -71,11 +95,23 @@ class IpcProvider():
         self.password = password
         self.ip_address = ip
         self.host = ":".join([ip, str(IPC_WEBSERVER_PORT)])
+        self.session_file = session_file
+        self.heartbeat_factory = heartbeat_factory or HeartBeatManager
 
         #: str: Session identifier obtained from the
         #:      camera/QMMF IPC webserver .
         self._session_token = None
+        #: RLock: Guards the session token and the login/logout sequence.
+        self._lock = threading.RLock()
         self._heartbeat_manager = None
+        #: list: Callables notified with every /async websocket message.
+        self._event_listeners = []
+        #: list: Callables restoring state after a heartbeat loss.
+        self._recovery_listeners = []
+        self._lost_at = None
+        self.metrics = IpcMetrics()
+        self.log_sample_rate = LOG_SAMPLE_RATE
+        self._log_counter = itertools.count()
         self.logger = logging.getLogger("iotccsdk")
 
     def _show_error(self, err_msg):
@@ -90,6 +126,59 @@ class IpcProvider():
         """
         self.logger.error(err_msg)
 
+    @property
+    def session_token(self):
+        """str: Current session token, read atomically."""
+        with self._lock:
+            return self._session_token
+
+    def add_event_listener(self, listener):
+        """
+        Register a listener for the camera notifications.
+
+        The listener is called from the heartbeat thread with every message
+        received over the /async websocket.
+
+        Parameters
+        ----------
+        listener : callable
+            Callable taking the notification message as argument.
+
+        """
+        with self._lock:
+            if listener not in self._event_listeners:
+                self._event_listeners = self._event_listeners + [listener]
+
+    def remove_event_listener(self, listener):
+        """
+        Unregister a listener added with `add_event_listener`.
+
+        Parameters
+        ----------
+        listener : callable
+            Listener to be removed.
+
+        """
+        with self._lock:
+            self._event_listeners = [
+                item for item in self._event_listeners if item != listener]
+
+    def _dispatch_event(self, message):
+        """
+        Private method for forwarding a notification to the listeners.
+
+        Parameters
+        ----------
+        message : str
+            Message received over the /async websocket.
+
+        """
+        for listener in self._event_listeners:
+            try:
+                listener(message)
+            except Exception as e:
+                self.logger.exception(e)
+
     def _get_function_name(self):
         """
         Private method for getting function name.
@@ -119,6 +208,19 @@ class IpcProvider():
         base_address = "".join(["http://", self.host])
         return "/".join([base_address, api_path.strip("/")])
 
+    def _log_request(self, url, payload):
+        """
+        Private method for logging a sampled request payload.
+
+        The message is only formatted when it is actually emitted.
+
+        """
+        if next(self._log_counter) % max(self.log_sample_rate, 1) == 0:
+            level = logging.INFO
+        else:
+            level = logging.DEBUG
+        self.logger.log(level, "API: %s data %s", url, payload)
+
     def get(self, path, payload=None, param=None):
         """
         GET API for QMMF IPC webserver.
@@ -208,28 +310,38 @@ class IpcProvider():
             raise ValueError("Method must be in %s" % ALL_METHODS)
 
         url = self._build_url(path)
-        headers = {"Cookie": self._session_token}
-        self.logger.info("API: %s data %s" % (url, payload))
+        session_token = self.session_token
+        self._log_request(url, payload)
+        error = True
+        start = time.monotonic()
         try:
             with requests.session() as mysession:
                 if method.lower() == POST_METHOD:
-                    response = mysession.post(
-                        url, data=json.dumps(payload), headers=headers, params=params)
+                    send = mysession.post
                 else:
-                    response = mysession.get(
-                        url, data=json.dumps(payload), headers=headers, params=params)
+                    send = mysession.get
+                response = send(url, data=json.dumps(payload),
+                                headers={"Cookie": session_token}, params=params)
+                if (response.status_code == requests.codes.unauthorized
+                        and self.session_token != session_token):
+                    # the session was renewed while this request was in flight
+                    response = send(url, data=json.dumps(payload),
+                                    headers={"Cookie": self.session_token}, params=params)
                 if response.status_code != requests.codes.ok:
-                    self.logger.info("RESPONSE: %s" % response.text)
+                    self.logger.info("RESPONSE: %s", response.text)
 
                 result = response.json()
                 if "status" not in result and "Status" not in result:
                     raise requests.ConnectionError(
                         "Call with method: %s to: %s returned malformed response: %s" %
                         (method, url, response))
+            error = response.status_code != requests.codes.ok
             return result
         except Exception as e:
             self.logger.exception(e)
             raise
+        finally:
+            self.metrics.record(method, path, time.monotonic() - start, error)
 
     def connect(self):
         """
@@ -253,24 +365,57 @@ class IpcProvider():
             The request is not correctly formed.
 
         """
-        if self._session_token:
-            # This is to clear out previous session before starting a new one
-            self.logout()
+        with self._lock:
+            if self._session_token:
+                # This is to clear out previous session before starting a new one
+                self.logout()
+            elif self.session_file and self._restore_session():
+                self._start_heartbeat()
+                return True
+
+            self._login()
+            self._save_session()
+            self._start_heartbeat()
+            return True
+
+    def _login(self):
+        """
+        Private method for the /login call.
+
+        This sets `_session_token` without touching the heartbeat.
+
+        Returns
+        -------
+        bool
+            True if the login was successful.
+
+        Raises
+        ------
+        ConnectionError
+            When the result of the call is a failure
 
+        """
         with requests.session() as mysession:
             try:
                 url = self._build_url(LOGIN_PATH)
                 payload = {"username": self.username, "userpwd": self.password}
-                self.logger.info("API: %s data: %s" % (url, payload))
-                response = mysession.post(url, json.dumps(payload))
-                self.logger.info("Login response: %s" % response.text)
+                self.logger.debug("API: %s data: %s", url, payload)
+                start = time.monotonic()
+                try:
+                    response = mysession.post(url, json.dumps(payload))
+                except Exception:
+                    self.metrics.record(POST_METHOD, LOGIN_PATH,
+                                        time.monotonic() - start, True)
+                    raise
+                self.metrics.record(POST_METHOD, LOGIN_PATH, time.monotonic() - start,
+                                    response.status_code != requests.codes.ok)
+                self.logger.info("Login response: %s", response.text)
                 result = response.json()
                 if "status" in result and result["status"]:
-                    self._session_token = response.headers["Set-Cookie"]
+                    with self._lock:
+                        self._session_token = response.headers["Set-Cookie"]
                     self.logger.info(
-                        "connection established with session token: [%s]" % self._session_token)
-                    self._heartbeat_manager = HeartBeatManager(
-                        self.host, self._session_token)
+                        "connection established with session token: [%s]", self._session_token)
                     return True
                 else:
                     raise requests.ConnectionError(
@@ -289,6 +434,178 @@ class IpcProvider():
                 self.logger.exception(e)
                 raise
 
+    def _start_heartbeat(self):
+        """
+        Private method for starting the /async websocket heartbeat.
+
+        """
+        self._heartbeat_manager = self.heartbeat_factory(
+            self.host, self._session_token,
+            on_event=self._dispatch_event,
+            on_lost=self._on_heartbeat_lost,
+            on_restored=self._on_heartbeat_restored)
+
+    def add_recovery_listener(self, listener):
+        """
+        Register a listener for the recovery after a heartbeat loss.
+
+        The listener is called without arguments once the heartbeat is
+        reconnected and the session is valid again. It should restore the
+        camera state it owns and raise if that fails.
+
+        Parameters
+        ----------
+        listener : callable
+            Callable taking no arguments.
+
+        """
+        with self._lock:
+            if listener not in self._recovery_listeners:
+                self._recovery_listeners = self._recovery_listeners + [listener]
+
+    def remove_recovery_listener(self, listener):
+        """
+        Unregister a listener added with `add_recovery_listener`.
+
+        Parameters
+        ----------
+        listener : callable
+            Listener to be removed.
+
+        """
+        with self._lock:
+            self._recovery_listeners = [
+                item for item in self._recovery_listeners if item != listener]
+
+    def _on_heartbeat_lost(self):
+        """
+        Private method called by the heartbeat when the connection drops.
+
+        """
+        self._lost_at = time.monotonic()
+
+    def _on_heartbeat_restored(self):
+        """
+        Private method called by the heartbeat when it is reconnected.
+
+        The recovery runs on its own thread so the websocket keeps serving.
+
+        """
+        t = threading.Thread(target=self._recover)
+        t.daemon = True
+        t.start()
+
+    def _recover(self):
+        """
+        Private method restoring the session and the camera state.
+
+        The session token is checked and renewed if needed, then the
+        recovery listeners are called. On failure the heartbeat is
+        reconnected, which counts towards its escalation limit.
+
+        """
+        start = self._lost_at or time.monotonic()
+        heartbeat_manager = self._heartbeat_manager
+        try:
+            with self._lock:
+                if not self._is_session_valid():
+                    self.logger.info("session rejected after heartbeat loss, logging in")
+                    self._login()
+                    self._save_session()
+            for listener in self._recovery_listeners:
+                listener()
+        except Exception as e:
+            self.logger.exception(e)
+            self.metrics.record_recovery(time.monotonic() - start, True)
+            if heartbeat_manager:
+                heartbeat_manager.reconnect()
+            return
+        self._lost_at = None
+        self.metrics.record_recovery(time.monotonic() - start)
+        self.logger.info("recovered from heartbeat loss in %.2fs",
+                         time.monotonic() - start)
+        if heartbeat_manager:
+            heartbeat_manager.mark_recovered()
+
+    def _is_session_valid(self):
+        """
+        Private method checking the session token with a cheap GET.
+
+        Returns
+        -------
+        bool
+            True if the camera accepts the session token.
+
+        """
+        if not self._session_token:
+            return False
+        try:
+            return bool(self.get(SESSION_CHECK_PATH).get("status"))
+        except Exception:
+            return False
+
+    def _restore_session(self):
+        """
+        Private method for reusing the session token from `session_file`.
+
+        The token is only used when it was issued for the same camera and
+        user, and the camera still accepts it.
+
+        Returns
+        -------
+        bool
+            True if the persisted session is valid.
+
+        """
+        try:
+            with open(self.session_file) as f:
+                session = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if (session.get("host") != self.host
+                or session.get("username") != self.username
+                or not session.get("token")):
+            return False
+
+        self._session_token = session["token"]
+        if self._is_session_valid():
+            self.logger.info("reusing persisted session token: [%s]",
+                             self._session_token)
+            return True
+        self.logger.info("persisted session token rejected, logging in")
+        self._session_token = None
+        self._clear_session()
+        return False
+
+    def _save_session(self):
+        """
+        Private method for persisting the session token to `session_file`.
+
+        """
+        if not self.session_file:
+            return
+        session = {"host": self.host, "username": self.username,
+                   "token": self._session_token}
+        tmp_file = "%s.tmp" % self.session_file
+        try:
+            fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as f:
+                json.dump(session, f)
+            os.replace(tmp_file, self.session_file)
+        except OSError as e:
+            self.logger.error("Failed to persist session token: %s", e)
+
+    def _clear_session(self):
+        """
+        Private method for removing the persisted session token.
+
+        """
+        if self.session_file and os.path.exists(self.session_file):
+            try:
+                os.remove(self.session_file)
+            except OSError as e:
+                self.logger.error("Failed to remove session file: %s", e)
+
     def logout(self):
         """
         Logout from the QMMF IPC webserver on the camera.
@@ -305,22 +622,53 @@ class IpcProvider():
             Any exception that occurs during the request.
 
         """
-        try:
-            if self._heartbeat_manager:
-                self._heartbeat_manager.stop()
-            response = self.post(LOGOUT_PATH)
-            if "status" in response and response["status"]:
-                return response["status"]
-            else:
-                return False
-        except Exception as e:
-            self.logger.exception(e)
-            raise
+        with self._lock:
+            try:
+                if self._heartbeat_manager:
+                    self._heartbeat_manager.stop()
+                response = self.post(LOGOUT_PATH)
+                if "status" in response and response["status"]:
+                    self._clear_session()
+                    return response["status"]
+                else:
+                    return False
+            except Exception as e:
+                self.logger.exception(e)
+                raise
 
 
 class HeartBeatManager():
-    def __init__(self, host=None, cookie=None):
+    """
+    This class keeps the /async websocket of the QMMF IPC webserver open.
+
+    A dropped connection is reconnected with exponential backoff. The
+    camera services are only restarted, as a last resort, after
+    `max_failures` consecutive failures without a successful recovery.
+
+    Attributes
+    ----------
+    failures : int
+        Consecutive connection failures since the last recovery.
+    max_failures : int
+        Failures tolerated before escalating to a service restart.
+
+    """
+
+    def __init__(self, host=None, cookie=None, on_event=None, on_lost=None,
+                 on_restored=None, max_failures=HEARTBEAT_MAX_FAILURES):
         self.logger = logging.getLogger("iotccsdk")
+        self._on_event = on_event
+        self._on_lost = on_lost
+        self._on_restored = on_restored
+        self.max_failures = max_failures
+        self.failures = 0
+        #: bool: True while the connection is open.
+        self._connected = False
+        #: bool: True between a connection loss and the next open.
+        self._lost = False
+        #: Event: Set while the connection is open.
+        self._opened = threading.Event()
+        self._stopped = threading.Event()
         websocket.enableTrace(True)
         uri = "ws://%s/async" % host
         self.logger.info("Connecting to: %s" % uri)
@@ -329,27 +677,101 @@ class HeartBeatManager():
                                               ws, msg),
                                           on_error=lambda ws, msg: self.on_error(
                                               ws, msg),
-                                          on_close=lambda ws: self.stop,
+                                          on_close=lambda ws, *args: self.on_close(ws),
                                           on_open=lambda ws: self.on_open(ws))
         t = threading.Thread(target=self.run)
         t.start()
 
     def on_message(self, ws, message):
         self.logger.debug(message)
+        if self._on_event:
+            self._on_event(message)
 
     def on_error(self, ws, error):
-        self.logger.error("Camera Restarted! Exiting!!")
-        subprocess.call("systemctl restart qmmf-webserver", shell=True)
-        subprocess.call("systemctl restart ipc-webserver", shell=True)
-        os._exit(-1)
+        self.logger.warning("Heartbeat error: %s", error)
+
+    def on_close(self, ws):
+        self._connected = False
+        self._opened.clear()
 
     def on_open(self, ws):
         self.logger.info("Starting heartbeat...")
+        self._connected = True
+        self._opened.set()
+        if self._lost and self._on_restored:
+            self._lost = False
+            self._on_restored()
+        else:
+            self._lost = False
+            self.failures = 0
 
     def run(self):
-        self._ws.run_forever(ping_interval=11, ping_timeout=10)
+        while not self._stopped.is_set():
+            self._ws.run_forever(ping_interval=11, ping_timeout=10)
+            self._connected = False
+            self._opened.clear()
+            if self._stopped.is_set():
+                break
+            self.failures += 1
+            if not self._lost:
+                self._lost = True
+                self.logger.error("Heartbeat lost, reconnecting")
+                if self._on_lost:
+                    self._on_lost()
+            if self.failures >= self.max_failures:
+                self.escalate()
+            delay = min(HEARTBEAT_BACKOFF_INITIAL * 2 ** (self.failures - 1),
+                        HEARTBEAT_BACKOFF_MAX)
+            self.logger.info("Heartbeat reconnect %d/%d in %ss",
+                             self.failures, self.max_failures, delay)
+            self._stopped.wait(delay)
+
+    def wait_connected(self, timeout=None):
+        """
+        Wait for the connection to be open.
+
+        Parameters
+        ----------
+        timeout : float, optional
+            Maximum time to wait in seconds (the default is None, wait forever).
+
+        Returns
+        -------
+        bool
+            True if the connection is open, False on timeout.
+
+        """
+        return self._opened.wait(timeout)
+
+    def reconnect(self):
+        """
+        Drop the connection so the heartbeat goes through a reconnect.
+
+        """
+        self._lost = True
+        if self._ws:
+            self._ws.close()
+
+    def mark_recovered(self):
+        """
+        Reset the failure count after a successful recovery.
+
+        """
+        self.failures = 0
+
+    def escalate(self):
+        """
+        Restart the camera services and exit, the last resort recovery.
+
+        """
+        self.logger.error("Camera not recovering after %d attempts! Exiting!!",
+                          self.failures)
+        subprocess.call("systemctl restart qmmf-webserver", shell=True)
+        subprocess.call("systemctl restart ipc-webserver", shell=True)
+        os._exit(-1)
 
     def stop(self):
         self.logger.info("Stopping heartbeat...")
+        self._stopped.set()
         if self._ws:
             self._ws.close()
@@ -0,0 +1,379 @@
+# Copyright (c) 2018-2019, The Linux Foundation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials provided
+#      with the distribution.
+#    * Neither the name of The Linux Foundation nor the names of its
+#      contributors may be used to endorse or promote products derived
+#      from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NON-INFRINGEMENT
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+This module provides metrics for the calls to the QMMF IPC webserver.
+"""
+
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+#: tuple of float: Upper bounds in seconds of the latency histogram buckets.
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                           0.5, 1.0, 2.5, 5.0, 10.0)
+#: tuple of float: Upper bounds in seconds of the recovery time buckets.
+DEFAULT_RECOVERY_BUCKETS = (0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+METRICS_PREFIX = "iotccsdk_ipc"
+
+
+class LatencyHistogram():
+    """
+    This is a class for a fixed bucket latency histogram.
+
+    Attributes
+    ----------
+    buckets : tuple of float
+        Upper bounds of the buckets in seconds.
+    counts : list of int
+        Observations per bucket, the last entry counts the overflow.
+    count : int
+        Number of observations.
+    sum : float
+        Sum of the observed latencies in seconds.
+
+    """
+
+    def __init__(self, buckets=DEFAULT_LATENCY_BUCKETS):
+        """
+        This is the constructor for `LatencyHistogram` class.
+
+        """
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        """
+        Add an observation to the histogram.
+
+        Parameters
+        ----------
+        seconds : float
+            Observed latency.
+
+        """
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def percentile(self, q):
+        """
+        Estimate a latency percentile from the buckets.
+
+        Parameters
+        ----------
+        q : float
+            Percentile between 0 and 100.
+
+        Returns
+        -------
+        float
+            Upper bound of the bucket holding the percentile,
+            None if there are no observations.
+
+        """
+        if not self.count:
+            return None
+        rank = q * self.count / 100.0
+        seen = 0
+        for i, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank and bucket_count:
+                return self.buckets[i] if i < len(self.buckets) else float("inf")
+        return float("inf")
+
+    def snapshot(self):
+        """
+        Get the histogram as a dict.
+
+        Returns
+        -------
+        dict
+            Cumulative counts keyed by bucket upper bound, with count and sum.
+
+        """
+        cumulative = {}
+        seen = 0
+        for bound, bucket_count in zip(self.buckets + ("+Inf",), self.counts):
+            seen += bucket_count
+            cumulative[str(bound)] = seen
+        return {"buckets": cumulative, "count": self.count, "sum": self.sum}
+
+
+class EndpointMetrics():
+    """
+    This is a class for the metrics of one API path and method.
+
+    Attributes
+    ----------
+    count : int
+        Number of requests.
+    errors : int
+        Number of requests which raised or returned an HTTP error.
+    latency : LatencyHistogram
+        Latency of the requests.
+
+    """
+
+    def __init__(self, buckets=DEFAULT_LATENCY_BUCKETS):
+        """
+        This is the constructor for `EndpointMetrics` class.
+
+        """
+        self.count = 0
+        self.errors = 0
+        self.latency = LatencyHistogram(buckets)
+
+    def snapshot(self):
+        return {"count": self.count, "errors": self.errors,
+                "latency": self.latency.snapshot()}
+
+
+class IpcMetrics():
+    """
+    This is a class for per endpoint metrics of `IpcProvider`.
+
+    Attributes
+    ----------
+    endpoints : dict
+        `EndpointMetrics` keyed by (method, path).
+    recovery : EndpointMetrics
+        Count, failures and duration of the in-process recoveries
+        after a heartbeat loss.
+
+    """
+
+    def __init__(self, buckets=DEFAULT_LATENCY_BUCKETS):
+        """
+        This is the constructor for `IpcMetrics` class.
+
+        """
+        self.buckets = tuple(buckets)
+        self.endpoints = {}
+        self.recovery = EndpointMetrics(DEFAULT_RECOVERY_BUCKETS)
+        self._lock = threading.Lock()
+        self._exporter = None
+        self.logger = logging.getLogger("iotccsdk")
+
+    def record(self, method, path, seconds, error=False):
+        """
+        Record a request.
+
+        Parameters
+        ----------
+        method : str
+            HTTP method of the request.
+        path : str
+            QMMF IPC webserver API.
+        seconds : float
+            Latency of the request.
+        error : bool
+            True if the request failed.
+
+        """
+        key = (method.upper(), "/" + path.strip("/"))
+        with self._lock:
+            endpoint = self.endpoints.get(key)
+            if endpoint is None:
+                endpoint = self.endpoints[key] = EndpointMetrics(self.buckets)
+            endpoint.count += 1
+            if error:
+                endpoint.errors += 1
+            endpoint.latency.observe(seconds)
+
+    def record_recovery(self, seconds, error=False):
+        """
+        Record an in-process recovery after a heartbeat loss.
+
+        Parameters
+        ----------
+        seconds : float
+            Time from the heartbeat loss to the restored camera state.
+        error : bool
+            True if the recovery failed.
+
+        """
+        with self._lock:
+            self.recovery.count += 1
+            if error:
+                self.recovery.errors += 1
+            self.recovery.latency.observe(seconds)
+
+    def recovery_snapshot(self):
+        """
+        Get a copy of the recovery metrics.
+
+        Returns
+        -------
+        dict
+            Count, errors and duration histogram of the recoveries.
+
+        """
+        with self._lock:
+            return self.recovery.snapshot()
+
+    def snapshot(self):
+        """
+        Get a copy of the metrics.
+
+        Returns
+        -------
+        dict
+            Metrics keyed by "<METHOD> <path>", e.g. "POST /preview".
+
+        """
+        with self._lock:
+            return {"%s %s" % key: endpoint.snapshot()
+                    for key, endpoint in self.endpoints.items()}
+
+    def reset(self):
+        """
+        Clear all the metrics.
+
+        """
+        with self._lock:
+            self.endpoints = {}
+            self.recovery = EndpointMetrics(DEFAULT_RECOVERY_BUCKETS)
+
+    def to_prometheus(self):
+        """
+        Format the metrics in the Prometheus text exposition format.
+
+        Returns
+        -------
+        str
+            Metrics text.
+
+        """
+        with self._lock:
+            endpoints = sorted(self.endpoints.items())
+            lines = [
+                "# HELP %s_requests_total Requests sent to the IPC webserver." % METRICS_PREFIX,
+                "# TYPE %s_requests_total counter" % METRICS_PREFIX,
+            ]
+            for (method, path), endpoint in endpoints:
+                lines.append('%s_requests_total{method="%s",path="%s"} %d' %
+                             (METRICS_PREFIX, method, path, endpoint.count))
+            lines += [
+                "# HELP %s_request_errors_total Failed requests." % METRICS_PREFIX,
+                "# TYPE %s_request_errors_total counter" % METRICS_PREFIX,
+            ]
+            for (method, path), endpoint in endpoints:
+                lines.append('%s_request_errors_total{method="%s",path="%s"} %d' %
+                             (METRICS_PREFIX, method, path, endpoint.errors))
+            lines += [
+                "# HELP %s_request_duration_seconds Request latency." % METRICS_PREFIX,
+                "# TYPE %s_request_duration_seconds histogram" % METRICS_PREFIX,
+            ]
+            for (method, path), endpoint in endpoints:
+                labels = 'method="%s",path="%s"' % (method, path)
+                for bound, seen in endpoint.latency.snapshot()["buckets"].items():
+                    lines.append('%s_request_duration_seconds_bucket{%s,le="%s"} %d' %
+                                 (METRICS_PREFIX, labels, bound, seen))
+                lines.append("%s_request_duration_seconds_sum{%s} %f" %
+                             (METRICS_PREFIX, labels, endpoint.latency.sum))
+                lines.append("%s_request_duration_seconds_count{%s} %d" %
+                             (METRICS_PREFIX, labels, endpoint.latency.count))
+            recovery = self.recovery.latency.snapshot()
+            lines += [
+                "# HELP %s_recoveries_total Recoveries after a heartbeat loss." % METRICS_PREFIX,
+                "# TYPE %s_recoveries_total counter" % METRICS_PREFIX,
+                "%s_recoveries_total %d" % (METRICS_PREFIX, self.recovery.count),
+                "# HELP %s_recovery_failures_total Failed recoveries." % METRICS_PREFIX,
+                "# TYPE %s_recovery_failures_total counter" % METRICS_PREFIX,
+                "%s_recovery_failures_total %d" % (METRICS_PREFIX, self.recovery.errors),
+                "# HELP %s_recovery_duration_seconds Recovery time." % METRICS_PREFIX,
+                "# TYPE %s_recovery_duration_seconds histogram" % METRICS_PREFIX,
+            ]
+            for bound, seen in recovery["buckets"].items():
+                lines.append('%s_recovery_duration_seconds_bucket{le="%s"} %d' %
+                             (METRICS_PREFIX, bound, seen))
+            lines.append("%s_recovery_duration_seconds_sum %f" %
+                         (METRICS_PREFIX, recovery["sum"]))
+            lines.append("%s_recovery_duration_seconds_count %d" %
+                         (METRICS_PREFIX, recovery["count"]))
+        return "\n".join(lines) + "\n"
+
+    def start_exporter(self, port=9100, host="127.0.0.1"):
+        """
+        Serve the metrics in the Prometheus text format.
+
+        The metrics are served on http://<host>:<port>/metrics
+        from a background thread.
+
+        Parameters
+        ----------
+        port : int
+            Port to listen on.
+        host : str
+            Address to listen on (the default is local only).
+
+        Returns
+        -------
+        HTTPServer
+            The exporter server.
+
+        """
+        if self._exporter:
+            return self._exporter
+        metrics = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                data = metrics.to_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._exporter = HTTPServer((host, port), _Handler)
+        t = threading.Thread(target=self._exporter.serve_forever)
+        t.daemon = True
+        t.start()
+        self.logger.info("Serving metrics on http://%s:%s/metrics", host, port)
+        return self._exporter
+
+    def stop_exporter(self):
+        """
+        Stop the exporter started with `start_exporter`.
+
+        """
+        if self._exporter:
+            self._exporter.shutdown()
+            self._exporter.server_close()
+            self._exporter = None
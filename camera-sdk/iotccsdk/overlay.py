@@ -0,0 +1,183 @@
+# Copyright (c) 2018-2019, The Linux Foundation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials provided
+#      with the distribution.
+#    * Neither the name of The Linux Foundation nor the names of its
+#      contributors may be used to endorse or promote products derived
+#      from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NON-INFRINGEMENT
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+This module provides the rate limited update of the text overlay.
+
+"""
+
+import logging
+import threading
+import time
+
+OVERLAY_UPDATE_INTERVAL = 1.0
+
+
+class OverlayUpdater(object):
+    """
+    This is a class for updating the text overlay from any thread.
+
+    `update` only stores the text and returns. A worker thread sends the
+    latest text with at most one /overlayconfig POST per `interval`,
+    intermediate texts are dropped and an unchanged text is not sent
+    again. The overlay is switched on with the first text.
+
+    Attributes
+    ----------
+    camera_client : CameraClient
+        Client of the camera.
+    interval : float
+        Minimum seconds between two /overlayconfig POSTs.
+    sent : int
+        Number of texts sent to the camera.
+    coalesced : int
+        Number of texts replaced by a newer one before being sent.
+    skipped : int
+        Number of texts not sent because they were already displayed.
+
+    """
+
+    def __init__(self, camera_client, interval=OVERLAY_UPDATE_INTERVAL):
+        """
+        This is the constructor for `OverlayUpdater` class.
+
+        """
+        self.camera_client = camera_client
+        self.interval = interval
+        self.sent = 0
+        self.coalesced = 0
+        self.skipped = 0
+        #: str: Latest text not sent yet, None if there is none.
+        self._pending = None
+        #: str: Text displayed by the camera.
+        self._displayed = None
+        self._last_post = None
+        #: bool: True while a text is being sent.
+        self._sending = False
+        self._cond = threading.Condition()
+        self._stopped = False
+        self.logger = logging.getLogger("iotccsdk")
+        self._worker = threading.Thread(target=self._run, name="overlay-updater")
+        self._worker.daemon = True
+        self._worker.start()
+
+    def update(self, text):
+        """
+        Show a text on the overlay, without blocking.
+
+        Parameters
+        ----------
+        text : str
+            Text to display.
+
+        """
+        text = str(text)
+        with self._cond:
+            if self._pending is not None:
+                self.coalesced += 1
+            self._pending = text
+            self._cond.notify()
+
+    def flush(self, timeout=None):
+        """
+        Wait for the latest text to be sent or skipped.
+
+        Parameters
+        ----------
+        timeout : float, optional
+            Maximum time to wait in seconds (the default is None, wait forever).
+
+        Returns
+        -------
+        bool
+            True if no text is waiting anymore.
+
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while ((self._pending is not None or self._sending)
+                   and self._worker.is_alive()):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return self._pending is None and not self._sending
+
+    def stop(self):
+        """
+        Stop the worker, a text still waiting is dropped.
+
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._worker is not threading.current_thread():
+            self._worker.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._pending is None and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                if self._last_post is not None:
+                    # rate limit, newer texts keep replacing the pending one
+                    delay = self._last_post + self.interval - time.monotonic()
+                    if delay > 0:
+                        self._cond.wait(delay)
+                        continue
+                text, self._pending = self._pending, None
+                if text == self._displayed:
+                    self.skipped += 1
+                    self._cond.notify_all()
+                    continue
+                self._sending = True
+            try:
+                self._send(text)
+            finally:
+                with self._cond:
+                    self._sending = False
+                    self._cond.notify_all()
+
+    def _send(self, text):
+        """
+        Private method sending a text, on the worker thread.
+
+        """
+        self._last_post = time.monotonic()
+        try:
+            if not self.camera_client.submit("configure_overlay", "text", text).result():
+                self.logger.error("Overlay update failed: %s", text)
+                return
+            if not self.camera_client.overlay_running:
+                self.camera_client.submit("set_overlay_state", "on").result()
+        except Exception as e:
+            self.logger.exception(e)
+            return
+        self._displayed = text
+        self.sent += 1
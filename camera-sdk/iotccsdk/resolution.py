@@ -0,0 +1,386 @@
+# Copyright (c) 2018-2019, The Linux Foundation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials provided
+#      with the distribution.
+#    * Neither the name of The Linux Foundation nor the names of its
+#      contributors may be used to endorse or promote products derived
+#      from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NON-INFRINGEMENT
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+This module provides the preview resolution model.
+
+"""
+
+import base64
+import functools
+import re
+import socket
+from urllib.parse import urlparse
+
+#: int: Range of the VA object coordinates, 10000 is the full frame.
+VA_COORDINATE_RANGE = 10000
+#: dict: Width and height of the camera resolution names.
+KNOWN_RESOLUTIONS = {
+    "4K": (3840, 2160),
+    "2160P": (3840, 2160),
+    "1080P": (1920, 1080),
+    "720P": (1280, 720),
+    "480P": (640, 480),
+}
+COORDINATES_PIXEL = "pixel"
+COORDINATES_NORMALIZED = "normalized"
+RTSP_TIMEOUT = 5
+
+_SIZE_PATTERN = re.compile(r"^\s*(\d+)\s*[xX*,-]\s*(\d+)\s*$")
+_LINES_PATTERN = re.compile(r"^\s*(\d+)\s*[pPiI]\s*$")
+_SDP_DIMENSIONS = re.compile(r"^a=x-dimensions:\s*(\d+)\s*,\s*(\d+)", re.MULTILINE)
+_SDP_FRAMESIZE = re.compile(r"^a=framesize:\s*\d+\s+(\d+)-(\d+)", re.MULTILINE)
+_SDP_SPROP = re.compile(r"sprop-parameter-sets=([A-Za-z0-9+/=]+)")
+
+
+class Resolution(object):
+    """
+    This is a class for a preview resolution.
+
+    Attributes
+    ----------
+    width : int
+        Width in pixels.
+    height : int
+        Height in pixels.
+    name : str
+        Name used by the camera, e.g. "1080P", if known.
+
+    """
+
+    def __init__(self, width, height, name=None):
+        """
+        This is the constructor for `Resolution` class.
+
+        """
+        self.width = int(width)
+        self.height = int(height)
+        self.name = name
+
+    def __eq__(self, other):
+        return (isinstance(other, Resolution)
+                and (self.width, self.height) == (other.width, other.height))
+
+    def __hash__(self):
+        return hash((self.width, self.height))
+
+    def __repr__(self):
+        return "Resolution(%d, %d, %r)" % (self.width, self.height, self.name)
+
+    @classmethod
+    def parse(cls, value):
+        """
+        Parse a resolution string of the camera.
+
+        Parameters
+        ----------
+        value : str
+            A name like "1080P" or "4K", or a size like "1920x1080".
+            A "<lines>P" name missing from `KNOWN_RESOLUTIONS` is not
+            understood, its width is not implied, see `guess`.
+
+        Returns
+        -------
+        Resolution
+            The parsed resolution, None if `value` is not understood.
+
+        """
+        if not value:
+            return None
+        key = str(value).strip().upper()
+        if key in KNOWN_RESOLUTIONS:
+            return cls(*KNOWN_RESOLUTIONS[key], name=value)
+        match = _SIZE_PATTERN.match(key)
+        if match:
+            return cls(int(match.group(1)), int(match.group(2)), name=value)
+        return None
+
+    @classmethod
+    def guess(cls, value):
+        """
+        Guess the resolution of a "<lines>P" name as 16:9.
+
+        This is a last resort for names `parse` does not understand and
+        whose stream cannot be asked, e.g. "576P" is taken as 1024x576
+        though cameras use 720x576.
+
+        Parameters
+        ----------
+        value : str
+            A name like "576P".
+
+        Returns
+        -------
+        Resolution
+            The guessed resolution, None if `value` is not a "<lines>P" name.
+
+        """
+        match = _LINES_PATTERN.match(str(value or ""))
+        if not match:
+            return None
+        height = int(match.group(1))
+        # rounded to an even width
+        return cls(int(round(height * 16 / 9.0 / 2)) * 2, height, name=value)
+
+    @classmethod
+    def from_sdp(cls, sdp):
+        """
+        Read the resolution of a stream from its SDP.
+
+        The x-dimensions and framesize attributes are used when present,
+        otherwise the H.264 sequence parameter set of the
+        sprop-parameter-sets.
+
+        Parameters
+        ----------
+        sdp : str
+            Session description, e.g. from `describe`.
+
+        Returns
+        -------
+        Resolution
+            The stream resolution, None if the SDP does not tell.
+
+        """
+        for pattern in (_SDP_DIMENSIONS, _SDP_FRAMESIZE):
+            match = pattern.search(sdp)
+            if match:
+                return cls(int(match.group(1)), int(match.group(2)))
+        match = _SDP_SPROP.search(sdp)
+        if match:
+            for parameter_set in match.group(1).split(","):
+                try:
+                    nal = base64.b64decode(parameter_set)
+                except ValueError:
+                    continue
+                if nal and nal[0] & 0x1f == 7:
+                    size = _parse_h264_sps(nal[1:])
+                    if size:
+                        return cls(*size)
+        return None
+
+    def scale(self, coordinates=COORDINATES_PIXEL):
+        """
+        Get the factors converting VA coordinates.
+
+        Parameters
+        ----------
+        coordinates : str
+            "pixel" for pixels of this resolution or "normalized"
+            for 0.0 - 1.0.
+
+        Returns
+        -------
+        tuple of float
+            (x factor, y factor) to multiply the VA coordinates by.
+
+        """
+        return get_scale(self.width, self.height, coordinates)
+
+
+@functools.lru_cache(maxsize=32)
+def get_scale(width, height, coordinates=COORDINATES_PIXEL):
+    """
+    Get the cached factors converting VA coordinates.
+
+    Parameters
+    ----------
+    width : int
+        Frame width in pixels.
+    height : int
+        Frame height in pixels.
+    coordinates : str
+        "pixel" or "normalized", see `Resolution.scale`.
+
+    Returns
+    -------
+    tuple of float
+        (x factor, y factor) to multiply the VA coordinates by.
+
+    Raises
+    ------
+    ValueError
+        If `coordinates` is not "pixel" or "normalized".
+
+    """
+    if coordinates == COORDINATES_NORMALIZED:
+        return 1.0 / VA_COORDINATE_RANGE, 1.0 / VA_COORDINATE_RANGE
+    if coordinates == COORDINATES_PIXEL:
+        return float(width) / VA_COORDINATE_RANGE, float(height) / VA_COORDINATE_RANGE
+    raise ValueError("coordinates must be in %s" %
+                     [COORDINATES_PIXEL, COORDINATES_NORMALIZED])
+
+
+def describe(url, timeout=RTSP_TIMEOUT):
+    """
+    Get the SDP of an RTSP stream with a DESCRIBE request.
+
+    Parameters
+    ----------
+    url : str
+        RTSP stream url.
+    timeout : float
+        Socket timeout in seconds.
+
+    Returns
+    -------
+    str
+        The session description.
+
+    Raises
+    ------
+    ConnectionError
+        If the server does not answer with a session description.
+
+    """
+    parsed = urlparse(url)
+    request = ("DESCRIBE %s RTSP/1.0\r\nCSeq: 1\r\nAccept: application/sdp\r\n\r\n" % url)
+    with socket.create_connection((parsed.hostname, parsed.port or 554), timeout) as sock:
+        sock.sendall(request.encode("ascii"))
+        response = b""
+        while b"\r\n\r\n" not in response:
+            data = sock.recv(4096)
+            if not data:
+                break
+            response += data
+        head, _, body = response.partition(b"\r\n\r\n")
+        match = re.search(rb"Content-Length:\s*(\d+)", head, re.IGNORECASE)
+        if not head.startswith(b"RTSP/1.0 200") or not match:
+            raise ConnectionError("DESCRIBE %s failed: %s" %
+                                  (url, head.split(b"\r\n")[0].decode(errors="replace")))
+        length = int(match.group(1))
+        while len(body) < length:
+            data = sock.recv(4096)
+            if not data:
+                break
+            body += data
+    return body[:length].decode(errors="replace")
+
+
+class _BitReader(object):
+    """
+    This is a class for reading the exp-Golomb coded H.264 headers.
+
+    """
+
+    def __init__(self, data):
+        # drop the emulation prevention bytes, 00 00 03 -> 00 00
+        self.data = re.sub(b"\x00\x00\x03", b"\x00\x00", bytes(data))
+        self.position = 0
+
+    def bit(self):
+        byte = self.data[self.position >> 3]
+        value = (byte >> (7 - (self.position & 7))) & 1
+        self.position += 1
+        return value
+
+    def bits(self, count):
+        value = 0
+        for _ in range(count):
+            value = (value << 1) | self.bit()
+        return value
+
+    def ue(self):
+        zeros = 0
+        while not self.bit():
+            zeros += 1
+        return (1 << zeros) - 1 + self.bits(zeros)
+
+    def se(self):
+        value = self.ue()
+        return (value + 1) // 2 if value & 1 else -(value // 2)
+
+
+def _parse_h264_sps(sps):
+    """
+    Read the frame size from an H.264 sequence parameter set.
+
+    Parameters
+    ----------
+    sps : bytes
+        The SPS NAL unit payload, without the NAL header byte.
+
+    Returns
+    -------
+    tuple of int
+        (width, height) after cropping, None if the SPS is truncated.
+
+    """
+    try:
+        reader = _BitReader(sps)
+        profile_idc = reader.bits(8)
+        reader.bits(16)  # constraint flags and level_idc
+        reader.ue()  # seq_parameter_set_id
+        chroma_format_idc = 1
+        separate_colour_plane = 0
+        if profile_idc in (100, 110, 122, 244, 44, 83, 86, 118, 128, 138, 139, 134, 135):
+            chroma_format_idc = reader.ue()
+            if chroma_format_idc == 3:
+                separate_colour_plane = reader.bit()
+            reader.ue()  # bit_depth_luma_minus8
+            reader.ue()  # bit_depth_chroma_minus8
+            reader.bit()  # qpprime_y_zero_transform_bypass_flag
+            if reader.bit():  # seq_scaling_matrix_present_flag
+                for index in range(8 if chroma_format_idc != 3 else 12):
+                    if reader.bit():
+                        last, next_scale = 8, 8
+                        for _ in range(16 if index < 6 else 64):
+                            if next_scale:
+                                next_scale = (last + reader.se()) % 256
+                            last = next_scale or last
+        reader.ue()  # log2_max_frame_num_minus4
+        pic_order_cnt_type = reader.ue()
+        if pic_order_cnt_type == 0:
+            reader.ue()
+        elif pic_order_cnt_type == 1:
+            reader.bit()
+            reader.se()
+            reader.se()
+            for _ in range(reader.ue()):
+                reader.se()
+        reader.ue()  # max_num_ref_frames
+        reader.bit()  # gaps_in_frame_num_value_allowed_flag
+        width_in_mbs = reader.ue() + 1
+        height_in_map_units = reader.ue() + 1
+        frame_mbs_only = reader.bit()
+        if not frame_mbs_only:
+            reader.bit()  # mb_adaptive_frame_field_flag
+        reader.bit()  # direct_8x8_inference_flag
+        crop_left = crop_right = crop_top = crop_bottom = 0
+        if reader.bit():
+            crop_left, crop_right = reader.ue(), reader.ue()
+            crop_top, crop_bottom = reader.ue(), reader.ue()
+    except IndexError:
+        return None
+    if separate_colour_plane or chroma_format_idc == 0:
+        crop_x, crop_y = 1, 2 - frame_mbs_only
+    else:
+        crop_x = 1 if chroma_format_idc == 3 else 2
+        crop_y = (2 if chroma_format_idc == 1 else 1) * (2 - frame_mbs_only)
+    width = width_in_mbs * 16 - crop_x * (crop_left + crop_right)
+    height = (2 - frame_mbs_only) * height_in_map_units * 16 - crop_y * (crop_top + crop_bottom)
+    return width, height
@@ -0,0 +1,215 @@
+# Copyright (c) 2018-2019, The Linux Foundation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials provided
+#      with the distribution.
+#    * Neither the name of The Linux Foundation nor the names of its
+#      contributors may be used to endorse or promote products derived
+#      from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NON-INFRINGEMENT
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+This module provides the orchestrated cold start of a camera.
+
+"""
+
+import collections
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from .camera import CameraClient, NULL_IP, LOOPBACK_IP
+from .frame_iterators import VideoInferenceIterator
+from .ipcprovider import IpcProvider
+
+HEARTBEAT_READY_TIMEOUT = 10
+
+
+class CameraStartup(object):
+    """
+    This is a class for starting a camera up to the first inference.
+
+    The steps of a cold start are run as soon as what they depend on is
+    done instead of one after the other:
+
+    * the heartbeat websocket connects while the capabilities are fetched
+      and the preview and the VA are switched on,
+    * the VA metadata pipeline is spawned while the overlay is configured.
+
+    The time of every phase is kept in `timings` and logged when the
+    first inference arrives.
+
+    Attributes
+    ----------
+    ip_address : str
+        IP address of the camera.
+    username : str
+        username of the camera.
+    password : str
+        password of the camera.
+    session_file : str
+        Optional path for persisting the session token, see `IpcProvider`.
+    preview_config : dict
+        Optional `CameraClient.configure_preview` arguments.
+    overlay : tuple
+        Optional `CameraClient.configure_overlay` (type, text) arguments,
+        the overlay is switched on when given.
+    source_cmd : str
+        Optional command replacing the VA pipeline,
+        see `VideoInferenceIterator`.
+    timings : OrderedDict
+        Seconds spent in every phase: login, capabilities, preview,
+        analytics, overlay, pipeline_spawn, heartbeat, then
+        first_inference (from the end of the start up) and total (from
+        the beginning).
+
+    """
+
+    def __init__(self, ip_address, username=None, password=None, session_file=None,
+                 preview_config=None, overlay=None, source_cmd=None):
+        """
+        This is the constructor for `CameraStartup` class.
+
+        """
+        self.ip_address = ip_address
+        self.username = username
+        self.password = password
+        self.session_file = session_file
+        self.preview_config = preview_config
+        self.overlay = overlay
+        self.source_cmd = source_cmd
+        self.timings = collections.OrderedDict()
+        self.logger = logging.getLogger("iotccsdk")
+
+    def _timed(self, phase, fn, *args, **kwargs):
+        """
+        Private method running `fn` and recording its duration as `phase`.
+
+        """
+        start = time.monotonic()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self.timings[phase] = time.monotonic() - start
+
+    @contextmanager
+    def start(self):
+        """
+        Connect the camera and start the preview, the VA and the overlay.
+
+        Yields
+        ------
+        tuple
+            (`CameraClient`, generator of `CameraInference`).
+
+        Raises
+        ------
+        EOFError
+            If the preview or the VA did not start.
+
+        Examples
+        --------
+        >>> startup = CameraStartup(ip, "admin", "admin", overlay=("inference", None))
+        >>> with startup.start() as (camera_client, inferences):
+        ...     for inference in inferences:
+        ...         pass
+
+        """
+        begin = time.monotonic()
+        self.timings.clear()
+        ipc_provider = IpcProvider(self.ip_address, self.username, self.password,
+                                   session_file=self.session_file)
+        self._timed("login", ipc_provider.connect)
+        camera_client = None
+        inference_iterator = None
+        try:
+            with ThreadPoolExecutor(max_workers=2) as pool:
+                heartbeat = ipc_provider._heartbeat_manager
+                heartbeat_ready = pool.submit(self._timed, "heartbeat",
+                                              heartbeat.wait_connected,
+                                              HEARTBEAT_READY_TIMEOUT)
+                camera_client = self._timed("capabilities", CameraClient, ipc_provider)
+                self._timed("preview", self._start_preview, camera_client)
+                self._timed("analytics", camera_client.set_analytics_state, "on")
+                if not camera_client.vam_running:
+                    raise EOFError("VAM not started")
+                if not camera_client.vam_url:
+                    camera_client._get_vam_info()
+                vam_url = camera_client.vam_url.replace(NULL_IP, LOOPBACK_IP)
+
+                preview_width, preview_height = camera_client._get_preview_size()
+                inference_iterator = VideoInferenceIterator(
+                    preview_width, preview_height, self.source_cmd)
+                spawned = pool.submit(self._timed, "pipeline_spawn",
+                                      inference_iterator.prestart, vam_url)
+                if self.overlay:
+                    self._timed("overlay", self._start_overlay, camera_client)
+                spawned.result()
+                if not heartbeat_ready.result():
+                    self.logger.warning("heartbeat not connected after %ss",
+                                        HEARTBEAT_READY_TIMEOUT)
+
+            camera_client._iterators.append(inference_iterator)
+            yield camera_client, self._first_inference(
+                inference_iterator.start(vam_url), begin, time.monotonic())
+        except Exception as e:
+            self.logger.exception(e)
+            raise
+        finally:
+            if inference_iterator is not None:
+                if inference_iterator in camera_client._iterators:
+                    camera_client._iterators.remove(inference_iterator)
+                inference_iterator.stop()
+            ipc_provider.logout()
+
+    def _start_preview(self, camera_client):
+        """
+        Private method configuring and switching on the preview.
+
+        """
+        if self.preview_config:
+            camera_client.configure_preview(**self.preview_config)
+        camera_client.set_preview_state("on")
+        if not camera_client.preview_running:
+            raise EOFError("preview not started")
+
+    def _start_overlay(self, camera_client):
+        """
+        Private method configuring and switching on the overlay.
+
+        """
+        camera_client.configure_overlay(*self.overlay)
+        camera_client.set_overlay_state("on")
+
+    def _first_inference(self, inferences, begin, ready):
+        """
+        Private method passing the inferences through, timing the first one.
+
+        """
+        first = True
+        for inference in inferences:
+            if first:
+                first = False
+                now = time.monotonic()
+                self.timings["first_inference"] = now - ready
+                self.timings["total"] = now - begin
+                self.logger.info("Camera start up: %s", ", ".join(
+                    "%s %.3fs" % item for item in self.timings.items()))
+            yield inference
@@ -39,7 +39,7 @@ with open(path.join(here, 'README.md'), encoding='utf-8') as f:
 
 
 NAME = 'iotccsdk'
-VERSION = '0.1.4'
+VERSION = '0.1.5'
 DESCRIPTION = 'SDK in Python for interacting with the Vision AI DevKit.'
 PROJECT_URL = 'https://github.com/microsoft/vision-ai-developer-kit'
 DEPENDENCIES = ['pip >= 9.0.0', 'requests',
@@ -0,0 +1,661 @@
+# Copyright (c) 2018-2019, The Linux Foundation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials provided
+#      with the distribution.
+#    * Neither the name of The Linux Foundation nor the names of its
+#      contributors may be used to endorse or promote products derived
+#      from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NON-INFRINGEMENT
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Local stand-in for the QMMF IPC webserver of the camera.
+
+It serves the port 1080 REST API used by `IpcProvider` and `CameraClient`
+together with the /async websocket, with configurable latency and failure
+injection. The ``va`` command prints synthetic VA metadata in the
+gst-launch fakesink dump format read by `VideoInferenceIterator` and the
+``frames`` command writes synthetic raw frames read by `VideoFrameIterator`.
+The ``ts`` command writes a synthetic MPEG-TS stream read by `ClipRecorder`.
+
+Run the webserver and point any of the test scripts at it:
+
+    python fake_ipc_webserver.py serve --latency 0.05 --failure-rate 0.01
+    python test-preview-inference-overlay.py --ip 127.0.0.1
+
+All are importable from a load test, see test-load-fake-camera.py.
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import os
+import random
+import socket
+import struct
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+WS_OP_TEXT = 0x1
+WS_OP_CLOSE = 0x8
+WS_OP_PING = 0x9
+WS_OP_PONG = 0xA
+
+RESOLUTIONS = ["4K", "1080P", "720P", "480P"]
+ENCODE_MODES = ["HEVC/H.265", "AVC/H.264"]
+BITRATES = ["512Kbps", "768Kbps", "1Mbps", "1.5Mbps", "2Mbps", "3Mbps",
+            "4Mbps", "6Mbps", "8Mbps", "10Mbps", "20Mbps"]
+FRAMERATES = [24, 30]
+PREVIEW_URL = "rtsp://0.0.0.0:8900/live"
+VAM_URL = "rtsp://0.0.0.0:8902/live"
+SWITCH_PATHS = {"/preview": "preview", "/vam": "vam",
+                "/overlay": "overlay", "/recording": "recording"}
+LABELS = ["person", "car", "bicycle", "dog", "cat", "chair", "bottle"]
+# gst-launch fakesink dump: offset, pointer and 16 hex bytes before the text
+DUMP_BYTES_PER_LINE = 16
+RTP_HEADER_SIZE = 12
+
+
+class FakeCamera():
+    """
+    This is the state of the fake camera behind the webserver.
+
+    Attributes
+    ----------
+    username : str
+        username accepted by /login.
+    password : str
+        password accepted by /login.
+    snapshot : bytes
+        JPEG returned by /captureimage.
+
+    """
+
+    def __init__(self, username="admin", password="admin", snapshot=None):
+        self.username = username
+        self.password = password
+        self.snapshot = snapshot or self._synthetic_jpeg(64 * 1024)
+        self.sessions = set()
+        self.video = {
+            "resolutionSelectVal": 1,
+            "encodeModeSelectVal": 1,
+            "bitRateSelectVal": 3,
+            "fpsSelectVal": 1,
+            "displayOut": 1,
+        }
+        self.switches = {name: False for name in SWITCH_PATHS.values()}
+        self.overlay_config = {
+            "ov_type_SelectVal": 5,
+            "ov_position_SelectVal": 0,
+            "ov_color": "869007615",
+            "ov_usertext": "Text",
+            "ov_start_x": 0,
+            "ov_start_y": 0,
+            "ov_width": 0,
+            "ov_height": 0,
+        }
+        self.lock = threading.Lock()
+
+    def _synthetic_jpeg(self, size):
+        # SOI, filler and EOI markers, enough to look like a JPEG on the wire
+        return b"\xff\xd8" + os.urandom(size) + b"\xff\xd9"
+
+    def handle(self, method, path, payload, cookie):
+        """
+        Handle a REST call.
+
+        Returns
+        -------
+        tuple
+            (HTTP status, response dict, extra headers dict,
+            /async notification dict or None)
+
+        """
+        if path == "/login" and method == "POST":
+            if (payload.get("username") != self.username
+                    or payload.get("userpwd") != self.password):
+                return 200, {"status": False}, {}, None
+            token = "session=%s" % "".join(
+                random.choice("0123456789abcdef") for _ in range(32))
+            with self.lock:
+                self.sessions.add(token)
+            return 200, {"status": True}, {"Set-Cookie": token}, None
+
+        if cookie not in self.sessions:
+            return 401, {"status": False, "Error": "unauthorized"}, {}, None
+
+        with self.lock:
+            if path == "/logout":
+                self.sessions.discard(cookie)
+                return 200, {"status": True}, {}, None
+            if path == "/video":
+                if method == "GET":
+                    result = dict(self.video, status=True, resolution=RESOLUTIONS,
+                                  encodeMode=ENCODE_MODES, bitRate=BITRATES,
+                                  fps=FRAMERATES)
+                    return 200, result, {}, None
+                self.video.update(payload)
+                return 200, {"status": True}, {}, None
+            if path == "/overlayconfig":
+                if method == "POST":
+                    self.overlay_config.update(payload)
+                return 200, dict(self.overlay_config, status=True), {}, None
+            if path == "/captureimage":
+                result = {
+                    "status": True,
+                    "Error": "none",
+                    "Timestamp": int(time.time() * 1000),
+                    "Data": base64.b64encode(self.snapshot).decode("ascii"),
+                }
+                return 200, result, {}, None
+            if path in SWITCH_PATHS:
+                name = SWITCH_PATHS[path]
+                if method == "POST":
+                    self.switches[name] = bool(payload.get("switchStatus"))
+                    event = {name: {"switchStatus": self.switches[name]}}
+                    return 200, {"status": True}, {}, event
+                result = {"status": self.switches[name]}
+                if name == "preview" and self.switches[name]:
+                    result["url"] = PREVIEW_URL
+                elif name == "vam" and self.switches[name]:
+                    result["url"] = VAM_URL
+                return 200, result, {}, None
+        return 404, {"status": False, "Error": "unknown path %s" % path}, {}, None
+
+
+class FakeIpcWebserver(ThreadingMixIn, HTTPServer):
+    """
+    This is the fake QMMF IPC webserver.
+
+    Attributes
+    ----------
+    camera : FakeCamera
+        State of the fake camera.
+    latency : float
+        Seconds added to every REST response.
+    jitter : float
+        Maximum random seconds added on top of `latency`.
+    failure_rate : float
+        Probability for a REST call to fail with HTTP 500.
+    transition_time : float
+        Seconds between a switch POST and its /async notification.
+
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host="127.0.0.1", port=1080, camera=None, latency=0.0,
+                 jitter=0.0, failure_rate=0.0, transition_time=0.0):
+        self.camera = camera or FakeCamera()
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.transition_time = transition_time
+        self.requests_served = 0
+        self.failures_injected = 0
+        self._websockets = []
+        self._ws_lock = threading.Lock()
+        self._thread = None
+        HTTPServer.__init__(self, (host, port), FakeIpcRequestHandler)
+
+    def start(self):
+        """Serve from a background thread."""
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving and close the websockets."""
+        self.drop_websockets()
+        self.shutdown()
+        self.server_close()
+
+    def notify(self, event):
+        """Send a notification to every /async websocket."""
+        data = json.dumps(event).encode("utf-8")
+        with self._ws_lock:
+            websockets = list(self._websockets)
+        for ws in websockets:
+            ws.send_frame(WS_OP_TEXT, data)
+
+    def drop_websockets(self):
+        """Close every /async websocket, like a webserver restart would."""
+        with self._ws_lock:
+            websockets, self._websockets = self._websockets, []
+        for ws in websockets:
+            ws.close_socket()
+
+    def _add_websocket(self, handler):
+        with self._ws_lock:
+            self._websockets.append(handler)
+
+    def _remove_websocket(self, handler):
+        with self._ws_lock:
+            if handler in self._websockets:
+                self._websockets.remove(handler)
+
+
+class FakeIpcRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if (self.path.split("?")[0] == "/async"
+                and self.headers.get("Upgrade", "").lower() == "websocket"):
+            self._serve_websocket()
+        else:
+            self._serve_rest("GET")
+
+    def do_POST(self):
+        self._serve_rest("POST")
+
+    def _serve_rest(self, method):
+        server = self.server
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        try:
+            payload = json.loads(body.decode("utf-8")) if body else {}
+        except ValueError:
+            payload = {}
+        if not isinstance(payload, dict):
+            payload = {}
+
+        delay = server.latency + random.uniform(0, server.jitter)
+        if delay:
+            time.sleep(delay)
+        server.requests_served += 1
+        if server.failure_rate and random.random() < server.failure_rate:
+            server.failures_injected += 1
+            status, result, headers, event = (
+                500, {"status": False, "Error": "injected failure"}, {}, None)
+        else:
+            status, result, headers, event = server.camera.handle(
+                method, self.path.split("?")[0], payload,
+                self.headers.get("Cookie"))
+
+        data = json.dumps(result).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+        if event is not None:
+            if server.transition_time:
+                timer = threading.Timer(server.transition_time, server.notify, [event])
+                timer.daemon = True
+                timer.start()
+            else:
+                server.notify(event)
+
+    def _serve_websocket(self):
+        key = self.headers.get("Sec-WebSocket-Key", "")
+        accept = base64.b64encode(hashlib.sha1(
+            (key + WEBSOCKET_GUID).encode("ascii")).digest()).decode("ascii")
+        self.send_response(101, "Switching Protocols")
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", accept)
+        self.end_headers()
+        self.wfile.flush()
+
+        self._send_lock = threading.Lock()
+        self.server._add_websocket(self)
+        try:
+            while True:
+                frame = self._read_frame()
+                if frame is None:
+                    break
+                opcode, data = frame
+                if opcode == WS_OP_PING:
+                    self.send_frame(WS_OP_PONG, data)
+                elif opcode == WS_OP_CLOSE:
+                    self.send_frame(WS_OP_CLOSE, data[:2])
+                    break
+        except (OSError, ValueError):
+            pass
+        finally:
+            self.server._remove_websocket(self)
+            self.close_connection = True
+
+    def _read_exact(self, size):
+        data = self.rfile.read(size)
+        if len(data) < size:
+            return None
+        return data
+
+    def _read_frame(self):
+        header = self._read_exact(2)
+        if header is None:
+            return None
+        opcode = header[0] & 0x0F
+        masked = header[1] & 0x80
+        length = header[1] & 0x7F
+        if length == 126:
+            length = struct.unpack("!H", self._read_exact(2))[0]
+        elif length == 127:
+            length = struct.unpack("!Q", self._read_exact(8))[0]
+        mask = self._read_exact(4) if masked else b"\x00" * 4
+        data = self._read_exact(length) if length else b""
+        if data is None or mask is None:
+            return None
+        data = bytes(b ^ mask[i % 4] for i, b in enumerate(data))
+        return opcode, data
+
+    def send_frame(self, opcode, data):
+        length = len(data)
+        if length < 126:
+            header = struct.pack("!BB", 0x80 | opcode, length)
+        elif length < 65536:
+            header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+        try:
+            with self._send_lock:
+                self.wfile.write(header + data)
+                self.wfile.flush()
+        except (OSError, ValueError):
+            pass
+
+    def close_socket(self):
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class SyntheticVamSource():
+    """
+    This is a synthetic VA metadata source.
+
+    It produces the JSON metadata of the camera VA stream and formats it the
+    way ``gst-launch-1.0 ... fakesink dump=true`` prints the RTP buffers.
+
+    Attributes
+    ----------
+    fps : float
+        Metadata messages per second.
+    objects : int
+        Detected objects per message.
+    labels : list of str
+        Labels picked for the detected objects.
+
+    """
+
+    def __init__(self, fps=30.0, objects=3, labels=None):
+        self.fps = fps
+        self.objects = objects
+        self.labels = labels or LABELS
+        platform = sys.platform.lower()
+        # same text column as VideoInferenceIterator expects
+        self.data_idx = 78 if "win" in platform else 72
+
+    def message(self, timestamp):
+        """Build one VA JSON metadata message."""
+        objects = []
+        for i in range(self.objects):
+            x = random.randint(0, 8000)
+            y = random.randint(0, 8000)
+            objects.append({
+                "id": str(i),
+                "display_name": random.choice(self.labels),
+                "confidence": random.randint(40, 99),
+                "position": {
+                    "x": x,
+                    "y": y,
+                    "width": random.randint(100, 10000 - x),
+                    "height": random.randint(100, 10000 - y),
+                },
+            })
+        if not objects:
+            return '{ "timestamp": %d }' % timestamp
+        return '{ "timestamp": %d, "objects":[%s] }' % (
+            timestamp, ",".join(json.dumps(o, separators=(",", ":")) for o in objects))
+
+    def dump_lines(self, message):
+        """Format a message like the fakesink hex dump of an RTP buffer."""
+        data = b"." * RTP_HEADER_SIZE + message.encode("ascii")
+        lines = []
+        for offset in range(0, len(data), DUMP_BYTES_PER_LINE):
+            chunk = data[offset:offset + DUMP_BYTES_PER_LINE]
+            hex_bytes = " ".join("%02x" % b for b in chunk)
+            head = "%08x (0x%08x): %s" % (offset, id(data) & 0xFFFFFFFF, hex_bytes)
+            lines.append(head.ljust(self.data_idx) + chunk.decode("ascii"))
+        return lines
+
+    def run(self, out=None, count=None):
+        """Write dump lines to `out` at `fps` until `count` messages are sent."""
+        out = out or sys.stdout
+        period = 1.0 / self.fps if self.fps else 0
+        next_time = time.time()
+        sent = 0
+        while count is None or sent < count:
+            timestamp = int(time.time() * 1000)
+            out.write("\n".join(self.dump_lines(self.message(timestamp))) + "\n")
+            out.flush()
+            sent += 1
+            next_time += period
+            delay = next_time - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+
+class SyntheticFrameSource():
+    """
+    This is a synthetic raw video source.
+
+    It writes raw BGR frames the way the `VideoFrameIterator` gstreamer
+    pipeline does. Each frame is filled with its index modulo 256 and its
+    first 8 bytes hold the capture time in milliseconds, little endian, so
+    a reader can check which frame it got.
+
+    Attributes
+    ----------
+    width : int
+        Frame width.
+    height : int
+        Frame height.
+    fps : float
+        Frames per second.
+
+    """
+
+    def __init__(self, width=640, height=360, fps=30.0):
+        self.width = width
+        self.height = height
+        self.fps = fps
+
+    def frame(self, index, timestamp):
+        """Build one raw BGR frame."""
+        size = self.width * self.height * 3
+        return struct.pack("<Q", timestamp) + bytes([index % 256]) * (size - 8)
+
+    def run(self, out=None, count=None):
+        """Write frames to `out` at `fps` until `count` frames are sent."""
+        out = out or sys.stdout.buffer
+        period = 1.0 / self.fps if self.fps else 0
+        next_time = time.time()
+        sent = 0
+        while count is None or sent < count:
+            out.write(self.frame(sent, int(time.time() * 1000)))
+            out.flush()
+            sent += 1
+            next_time += period
+            delay = next_time - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+
+class SyntheticTsSource():
+    """
+    This is a synthetic MPEG-TS source.
+
+    It writes 188 byte MPEG-TS packets the way the `ClipRecorder`
+    gstreamer pipeline does. Every keyframe is preceded by a PAT and a PMT
+    and its first packet has the random access indicator set. The video
+    packets (PID 0x100) payload starts with the packet index, big endian,
+    so a reader can check a clip is contiguous.
+
+    Attributes
+    ----------
+    bitrate : int
+        Bits per second.
+    keyframe_interval : float
+        Seconds between two keyframes.
+
+    """
+
+    def __init__(self, bitrate=2000000, keyframe_interval=1.0):
+        self.bitrate = bitrate
+        self.keyframe_interval = keyframe_interval
+
+    # program 1 mapped to PID 0x1000, CRC not computed
+    PAT = (bytes([0x47, 0x40, 0x00, 0x10, 0x00,
+                  0x00, 0xB0, 0x0D, 0x00, 0x01, 0xC1, 0x00, 0x00,
+                  0x00, 0x01, 0xF0, 0x00,
+                  0x00, 0x00, 0x00, 0x00]))
+    PAT += b"\xff" * (188 - len(PAT))
+    # H.264 stream on PID 0x100, also the PCR PID
+    PMT = (bytes([0x47, 0x50, 0x00, 0x10, 0x00,
+                  0x02, 0xB0, 0x12, 0x00, 0x01, 0xC1, 0x00, 0x00,
+                  0xE1, 0x00, 0xF0, 0x00,
+                  0x1B, 0xE1, 0x00, 0xF0, 0x00,
+                  0x00, 0x00, 0x00, 0x00]))
+    PMT += b"\xff" * (188 - len(PMT))
+
+    def packet(self, index, keyframe):
+        """Build one MPEG-TS packet."""
+        if keyframe:
+            # adaptation field of 1 byte with the random access indicator
+            header = bytes([0x47, 0x01, 0x00, 0x30, 0x01, 0x40])
+        else:
+            header = bytes([0x47, 0x01, 0x00, 0x10])
+        payload = struct.pack(">I", index)
+        return header + payload + b"\xff" * (188 - len(header) - len(payload))
+
+    def run(self, out=None, seconds=None):
+        """Write packets to `out` at `bitrate` for `seconds`."""
+        out = out or sys.stdout.buffer
+        per_tick = max(int(self.bitrate / 8 / 188 / 100), 1)
+        start = time.time()
+        next_keyframe = start
+        index = 0
+        while seconds is None or time.time() - start < seconds:
+            packets = []
+            for _ in range(per_tick):
+                keyframe = time.time() >= next_keyframe
+                if keyframe:
+                    next_keyframe += self.keyframe_interval
+                    packets.extend((self.PAT, self.PMT))
+                packets.append(self.packet(index, keyframe))
+                index += 1
+            out.write(b"".join(packets))
+            out.flush()
+            time.sleep(0.01)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest="command")
+    serve = commands.add_parser("serve", help="run the fake IPC webserver")
+    serve.add_argument('--host', help='address to listen on', default='127.0.0.1')
+    serve.add_argument('--port', help='port to listen on', type=int, default=1080)
+    serve.add_argument('--username', help='username of the camera', default='admin')
+    serve.add_argument('--password', help='password of the camera', default='admin')
+    serve.add_argument('--latency', help='seconds added to every response',
+                       type=float, default=0.0)
+    serve.add_argument('--jitter', help='max random seconds added to the latency',
+                       type=float, default=0.0)
+    serve.add_argument('--failure-rate', help='probability of an HTTP 500 response',
+                       type=float, default=0.0)
+    serve.add_argument('--transition-time', help='seconds before /async notifications',
+                       type=float, default=0.0)
+    va = commands.add_parser("va", help="print synthetic VA metadata")
+    va.add_argument('--url', help='VA url, ignored', default=VAM_URL)
+    va.add_argument('--fps', help='metadata messages per second', type=float, default=30.0)
+    va.add_argument('--objects', help='objects per message', type=int, default=3)
+    va.add_argument('--count', help='messages to send, default forever', type=int)
+    frames = commands.add_parser("frames", help="write synthetic raw BGR frames")
+    frames.add_argument('--url', help='preview url, ignored', default=PREVIEW_URL)
+    frames.add_argument('--width', help='frame width', type=int, default=640)
+    frames.add_argument('--height', help='frame height', type=int, default=360)
+    frames.add_argument('--fps', help='frames per second, 0 for the default',
+                        type=float, default=0)
+    frames.add_argument('--count', help='frames to send, default forever', type=int)
+    ts = commands.add_parser("ts", help="write a synthetic MPEG-TS stream")
+    ts.add_argument('--url', help='preview url, ignored', default=PREVIEW_URL)
+    ts.add_argument('--bitrate', help='bits per second', type=int, default=2000000)
+    ts.add_argument('--keyframe-interval', help='seconds between keyframes',
+                    type=float, default=1.0)
+    ts.add_argument('--seconds', help='seconds to run, default forever', type=float)
+    args = parser.parse_args()
+
+    if args.command == "ts":
+        try:
+            SyntheticTsSource(args.bitrate, args.keyframe_interval).run(
+                seconds=args.seconds)
+        except (KeyboardInterrupt, BrokenPipeError):
+            pass
+        return
+
+    if args.command == "frames":
+        try:
+            SyntheticFrameSource(args.width, args.height, args.fps or 30.0).run(
+                count=args.count)
+        except (KeyboardInterrupt, BrokenPipeError):
+            pass
+        return
+
+    if args.command == "va":
+        try:
+            SyntheticVamSource(args.fps, args.objects).run(count=args.count)
+        except (KeyboardInterrupt, BrokenPipeError):
+            pass
+        return
+
+    if args.command is None:
+        args = parser.parse_args(["serve"] + sys.argv[1:])
+    server = FakeIpcWebserver(args.host, args.port,
+                              FakeCamera(args.username, args.password),
+                              latency=args.latency, jitter=args.jitter,
+                              failure_rate=args.failure_rate,
+                              transition_time=args.transition_time)
+    print("Fake IPC webserver listening on %s:%s" % (args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Stopping")
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
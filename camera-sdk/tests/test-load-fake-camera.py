@@ -0,0 +1,95 @@
+# Copyright (c) 2018-2019, The Linux Foundation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials provided
+#      with the distribution.
+#    * Neither the name of The Linux Foundation nor the names of its
+#      contributors may be used to endorse or promote products derived
+#      from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NON-INFRINGEMENT
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.append('../iotccsdk')
+from iotccsdk.camera import CameraClient
+from fake_ipc_webserver import FakeIpcWebserver
+
+VA_SOURCE_CMD = '"%s" "%s" va --url {url} --fps %s --objects %s'
+
+
+def main(protocol=None):
+    print("\nPython %s\n" % sys.version)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ip', help='address of the fake camera', default='127.0.0.1')
+    parser.add_argument('--calls', help='control calls to make', type=int, default=200)
+    parser.add_argument('--latency', help='fake webserver latency in seconds',
+                        type=float, default=0.0)
+    parser.add_argument('--failure-rate', help='fake webserver failure rate',
+                        type=float, default=0.0)
+    parser.add_argument('--fps', help='synthetic VA fps', type=float, default=30.0)
+    parser.add_argument('--objects', help='synthetic objects per frame', type=int, default=5)
+    parser.add_argument('--seconds', help='seconds to read inferences', type=float, default=10.0)
+    args = parser.parse_args()
+
+    server = FakeIpcWebserver(args.ip, latency=args.latency,
+                              failure_rate=args.failure_rate).start()
+    source_cmd = VA_SOURCE_CMD % (
+        sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                     'fake_ipc_webserver.py'),
+        args.fps, args.objects)
+    try:
+        with CameraClient.connect(ip_address=args.ip, username='admin',
+                                  password='admin') as camera_client:
+            camera_client.set_preview_state("on")
+            camera_client.set_analytics_state("on")
+
+            failures = 0
+            start = time.time()
+            for i in range(args.calls):
+                try:
+                    camera_client.set_overlay_state("on" if i % 2 else "off")
+                except Exception:
+                    failures += 1
+            elapsed = time.time() - start
+            print("control calls: %d in %.2fs (%.1f/s), %d failed" %
+                  (args.calls, elapsed, args.calls / elapsed, failures))
+
+            frames = 0
+            objects = 0
+            start = time.time()
+            with camera_client.get_inferences(source_cmd=source_cmd) as results:
+                for result in results:
+                    frames += 1
+                    objects += len(result.objects or [])
+                    if time.time() - start > args.seconds:
+                        break
+            elapsed = time.time() - start
+            print("inferences: %d frames, %d objects in %.2fs (%.1f fps)" %
+                  (frames, objects, elapsed, frames / elapsed))
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -8,7 +8,78 @@ SETTING_OFF = "off"
 
 TURN_CAMERA_ON_METHOD_NAME = "StartCamera"
 TURN_CAMERA_OFF_METHOD_NAME = "StopCamera"
+GET_STATS_METHOD_NAME = "GetStats"
+RESET_STATS_METHOD_NAME = "ResetStats"
 
 TO_UPSTREAM_MESSAGE_QUEUE_NAME = "ToUpstream"
 
 MINIMUM_MESSAGE_DELAY_IN_SECONDS = 6
+
+# detections are admitted through a token bucket per label, or per label and
+# track id; labels without a limit of their own get one message per message delay
+RATE_LIMIT_KEY_LABEL = "label"
+RATE_LIMIT_KEY_TRACK = "track"
+MAX_RATE_LIMIT_BUCKETS = 1024
+
+# maximum time to wait for the camera to report a preview/analytics transition
+STATE_CHANGE_TIMEOUT_IN_SECONDS = 5
+
+# the session token is kept in the container filesystem, which survives
+# module restarts, so a restarted module can skip the camera login; the
+# Dockerfiles make /app writable for moduleuser
+IPC_SESSION_FILE = "/app/ipc_session.json"
+
+# detections are packed into a single upstream message until either limit is hit;
+# IoT Hub meters device-to-cloud messages in 4 KB blocks and caps them at 256 KB
+DEFAULT_BATCH_SIZE_IN_BYTES = 4096
+HUB_MESSAGE_SIZE_LIMIT_IN_BYTES = 256 * 1024
+BATCH_FLUSH_INTERVAL_IN_SECONDS = 1.0
+
+# a batch body is a JSON array, newline-delimited JSON objects, or the
+# binary layout in inference_codec.py
+BATCH_FORMAT_JSON = "json"
+BATCH_FORMAT_JSON_LINES = "jsonl"
+BATCH_FORMAT_BINARY = "binary"
+
+# application property carrying the number of detections in a batched message
+BATCH_COUNT_PROPERTY = "batchCount"
+BATCH_FORMAT_PROPERTY = "batchFormat"
+SCHEMA_VERSION_PROPERTY = "schemaVersion"
+
+# with compression enabled, upstream payloads at or above the threshold are
+# compressed; the encoding is carried in the contentEncoding application
+# property so consumers can undo it. Off by default: hub consumers and
+# body-based routes must decode it first
+ENCODING_GZIP = "gzip"
+ENCODING_DEFLATE = "deflate"
+ENCODING_NONE = "none"
+COMPRESSION_LEVEL = 6
+COMPRESSION_THRESHOLD_IN_BYTES = 512
+CONTENT_ENCODING_PROPERTY = "contentEncoding"
+ORIGINAL_SIZE_PROPERTY = "originalSize"
+
+# undelivered upstream messages are kept in the container filesystem, which
+# survives module restarts, and replayed in order once IoT Hub is reachable;
+# the Dockerfiles create it for moduleuser
+OUTBOX_DIRECTORY = "/app/outbox"
+OUTBOX_SEGMENT_SIZE_IN_BYTES = 1024 * 1024
+OUTBOX_MAX_SIZE_IN_BYTES = 64 * 1024 * 1024
+OUTBOX_DRAIN_RATE_PER_SECOND = 5
+OUTBOX_MAX_RETRY_DELAY_IN_SECONDS = 60
+
+# detections wait in a bounded queue for the send worker; when it is full the
+# policy drops the oldest, blocks the inference loop or spills to the outbox
+SEND_QUEUE_CAPACITY = 1000
+SEND_POLICY_DROP = "drop"
+SEND_POLICY_BLOCK = "block"
+SEND_POLICY_SPILL = "spill"
+
+# in summary mode one message per window replaces the per-detection messages
+TELEMETRY_MODE_DETECTIONS = "detections"
+TELEMETRY_MODE_SUMMARY = "summary"
+SUMMARY_INTERVAL_IN_SECONDS = 60
+MINIMUM_SUMMARY_INTERVAL_IN_SECONDS = 1
+SUMMARY_MESSAGE_TYPE = "summary"
+
+# latency percentiles reported by the GetStats method
+STATS_PERCENTILES = (50, 90, 99)
@@ -0,0 +1,121 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE file in the project root for
+# full license information.
+
+import struct
+
+# Layout of a binary inference batch, all little endian:
+#
+#   header   magic "IV", schema version, flags, detection count
+#   labels   label count, then per label its utf-8 length and bytes
+#   records  one fixed size record per detection, referring to its label
+#            by index into the table above
+#
+# Bump SCHEMA_VERSION whenever the layout changes so decoders can refuse
+# messages they do not understand.
+MAGIC = b"IV"
+SCHEMA_VERSION = 1
+HEADER = struct.Struct("<2sBBH")
+LABEL_COUNT = struct.Struct("<B")
+LABEL_LENGTH = struct.Struct("<B")
+# id, label index, confidence in hundredths of a percent, x, y, width, height
+RECORD = struct.Struct("<IBHffff")
+
+MAX_LABELS = 255
+MAX_LABEL_LENGTH = 255
+MAX_DETECTIONS = 0xFFFF
+MAX_CONFIDENCE = 0xFFFF
+
+CONTENT_TYPE = "application/vnd.inference-batch"
+
+
+def encode_label(label):
+    """
+        UTF-8 bytes of a label as stored in the label table, cut to
+        MAX_LABEL_LENGTH bytes without splitting a character
+    """
+    encoded = label.encode("utf-8")
+    if len(encoded) > MAX_LABEL_LENGTH:
+        encoded = encoded[:MAX_LABEL_LENGTH].decode("utf-8", "ignore").encode("utf-8")
+    return encoded
+
+
+def label_size(label):
+    """
+        Bytes a label adds to the label table
+    """
+    return LABEL_LENGTH.size + len(encode_label(label))
+
+
+def batch_size(label_table_size, count):
+    """
+        Bytes of a batch with `count` records and the given label table size
+    """
+    return HEADER.size + LABEL_COUNT.size + label_table_size + count * RECORD.size
+
+
+def encode_inferences(inferences):
+    """
+        Packs objects with the `Inference` fields (id, label, confidence,
+        position_x, position_y, width, height) into one binary batch
+    """
+    if len(inferences) > MAX_DETECTIONS:
+        raise ValueError("At most %d detections fit in a batch" % MAX_DETECTIONS)
+    labels = {}
+    records = []
+    for inference in inferences:
+        index = labels.get(inference.label)
+        if index is None:
+            if len(labels) == MAX_LABELS:
+                raise ValueError("At most %d labels fit in a batch" % MAX_LABELS)
+            index = labels[inference.label] = len(labels)
+        confidence = min(MAX_CONFIDENCE, max(0, int(round(inference.confidence * 100))))
+        records.append(RECORD.pack(
+            int(inference.id) & 0xFFFFFFFF, index, confidence,
+            inference.position_x, inference.position_y,
+            inference.width, inference.height))
+
+    parts = [HEADER.pack(MAGIC, SCHEMA_VERSION, 0, len(records)),
+             LABEL_COUNT.pack(len(labels))]
+    for label in labels:
+        encoded = encode_label(label)
+        parts.append(LABEL_LENGTH.pack(len(encoded)))
+        parts.append(encoded)
+    parts.extend(records)
+    return b"".join(parts)
+
+
+def decode_inferences(data):
+    """
+        Unpacks a binary batch into a list of dicts with the same keys as
+        `Inference.to_json`
+    """
+    data = memoryview(data)
+    magic, version, _, count = HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ValueError("Not an inference batch")
+    if version != SCHEMA_VERSION:
+        raise ValueError("Unsupported inference batch schema version %d" % version)
+    offset = HEADER.size
+    label_count, = LABEL_COUNT.unpack_from(data, offset)
+    offset += LABEL_COUNT.size
+    labels = []
+    for _ in range(label_count):
+        length, = LABEL_LENGTH.unpack_from(data, offset)
+        offset += LABEL_LENGTH.size
+        labels.append(bytes(data[offset:offset + length]).decode("utf-8"))
+        offset += length
+    inferences = []
+    for _ in range(count):
+        id, index, confidence, x, y, width, height = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        inferences.append({
+            "id": id,
+            "label": labels[index],
+            "confidence": confidence / 100,
+            "position_x": x,
+            "position_y": y,
+            "width": width,
+            "height": height
+        })
+    return inferences
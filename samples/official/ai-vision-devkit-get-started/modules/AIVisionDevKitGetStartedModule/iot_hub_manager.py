@@ -2,11 +2,31 @@ from . constants import SETTING_OFF, \
     SETTING_ON, \
     TURN_CAMERA_ON_METHOD_NAME, \
     TURN_CAMERA_OFF_METHOD_NAME, \
-    TO_UPSTREAM_MESSAGE_QUEUE_NAME
+    GET_STATS_METHOD_NAME, \
+    RESET_STATS_METHOD_NAME, \
+    TO_UPSTREAM_MESSAGE_QUEUE_NAME, \
+    BATCH_COUNT_PROPERTY, \
+    BATCH_FORMAT_PROPERTY, \
+    BATCH_FORMAT_BINARY, \
+    SCHEMA_VERSION_PROPERTY, \
+    CONTENT_ENCODING_PROPERTY, \
+    ORIGINAL_SIZE_PROPERTY, \
+    OUTBOX_DIRECTORY
+import json
+import threading
+from collections import Counter
 from iotccsdk import CameraClient
-from iothub_client import IoTHubModuleClient, IoTHubMessage, DeviceMethodReturnValue
+from iothub_client import IoTHubModuleClient, IoTHubMessage, DeviceMethodReturnValue, \
+    IoTHubClientConfirmationResult
 from . properties import Properties
 from . error_utils import log_unknown_exception
+from . message_batcher import MessageBatcher
+from . message_encoding import encode_message
+from . inference_codec import SCHEMA_VERSION
+from . outbox import Outbox, OutboxDrainer
+from . send_pipeline import SendPipeline
+from . summarizer import InferenceSummarizer
+from . stats import PipelineStats, ipc_counters, ipc_latency, process_stats
 
 
 MODULE_TWIN_UPDATE_CONTEXT = 0
@@ -17,12 +37,10 @@ MODULE_TWIN_UPDATE_CONTEXT = 0
 # By default, messages do not expire.
 MESSAGE_TIMEOUT = 10000
 
-# global counters
-send_callbacks = 0
-
 
 class IotHubManager(object):
-    def __init__(self, protocol, camera_client: CameraClient, properties: Properties):
+    def __init__(self, protocol, camera_client: CameraClient, properties: Properties,
+                 outbox_directory=OUTBOX_DIRECTORY):
         print("Creating IoT Hub manager")
         self.client_protocol = protocol
         self.client = IoTHubModuleClient()
@@ -33,6 +51,55 @@ class IotHubManager(object):
         # set the time until a message times out
         self.client.set_option("messageTimeout", MESSAGE_TIMEOUT)
 
+        # messages in flight, keyed by the send context, so a failed send
+        # can be moved to the outbox
+        self.__pending = {}
+        self.__pending_lock = threading.Lock()
+        self.__send_context = 0
+        self.__connected = True
+        # confirmation results by name, counted instead of printed
+        self.confirmations = Counter()
+
+        # messages that could not be delivered are replayed from here; with
+        # no outbox_directory, or one that cannot be opened, they are dropped
+        self.outbox = None
+        self.outbox_drainer = None
+        # messages dropped for want of an outbox
+        self.undelivered = 0
+        if outbox_directory is not None:
+            try:
+                self.outbox = Outbox(outbox_directory)
+            except OSError as ex:
+                log_unknown_exception(
+                    "Cannot open the outbox in %s, undelivered messages will be dropped: %s" % (
+                        outbox_directory, ex))
+        if self.outbox is not None:
+            self.outbox_drainer = OutboxDrainer(
+                self.outbox,
+                self.__send_event,
+                confirmation_timeout=MESSAGE_TIMEOUT / 1000 + 5)
+            self.properties.message_properties.configure_drainer(self.outbox_drainer)
+
+        # detections are packed into one upstream message per batch
+        self.batcher = MessageBatcher(self.__send_batch_to_upstream)
+        self.properties.message_properties.configure_batcher(self.batcher)
+        # what overflows the send queue is packed the same way, into the outbox
+        self.spill_batcher = MessageBatcher(self.__spill_batch_to_outbox)
+        self.properties.message_properties.configure_batcher(self.spill_batcher)
+
+        # serialization and sending happen on the pipeline worker, never on
+        # the inference loop
+        self.send_pipeline = SendPipeline(
+            self.__process_queued_message, spill=self.__spill_to_outbox)
+        self.properties.message_properties.configure_send_pipeline(self.send_pipeline)
+
+        # in summary mode frames are aggregated here instead of sent one by one
+        self.summarizer = InferenceSummarizer(self.queue_message_to_upstream)
+        self.properties.message_properties.configure_summarizer(self.summarizer)
+
+        # frame and detection counters, updated by the inference loop
+        self.stats = PipelineStats()
+
     def subscribe_to_events(self):
         print("Subscribing to method calls")
         self.client.set_module_method_callback(self.__method_callback_handler, 0)
@@ -41,46 +108,260 @@ class IotHubManager(object):
         self.client.set_module_twin_callback(
             self.__module_twin_callback, MODULE_TWIN_UPDATE_CONTEXT)
 
-    # sends a messager to the "ToUpstream" queue to be sent to hub
-    def send_message_to_upstream(self, message):
+    # queues a JSON string, or an object with to_json(), to be sent to hub
+    # in the next batch; serialization is left to the send worker
+    def queue_message_to_upstream(self, message):
+        try:
+            self.send_pipeline.submit(message)
+        except Exception as ex:
+            print("Exception in queue_message_to_upstream: %s" % ex)
+
+    # counters for the upstream path, from the send queue to the confirmations
+    def send_stats(self):
+        return {
+            "queue": self.send_pipeline.stats(),
+            "batches_sent": self.batcher.batches_sent,
+            "messages_batched": self.batcher.messages_sent,
+            "confirmations": dict(self.confirmations),
+            "in_flight": len(self.__pending),
+            "outbox": self.outbox.stats() if self.outbox is not None else None,
+            "outbox_replayed": self.outbox_drainer.replayed if self.outbox is not None else 0,
+            "undelivered": self.undelivered,
+            "summaries_sent": self.summarizer.summaries_sent
+        }
+
+    # snapshot returned by the GetStats method, counted from the last ResetStats
+    def get_stats(self):
+        counters = self.stats.since_reset(self.__stats_counters())
+        window_sec, cpu_sec = self.stats.window()
+        ipc = {
+            "requests": counters.get("ipc_requests", 0),
+            "errors": counters.get("ipc_errors", 0)
+        }
+        ipc.update(ipc_latency(counters))
+        return {
+            "window_sec": round(window_sec, 3),
+            "frames": {
+                "received": counters["frames_received"],
+                "parsed": counters["frames_parsed"],
+                "dropped": counters["frames_dropped"]
+            },
+            "detections": {
+                "received": counters["detections_received"],
+                "filtered": counters["detections_filtered"],
+                "throttled": counters["detections_throttled"],
+                "queued": counters["detections_queued"]
+            },
+            "upstream": {
+                "batches": counters["batches_sent"],
+                "messages": counters["messages_batched"],
+                "summaries": counters["summaries_sent"],
+                "confirmed": counters["confirmed"],
+                "failed": counters["failed"],
+                "queue_dropped": counters["queue_dropped"],
+                "queue_spilled": counters["queue_spilled"],
+                "outbox_appended": counters["outbox_appended"],
+                "outbox_replayed": counters["outbox_replayed"],
+                "undelivered": counters["undelivered"]
+            },
+            "queues": {
+                "send": self.send_pipeline.stats()["queued"],
+                "send_capacity": self.send_pipeline.capacity,
+                "in_flight": len(self.__pending),
+                "outbox": len(self.outbox) if self.outbox is not None else 0
+            },
+            "ipc": ipc,
+            "process": process_stats(window_sec, cpu_sec)
+        }
+
+    def reset_stats(self):
+        self.stats.reset(self.__stats_counters())
+
+    # cumulative totals of the whole pipeline; plain attribute reads so
+    # GetStats stays cheap
+    def __stats_counters(self):
+        queue = self.send_pipeline.stats()
+        confirmed = self.confirmations[str(IoTHubClientConfirmationResult.OK)]
+        counters = self.stats.counters()
+        counters.update({
+            "batches_sent": self.batcher.batches_sent,
+            "messages_batched": self.batcher.messages_sent,
+            "summaries_sent": self.summarizer.summaries_sent,
+            "confirmed": confirmed,
+            "failed": sum(self.confirmations.values()) - confirmed,
+            "queue_dropped": queue["dropped"],
+            "queue_spilled": queue["spilled"],
+            "outbox_appended": self.outbox.appended if self.outbox is not None else 0,
+            "outbox_replayed": self.outbox_drainer.replayed if self.outbox is not None else 0,
+            "undelivered": self.undelivered
+        })
+        counters.update(ipc_counters(getattr(self.camera_client, "ipc_provider", None)))
+        return counters
+
+    # sends any queued messages and stops the batcher and outbox replay
+    def close(self):
+        self.summarizer.stop()
+        self.send_pipeline.stop()
+        self.batcher.stop()
+        self.spill_batcher.stop()
+        if self.outbox is not None:
+            self.outbox_drainer.stop()
+            self.outbox.close()
+
+    def __process_queued_message(self, message):
+        if isinstance(message, str) and self.batcher.body_format == BATCH_FORMAT_BINARY:
+            # summaries and other JSON messages have no binary layout
+            self.send_message_to_upstream(message)
+            return
+        self.batcher.add(message)
+
+    # messages the send queue has no room for are batched and encoded like
+    # the ones sent, then kept in the outbox for replay
+    def __spill_to_outbox(self, message):
+        if self.outbox is None:
+            self.undelivered += 1
+            return
+        try:
+            if isinstance(message, str) and self.spill_batcher.body_format == BATCH_FORMAT_BINARY:
+                self.__store_encoded_in_outbox(message)
+                return
+            self.spill_batcher.add(message)
+        except Exception as ex:
+            print("Exception in __spill_to_outbox: %s" % ex)
+
+    def __send_batch_to_upstream(self, body, count):
+        self.send_message_to_upstream(body, self.__batch_properties(self.batcher, count))
+
+    def __spill_batch_to_outbox(self, body, count):
+        self.__store_encoded_in_outbox(body, self.__batch_properties(self.spill_batcher, count))
+
+    def __batch_properties(self, batcher, count):
+        message_properties = {
+            BATCH_COUNT_PROPERTY: str(count),
+            BATCH_FORMAT_PROPERTY: batcher.body_format}
+        if batcher.body_format == BATCH_FORMAT_BINARY:
+            message_properties[SCHEMA_VERSION_PROPERTY] = str(SCHEMA_VERSION)
+        return message_properties
+
+    # compresses a message when it is larger than the configured threshold;
+    # returns the payload and its properties
+    def __encode(self, message, message_properties):
+        message_props = self.properties.message_properties
+        payload, content_encoding = encode_message(
+            message,
+            message_props.compression,
+            message_props.compression_threshold_bytes)
+        message_properties = dict(message_properties or {})
+        if content_encoding is not None:
+            message_properties[CONTENT_ENCODING_PROPERTY] = content_encoding
+            message_properties[ORIGINAL_SIZE_PROPERTY] = str(
+                len(message.encode("utf-8")) if isinstance(message, str)
+                else len(message))
+        return payload, message_properties
+
+    def __store_encoded_in_outbox(self, message, message_properties=None):
+        try:
+            payload, message_properties = self.__encode(message, message_properties)
+        except Exception as ex:
+            print("Exception in __store_encoded_in_outbox: %s" % ex)
+            return
+        self.__store_in_outbox(payload, message_properties)
+
+    # sends a messager to the "ToUpstream" queue to be sent to hub,
+    # compressing it when it is larger than the configured threshold
+    def send_message_to_upstream(self, message, message_properties=None):
+        try:
+            payload, message_properties = self.__encode(message, message_properties)
+        except Exception as ex:
+            print("Exception in send_message_to_upstream: %s" % ex)
+            return
+
+        # while the hub is unreachable live messages join the outbox behind
+        # the ones already waiting, so they are replayed in order
+        if not self.__connected and self.outbox is not None:
+            self.__store_in_outbox(payload, message_properties)
+            return
+        try:
+            self.__send_event(payload, message_properties)
+        except Exception as ex:
+            print("Exception in send_message_to_upstream: %s" % ex)
+            self.__store_in_outbox(payload, message_properties)
+
+    def __send_event(self, payload, message_properties, on_result=None):
+        message = IoTHubMessage(bytearray(payload))
+        map_properties = message.properties()
+        for key, value in message_properties.items():
+            map_properties.add(key, value)
+        with self.__pending_lock:
+            self.__send_context += 1
+            context = self.__send_context
+            self.__pending[context] = (payload, message_properties, on_result)
         try:
-            message = IoTHubMessage(message)
             self.client.send_event_async(
                 TO_UPSTREAM_MESSAGE_QUEUE_NAME,
                 message,
                 self.__send_confirmation_callback,
-                0)
-            # logging.info("finished sending message...")
+                context)
+        except Exception:
+            with self.__pending_lock:
+                self.__pending.pop(context, None)
+            raise
+
+    def __store_in_outbox(self, payload, message_properties):
+        if self.outbox is None:
+            self.undelivered += 1
+            return
+        try:
+            self.outbox.append(payload, message_properties)
+            self.outbox_drainer.notify()
         except Exception as ex:
-            print("Exception in send_message_to_upstream: %s" % ex)
-            pass
+            print("Exception storing message in outbox: %s" % ex)
 
     # Callback received when the message that we're forwarding is processed.
     def __send_confirmation_callback(self, message, result, user_context):
-        global send_callbacks
-        print("Confirmation[%d] received for message with result = %s" % (
-            user_context, result))
-        map_properties = message.properties()
-        key_value_pair = map_properties.get_internals()
-        print("\tProperties: %s" % key_value_pair)
-        send_callbacks += 1
-        print("\tTotal calls confirmed: %d" % send_callbacks)
+        is_sent = result == IoTHubClientConfirmationResult.OK
+        self.confirmations[str(result)] += 1
+        if not is_sent:
+            print("Confirmation[%d] received for message with result = %s" % (
+                user_context, result))
+        self.__connected = is_sent
+        with self.__pending_lock:
+            pending = self.__pending.pop(user_context, None)
+        if pending is None:
+            return
+        payload, message_properties, on_result = pending
+        if on_result is not None:
+            # replayed from the outbox, which keeps it until it is confirmed
+            on_result(is_sent)
+        elif not is_sent:
+            self.__store_in_outbox(payload, message_properties)
 
     def __method_callback_handler(self, method_name, payload, user_context):
         """
         Private method to handle the callbacks from the IoT Hub by calling the
         callback matching `method_name`
         """
-        retval = {
+        callback = {
             TURN_CAMERA_ON_METHOD_NAME:
                 lambda payload, user_context: self.__turn_camera_on_callback(
                     payload, user_context),
             TURN_CAMERA_OFF_METHOD_NAME:
                 lambda payload, user_context: self.__turn_camera_off_callback(
+                    payload, user_context),
+            GET_STATS_METHOD_NAME:
+                lambda payload, user_context: self.__get_stats_callback(
+                    payload, user_context),
+            RESET_STATS_METHOD_NAME:
+                lambda payload, user_context: self.__reset_stats_callback(
                     payload, user_context)
-        }[method_name](payload, user_context)
+        }.get(method_name)
 
-        return retval
+        if callback is None:
+            retval = DeviceMethodReturnValue()
+            retval.status = 404
+            retval.response = json.dumps({"Response": "Unknown method %s" % method_name})
+            return retval
+        return callback(payload, user_context)
 
     def __turn_camera_on_callback(self, payload, user_context):
         retval = DeviceMethodReturnValue()
@@ -109,6 +390,29 @@ class IotHubManager(object):
             retval.response = "{\"Response\":\"Failed to stop camera\"}"
             return retval
 
+    def __get_stats_callback(self, payload, user_context):
+        retval = DeviceMethodReturnValue()
+        try:
+            retval.status = 200
+            retval.response = json.dumps(self.get_stats())
+            return retval
+        except Exception as ex:
+            retval.status = 500
+            retval.response = json.dumps({"Response": "Failed to get stats: %s" % ex})
+            return retval
+
+    def __reset_stats_callback(self, payload, user_context):
+        retval = DeviceMethodReturnValue()
+        try:
+            self.reset_stats()
+            retval.status = 200
+            retval.response = "{\"Response\":\"Successfully reset stats\"}"
+            return retval
+        except Exception as ex:
+            retval.status = 500
+            retval.response = json.dumps({"Response": "Failed to reset stats: %s" % ex})
+            return retval
+
     def __module_twin_callback(self, update_state, payload, user_context):
         print("Received twin callback")
         self.properties.handle_twin_update(payload)
@@ -124,6 +428,12 @@ class IotHubManager(object):
         try:
             is_model_changed = model_props.update_inference_model()
             camera_props.configure_camera_client(self.camera_client, is_model_changed)
+            self.properties.message_properties.configure_batcher(self.batcher)
+            self.properties.message_properties.configure_batcher(self.spill_batcher)
+            if self.outbox_drainer is not None:
+                self.properties.message_properties.configure_drainer(self.outbox_drainer)
+            self.properties.message_properties.configure_send_pipeline(self.send_pipeline)
+            self.properties.message_properties.configure_summarizer(self.summarizer)
             self.properties.report_properties_to_hub(self)
         except Exception as ex:
             log_unknown_exception(
@@ -12,7 +12,7 @@ if __package__ == '' or __package__ is None:  # noqa
     __import__(pkg_name)
     __package__ = str(pkg_name)
     del os
-from . constants import SETTING_OFF
+from . constants import SETTING_OFF, IPC_SESSION_FILE
 from . error_utils import CameraClientError, log_unknown_exception
 from . properties import Properties
 from . model_utility import ModelUtility
@@ -20,7 +20,6 @@ from . inference import Inference
 from . iot_hub_manager import IotHubManager
 from iotccsdk import CameraClient
 from iothub_client import IoTHubTransportProvider, IoTHubError
-import time
 
 # Choose HTTP, AMQP or MQTT as transport protocol.  Currently only MQTT is supported.
 IOT_HUB_PROTOCOL = IoTHubTransportProvider.MQTT
@@ -42,7 +41,8 @@ def create_camera(ip_address=None, username="admin", password="admin"):
         return CameraClient.connect(
             ip_address=ip_address,
             username=username,
-            password=password)
+            password=password,
+            session_file=IPC_SESSION_FILE)
 
     print("Create camera with ipc_provider %s" % ipc_provider)
     return CameraClient.connect(
@@ -52,23 +52,44 @@ def create_camera(ip_address=None, username="admin", password="admin"):
         password=password)
 
 
-def print_inference(result=None, hub_manager=None, last_sent_time=time.time()):
+def print_inference(result=None, hub_manager=None):
     global properties
-    if (time.time() - last_sent_time <= properties.model_properties.message_delay_sec
-            or result is None
-            or result.objects is None
-            or len(result.objects) == 0):
-        return last_sent_time
+    if result is None:
+        return
+
+    stats = hub_manager.stats
+    stats.frames_received += 1
+    if result.objects is None:
+        # the VA metadata of this frame could not be parsed
+        stats.frames_dropped += 1
+    else:
+        stats.frames_parsed += 1
+        stats.detections_received += len(result.objects)
+
+    model_props = properties.model_properties
+    summarizer = hub_manager.summarizer
+    if properties.message_properties.is_summary_mode:
+        # empty frames count too, they lower the occupancy
+        summarizer.add_frame(result.objects, model_props.is_object_of_interest)
+        return
+    if summarizer.pending_frames:
+        # the mode was switched back, send what was aggregated so far
+        summarizer.flush()
+
+    if result.objects is None or len(result.objects) == 0:
+        return
 
     for inf_obj in result.objects:
-        print("Found result object")
         inference = Inference(inf_obj)
-        if (properties.model_properties.is_object_of_interest(inference.label)):
-            json_message = inference.to_json()
-            iot_hub_manager.send_message_to_upstream(json_message)
-            print(json_message)
-            last_sent_time = time.time()
-    return last_sent_time
+        if not model_props.is_object_of_interest(inference.label):
+            stats.detections_filtered += 1
+        # each label (or track) is throttled by its own token bucket
+        elif not model_props.is_message_allowed(inference):
+            stats.detections_throttled += 1
+        else:
+            # serialized and sent by the hub manager's send worker
+            hub_manager.queue_message_to_upstream(inference)
+            stats.detections_queued += 1
 
 
 def main(protocol):
@@ -89,7 +110,6 @@ def main(protocol):
     model_util.transfer_dlc(False)
 
     print("\nPython %s\n" % sys.version)
-    last_time = time.time()
 
     while True:
         with create_camera() as camera_client:
@@ -105,8 +125,7 @@ def main(protocol):
                         while camera_client.vam_running:
                             with camera_client.get_inferences() as results:
                                 for result in results:
-                                    last_time = print_inference(
-                                        result, iot_hub_manager, last_time)
+                                    print_inference(result, iot_hub_manager)
                     except EOFError:
                         print("EOFError. Current VAM running state is %s." %
                               camera_client.vam_running)
@@ -129,6 +148,9 @@ def main(protocol):
                 return
             finally:
                 print("Try to clean up before the end")
+                if iot_hub_manager is not None:
+                    iot_hub_manager.close()
+                    iot_hub_manager = None
                 if camera_client is not None:
                     camera_client.set_overlay_state(SETTING_OFF)
                     camera_client.set_analytics_state(SETTING_OFF)
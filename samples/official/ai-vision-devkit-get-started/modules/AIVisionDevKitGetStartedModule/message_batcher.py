@@ -0,0 +1,204 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE file in the project root for
+# full license information.
+
+import threading
+import time
+from . constants import DEFAULT_BATCH_SIZE_IN_BYTES, \
+    HUB_MESSAGE_SIZE_LIMIT_IN_BYTES, \
+    BATCH_FLUSH_INTERVAL_IN_SECONDS, \
+    BATCH_FORMAT_JSON, \
+    BATCH_FORMAT_JSON_LINES, \
+    BATCH_FORMAT_BINARY
+from . inference_codec import encode_inferences, \
+    label_size, \
+    batch_size, \
+    MAX_LABELS, \
+    MAX_DETECTIONS
+
+BATCH_FORMATS = (BATCH_FORMAT_JSON, BATCH_FORMAT_JSON_LINES, BATCH_FORMAT_BINARY)
+
+
+class MessageBatcher(object):
+    """
+        Packs messages into one body until the byte limit or the flush
+        interval is reached, then hands the body to `send(body, count)`.
+        JSON formats take JSON strings or objects with to_json(); the
+        binary format takes `Inference` objects.
+    """
+
+    def __init__(self, send,
+                 max_size=DEFAULT_BATCH_SIZE_IN_BYTES,
+                 flush_interval=BATCH_FLUSH_INTERVAL_IN_SECONDS,
+                 body_format=BATCH_FORMAT_JSON):
+        self.__send = send
+        self.__condition = threading.Condition()
+        # serializes take-and-send so batches go upstream in order
+        self.__flush_lock = threading.Lock()
+        self.__items = []
+        self.__size = 0
+        # labels of the pending binary batch, for its label table
+        self.__labels = set()
+        self.__label_table_size = 0
+        self.__oldest = None
+        self.__running = True
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self.body_format = body_format
+        self.batches_sent = 0
+        self.messages_sent = 0
+        self.__thread = threading.Thread(
+            target=self.__flush_loop, name="message-batcher", daemon=True)
+        self.__thread.start()
+
+    def configure(self, max_size=None, flush_interval=None, body_format=None):
+        if body_format is not None and body_format not in BATCH_FORMATS:
+            raise ValueError("Unknown batch format %s" % body_format)
+        with self.__flush_lock:
+            pending = None
+            with self.__condition:
+                if body_format is not None and body_format != self.body_format:
+                    # pending items were packed for the old format; taken
+                    # in the same step as the switch so add() cannot slip
+                    # an old format item in between
+                    pending = self.__take_pending()
+                    self.body_format = body_format
+                if max_size is not None:
+                    self.max_size = max(1, min(int(max_size), HUB_MESSAGE_SIZE_LIMIT_IN_BYTES))
+                if flush_interval is not None:
+                    self.flush_interval = max(0.0, float(flush_interval))
+                self.__condition.notify()
+            if pending is not None:
+                self.__send_pending(*pending)
+
+    def add(self, message):
+        """
+            Queues a message. Flushes first when the message would push
+            the pending body past `max_size`
+        """
+        while True:
+            # converted outside the lock, then checked against the format
+            # again in case configure() switched it meanwhile
+            body_format = self.body_format
+            item = self.__convert(message, body_format)
+            with self.__condition:
+                if not self.__running:
+                    raise RuntimeError("MessageBatcher is stopped")
+                if self.body_format != body_format:
+                    continue
+                if not self.__items or self.__fits(item):
+                    self.__append(item)
+                    full = self.__size >= self.max_size
+                    break
+            # send what is pending to make room, then try again
+            self.flush()
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self.__flush_lock:
+            return self.__flush_pending()
+
+    def stop(self):
+        with self.__condition:
+            self.__running = False
+            self.__condition.notify()
+        self.__thread.join()
+        self.flush()
+
+    @staticmethod
+    def __convert(message, body_format):
+        if body_format == BATCH_FORMAT_BINARY:
+            if isinstance(message, (str, bytes)):
+                raise ValueError("The binary batch format takes Inference objects")
+            return message
+        if not isinstance(message, (str, bytes)):
+            message = message.to_json()
+        if isinstance(message, str):
+            message = message.encode("utf-8")
+        return message
+
+    # called with the flush lock held
+    def __flush_pending(self):
+        with self.__condition:
+            pending = self.__take_pending()
+        return self.__send_pending(*pending)
+
+    # called with the condition held
+    def __take_pending(self):
+        items = self.__items
+        self.__items = []
+        self.__size = 0
+        self.__labels = set()
+        self.__label_table_size = 0
+        self.__oldest = None
+        return items, self.body_format
+
+    # called with the flush lock held
+    def __send_pending(self, items, body_format):
+        if not items:
+            return 0
+        try:
+            if body_format == BATCH_FORMAT_BINARY:
+                body = encode_inferences(items)
+            elif body_format == BATCH_FORMAT_JSON_LINES:
+                body = b"\n".join(items).decode("utf-8")
+            else:
+                body = (b"[" + b",".join(items) + b"]").decode("utf-8")
+            self.__send(body, len(items))
+        except Exception as ex:
+            print("Exception sending batch of %d messages: %s" % (len(items), ex))
+            return 0
+        self.batches_sent += 1
+        self.messages_sent += len(items)
+        return len(items)
+
+    def __fits(self, message):
+        if self.body_format != BATCH_FORMAT_BINARY:
+            return self.__body_size(len(message)) <= self.max_size
+        if len(self.__items) >= MAX_DETECTIONS:
+            return False
+        if message.label in self.__labels:
+            return self.__body_size(0) <= self.max_size
+        return (len(self.__labels) < MAX_LABELS
+                and self.__body_size(label_size(message.label)) <= self.max_size)
+
+    def __append(self, message):
+        if self.body_format == BATCH_FORMAT_BINARY:
+            added = 0
+            if message.label not in self.__labels:
+                self.__labels.add(message.label)
+                added = label_size(message.label)
+            self.__size = self.__body_size(added)
+            self.__label_table_size += added
+        else:
+            self.__size = self.__body_size(len(message))
+        self.__items.append(message)
+        if self.__oldest is None:
+            self.__oldest = time.monotonic()
+            self.__condition.notify()
+
+    # size of the pending body once a message of `length` bytes is added; for
+    # the binary format `length` is what the message adds to the label table
+    def __body_size(self, length):
+        if self.body_format == BATCH_FORMAT_BINARY:
+            return batch_size(self.__label_table_size + length, len(self.__items) + 1)
+        if not self.__items:
+            framing = 2 if self.body_format == BATCH_FORMAT_JSON else 0
+            return framing + length
+        return self.__size + 1 + length
+
+    def __flush_loop(self):
+        while True:
+            with self.__condition:
+                while self.__running:
+                    if self.__oldest is None:
+                        self.__condition.wait()
+                        continue
+                    remaining = self.__oldest + self.flush_interval - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.__condition.wait(remaining)
+                if not self.__running:
+                    return
+            self.flush()
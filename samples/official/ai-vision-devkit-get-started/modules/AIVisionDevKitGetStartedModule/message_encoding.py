@@ -0,0 +1,50 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE file in the project root for
+# full license information.
+
+import zlib
+from . constants import ENCODING_GZIP, \
+    ENCODING_DEFLATE, \
+    ENCODING_NONE, \
+    COMPRESSION_LEVEL
+
+# zlib window bits selecting the gzip container instead of the zlib one
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+SUPPORTED_ENCODINGS = (ENCODING_GZIP, ENCODING_DEFLATE, ENCODING_NONE)
+
+
+def compress(data, encoding):
+    if encoding == ENCODING_GZIP:
+        # compressobj rather than gzip.compress keeps the header free of a
+        # timestamp, so equal payloads compress to equal bytes
+        compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, GZIP_WBITS)
+        return compressor.compress(data) + compressor.flush()
+    if encoding == ENCODING_DEFLATE:
+        return zlib.compress(data, COMPRESSION_LEVEL)
+    raise ValueError("Unsupported content encoding %s" % encoding)
+
+
+def decompress(data, encoding):
+    if encoding == ENCODING_GZIP:
+        return zlib.decompress(bytes(data), GZIP_WBITS)
+    if encoding == ENCODING_DEFLATE:
+        return zlib.decompress(bytes(data))
+    if encoding in (None, "", ENCODING_NONE):
+        return bytes(data)
+    raise ValueError("Unsupported content encoding %s" % encoding)
+
+
+def encode_message(message, encoding, threshold):
+    """
+        Returns (payload, content_encoding). The payload is only compressed
+        when it is at least `threshold` bytes and compression shrinks it,
+        otherwise content_encoding is None and the payload is unchanged
+    """
+    data = message.encode("utf-8") if isinstance(message, str) else bytes(message)
+    if encoding in (None, ENCODING_NONE) or len(data) < threshold:
+        return data, None
+    compressed = compress(data, encoding)
+    if len(compressed) >= len(data):
+        return data, None
+    return compressed, encoding
@@ -0,0 +1,314 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE file in the project root for
+# full license information.
+
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+from . constants import OUTBOX_SEGMENT_SIZE_IN_BYTES, \
+    OUTBOX_MAX_SIZE_IN_BYTES, \
+    OUTBOX_DRAIN_RATE_PER_SECOND, \
+    OUTBOX_MAX_RETRY_DELAY_IN_SECONDS
+
+# payload length, properties length, crc32, sequence number, enqueue time
+RECORD_HEADER = struct.Struct("<IIIQd")
+# first sequence number of the cursor segment, offset in it, next sequence number
+CURSOR = struct.Struct("<QQQ")
+
+SEGMENT_SUFFIX = ".seg"
+CURSOR_FILE = "cursor"
+
+
+class _Segment(object):
+    """
+        A preallocated, memory-mapped file of records named after the
+        sequence number of its first record
+    """
+
+    def __init__(self, directory, first_seq, size=None):
+        self.first_seq = first_seq
+        self.path = os.path.join(directory, "%020d%s" % (first_seq, SEGMENT_SUFFIX))
+        with open(self.path, "w+b" if size else "r+b") as segment_file:
+            if size:
+                segment_file.truncate(size)
+            self.map = mmap.mmap(segment_file.fileno(), 0)
+        self.size = len(self.map)
+        self.end = 0
+        self.next_seq = first_seq
+        if not size:
+            self.__recover()
+
+    def append(self, seq, timestamp, properties, payload):
+        length = RECORD_HEADER.size + len(properties) + len(payload)
+        if self.end + length > self.size:
+            return False
+        body = properties + payload
+        RECORD_HEADER.pack_into(self.map, self.end, len(payload), len(properties),
+                                zlib.crc32(body), seq, timestamp)
+        start = self.end + RECORD_HEADER.size
+        self.map[start:start + len(body)] = body
+        self.end += length
+        self.next_seq = seq + 1
+        return True
+
+    # returns (seq, timestamp, properties, payload, next_offset) or None
+    def read(self, offset):
+        if offset >= self.end:
+            return None
+        length, properties_length, _, seq, timestamp = RECORD_HEADER.unpack_from(
+            self.map, offset)
+        start = offset + RECORD_HEADER.size
+        properties = self.map[start:start + properties_length]
+        payload = self.map[start + properties_length:start + properties_length + length]
+        return seq, timestamp, properties, payload, start + properties_length + length
+
+    def close(self, remove=False):
+        self.map.flush()
+        self.map.close()
+        if remove:
+            os.remove(self.path)
+
+    # walk the records written before a restart; a torn or zeroed record ends the log
+    def __recover(self):
+        offset = 0
+        while offset + RECORD_HEADER.size <= self.size:
+            length, properties_length, crc, seq, _ = RECORD_HEADER.unpack_from(
+                self.map, offset)
+            start = offset + RECORD_HEADER.size
+            end = start + properties_length + length
+            if seq != self.next_seq or end > self.size:
+                break
+            if zlib.crc32(self.map[start:end]) != crc:
+                break
+            offset = end
+            self.next_seq += 1
+        self.end = offset
+
+
+class Outbox(object):
+    """
+        Append-only log of upstream messages kept in memory-mapped segment
+        files. Disk use is bounded by `max_size`; when a new segment would
+        exceed it the oldest segment is dropped, sent or not.
+    """
+
+    def __init__(self, directory,
+                 segment_size=OUTBOX_SEGMENT_SIZE_IN_BYTES,
+                 max_size=OUTBOX_MAX_SIZE_IN_BYTES):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_size = max(max_size, segment_size)
+        self.__lock = threading.Lock()
+        self.appended = 0
+        self.committed = 0
+        self.evicted = 0
+        os.makedirs(directory, exist_ok=True)
+
+        names = sorted(n for n in os.listdir(directory) if n.endswith(SEGMENT_SUFFIX))
+        self.__segments = deque(
+            _Segment(directory, int(n[:-len(SEGMENT_SUFFIX)])) for n in names)
+
+        cursor_path = os.path.join(directory, CURSOR_FILE)
+        with open(cursor_path, "a+b") as cursor_file:
+            if os.path.getsize(cursor_path) < CURSOR.size:
+                cursor_file.truncate(CURSOR.size)
+            self.__cursor_map = mmap.mmap(cursor_file.fileno(), CURSOR.size)
+        segment_seq, offset, seq = CURSOR.unpack_from(self.__cursor_map, 0)
+
+        # segments wholly before the cursor were sent before the restart
+        while len(self.__segments) > 1 and self.__segments[1].first_seq <= seq:
+            self.__segments.popleft().close(remove=True)
+        if self.__segments:
+            self.__next_seq = self.__segments[-1].next_seq
+            first = self.__segments[0]
+            if first.first_seq != segment_seq or offset > first.end:
+                offset, seq = 0, first.first_seq
+        else:
+            # sequence numbers start at 1 so a zeroed header never parses
+            self.__next_seq = max(seq, 1)
+            offset, seq = 0, self.__next_seq
+        self.__cursor_offset = offset
+        self.__cursor_seq = seq
+        self.__write_cursor()
+
+    def __len__(self):
+        with self.__lock:
+            return self.__next_seq - self.__cursor_seq
+
+    def append(self, payload, properties=None):
+        """
+            Stores a message and returns its sequence number
+        """
+        properties = json.dumps(properties or {}).encode("utf-8")
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        with self.__lock:
+            if self.__cursor_map is None:
+                raise RuntimeError("Outbox is closed")
+            seq = self.__next_seq
+            timestamp = time.time()
+            if not self.__segments or not self.__segments[-1].append(
+                    seq, timestamp, properties, payload):
+                record_size = RECORD_HEADER.size + len(properties) + len(payload)
+                self.__add_segment(seq, max(self.segment_size, record_size))
+                self.__segments[-1].append(seq, timestamp, properties, payload)
+            self.__next_seq = seq + 1
+            self.appended += 1
+            return seq
+
+    def peek(self):
+        """
+            Returns the oldest unsent message as (seq, timestamp, payload,
+            properties), or None when the outbox is empty
+        """
+        with self.__lock:
+            record = self.__read_cursor()
+            if record is None:
+                return None
+            seq, timestamp, properties, payload, _ = record
+            return seq, timestamp, payload, json.loads(properties.decode("utf-8"))
+
+    def commit(self, seq):
+        """
+            Marks the message returned by peek as sent
+        """
+        with self.__lock:
+            record = self.__read_cursor()
+            if record is None or record[0] != seq:
+                # the record was evicted while it was being sent
+                return
+            self.__cursor_offset = record[4]
+            self.__cursor_seq = seq + 1
+            self.committed += 1
+            self.__write_cursor()
+
+    def stats(self):
+        with self.__lock:
+            oldest_age = 0
+            record = self.__read_cursor()
+            if record is not None:
+                oldest_age = max(0.0, time.time() - record[1])
+            backlog_bytes = sum(s.end for s in self.__segments) - self.__cursor_offset
+            return {
+                "backlog_messages": self.__next_seq - self.__cursor_seq,
+                "backlog_bytes": backlog_bytes,
+                "oldest_age_sec": round(oldest_age, 3),
+                "disk_bytes": sum(s.size for s in self.__segments),
+                "appended": self.appended,
+                "committed": self.committed,
+                "evicted": self.evicted
+            }
+
+    def close(self):
+        with self.__lock:
+            if self.__cursor_map is None:
+                return
+            for segment in self.__segments:
+                segment.close()
+            self.__segments.clear()
+            self.__cursor_map.flush()
+            self.__cursor_map.close()
+            self.__cursor_map = None
+
+    def __add_segment(self, first_seq, size):
+        disk_bytes = sum(s.size for s in self.__segments)
+        while self.__segments and disk_bytes + size > self.max_size:
+            oldest = self.__segments.popleft()
+            disk_bytes -= oldest.size
+            self.evicted += max(0, oldest.next_seq - max(oldest.first_seq, self.__cursor_seq))
+            oldest.close(remove=True)
+            if self.__segments:
+                self.__cursor_seq = max(self.__cursor_seq, self.__segments[0].first_seq)
+            else:
+                self.__cursor_seq = first_seq
+            self.__cursor_offset = 0
+        self.__segments.append(_Segment(self.directory, first_seq, size))
+        self.__write_cursor()
+
+    def __read_cursor(self):
+        while self.__segments:
+            record = self.__segments[0].read(self.__cursor_offset)
+            if record is not None or len(self.__segments) == 1:
+                return record
+            # a drained segment that is no longer written to can go
+            self.__segments.popleft().close(remove=True)
+            self.__cursor_offset = 0
+            self.__write_cursor()
+        return None
+
+    def __write_cursor(self):
+        segment_seq = self.__segments[0].first_seq if self.__segments else self.__cursor_seq
+        CURSOR.pack_into(self.__cursor_map, 0,
+                         segment_seq, self.__cursor_offset, self.__cursor_seq)
+
+
+class OutboxDrainer(object):
+    """
+        Replays an Outbox in order through `send(payload, properties,
+        on_result)`, at most `drain_rate` messages per second so a backlog
+        does not crowd out live messages. A failed send is retried with an
+        increasing delay.
+    """
+
+    def __init__(self, outbox, send,
+                 drain_rate=OUTBOX_DRAIN_RATE_PER_SECOND,
+                 confirmation_timeout=30):
+        self.outbox = outbox
+        self.drain_rate = drain_rate
+        self.confirmation_timeout = confirmation_timeout
+        self.replayed = 0
+        self.failures = 0
+        self.__send = send
+        self.__wake = threading.Event()
+        self.__stopped = threading.Event()
+        self.__thread = threading.Thread(
+            target=self.__drain_loop, name="outbox-drainer", daemon=True)
+        self.__thread.start()
+
+    def notify(self):
+        self.__wake.set()
+
+    def stop(self):
+        self.__stopped.set()
+        self.__wake.set()
+        self.__thread.join()
+
+    def __drain_loop(self):
+        retry_delay = 1
+        while not self.__stopped.is_set():
+            record = self.outbox.peek()
+            if record is None:
+                self.__wake.wait()
+                self.__wake.clear()
+                continue
+            seq, _, payload, properties = record
+            if self.__send_and_wait(payload, properties):
+                self.outbox.commit(seq)
+                self.replayed += 1
+                retry_delay = 1
+                if self.drain_rate > 0:
+                    self.__stopped.wait(1.0 / self.drain_rate)
+            else:
+                self.failures += 1
+                self.__stopped.wait(retry_delay)
+                retry_delay = min(retry_delay * 2, OUTBOX_MAX_RETRY_DELAY_IN_SECONDS)
+
+    def __send_and_wait(self, payload, properties):
+        done = threading.Event()
+        result = []
+
+        def on_result(is_sent):
+            result.append(is_sent)
+            done.set()
+
+        try:
+            self.__send(payload, properties, on_result)
+        except Exception as ex:
+            print("Exception replaying outbox message: %s" % ex)
+            return False
+        return done.wait(self.confirmation_timeout) and result[0]
@@ -1,17 +1,39 @@
 import json
 import math
-import time
+import threading
 from iotccsdk import CameraClient
 from . error_utils import log_unknown_exception, CameraClientError
 from . model_utility import ModelUtility
 from . constants import SETTING_ON, \
     SETTING_OFF, \
-    MINIMUM_MESSAGE_DELAY_IN_SECONDS
+    MINIMUM_MESSAGE_DELAY_IN_SECONDS, \
+    STATE_CHANGE_TIMEOUT_IN_SECONDS, \
+    DEFAULT_BATCH_SIZE_IN_BYTES, \
+    HUB_MESSAGE_SIZE_LIMIT_IN_BYTES, \
+    BATCH_FLUSH_INTERVAL_IN_SECONDS, \
+    BATCH_FORMAT_JSON, \
+    ENCODING_NONE, \
+    COMPRESSION_THRESHOLD_IN_BYTES, \
+    OUTBOX_DRAIN_RATE_PER_SECOND, \
+    RATE_LIMIT_KEY_LABEL, \
+    RATE_LIMIT_KEY_TRACK, \
+    SEND_QUEUE_CAPACITY, \
+    SEND_POLICY_SPILL, \
+    TELEMETRY_MODE_DETECTIONS, \
+    TELEMETRY_MODE_SUMMARY, \
+    SUMMARY_INTERVAL_IN_SECONDS, \
+    MINIMUM_SUMMARY_INTERVAL_IN_SECONDS
+from . message_encoding import SUPPORTED_ENCODINGS
+from . send_pipeline import SEND_POLICIES
+from . rate_limiter import LabelRateLimiter
+from . message_batcher import BATCH_FORMATS
 
 
 MODEL_ZIP_URL_PROP = "ModelZipUrl"
 MESSAGE_DELAY_SECS_PROP = "TimeBetweenMessagesInSeconds"
 OBJS_OF_INTEREST_PROP = "ObjectsOfInterest"
+LABEL_RATE_LIMITS_PROP = "LabelRateLimits"
+RATE_LIMIT_KEY_PROP = "RateLimitKey"
 OVERLAY_STATE_PROP = "ShowVideoOverlay"
 OVERLAY_CONFIG_PROP = "VideoOverlayConfig"
 BITRATE_PROP = "Bitrate"
@@ -28,6 +50,16 @@ SPTD_BITRATES_PROP = "SupportedBitrates"
 SPTD_FRAME_RATES_PROP = "SupportedFrameRates"
 SPTD_RESOLUTIONS_PROP = "SupportedResolutions"
 SPTD_CONFIG_OVERLAY_PROP = "SupportedConfigOverlayStyles"
+BATCH_SIZE_PROP = "MaxBatchSizeInBytes"
+BATCH_INTERVAL_PROP = "BatchFlushIntervalInSeconds"
+BATCH_FORMAT_PROP = "BatchFormat"
+COMPRESSION_PROP = "MessageCompression"
+COMPRESSION_THRESHOLD_PROP = "CompressionThresholdInBytes"
+OUTBOX_DRAIN_RATE_PROP = "OutboxDrainRatePerSecond"
+SEND_QUEUE_CAPACITY_PROP = "SendQueueCapacity"
+SEND_QUEUE_POLICY_PROP = "SendQueuePolicy"
+TELEMETRY_MODE_PROP = "TelemetryMode"
+SUMMARY_INTERVAL_PROP = "SummaryIntervalInSeconds"
 
 PROPERTY_NAME_MAP = {
     'resolution': RESOLUTION_PROP,
@@ -48,6 +80,10 @@ PROPERTY_NAME_MAP = {
     'supported_config_overlay': SPTD_CONFIG_OVERLAY_PROP
 }
 
+# CameraProperties attributes (fields and properties alike) with the twin
+# names they are reported under, worked out once instead of per report
+CAMERA_REPORTED_SCHEMA = tuple(PROPERTY_NAME_MAP.items())
+
 
 class CameraProperties:
 
@@ -151,6 +187,12 @@ class CameraProperties:
                   self.analytics_state)
             raise CameraClientError(
                 "VAM failed to start in configure_camera_client")
+        # the camera reports the new state asynchronously, wait for it
+        # before reading it back below
+        if not camera_client.wait_for(vam_running=self.analytics_state,
+                                      timeout=STATE_CHANGE_TIMEOUT_IN_SECONDS):
+            print("VAM not %s after %s seconds" %
+                  (self.__analytics_state, STATE_CHANGE_TIMEOUT_IN_SECONDS))
 
         # update properties from the camera
         self.update_camera_properties(camera_client)
@@ -158,9 +200,13 @@ class CameraProperties:
         return True
 
     def get_reported_properties(self):
-        props = list()
-        self.__add_class_fields(props)
-        self.__add_class_properties(props)
+        props = dict()
+        for attribute, reported_name in CAMERA_REPORTED_SCHEMA:
+            value = getattr(self, attribute)
+            if type(value) is list:
+                # format as stringified json
+                value = json.dumps(value)
+            props[reported_name] = value
         return props
 
     def handle_twin_update(self, data):
@@ -192,31 +238,6 @@ class CameraProperties:
         self.__supported_frame_rates = camera_client.framerates
         self.analytics_state = camera_client.vam_running
 
-    # adds public fields to list of property objects as key value pairs
-    def __add_class_fields(self, props):
-        for k, v in self.__dict__.items():
-            # skip private fields
-            if "__" in k:
-                continue
-            if type(v) is list:
-                # format as stringified json
-                v = json.dumps(v)
-            if k in PROPERTY_NAME_MAP:
-                props.append({PROPERTY_NAME_MAP[k]: v})
-            else:
-                props.append({k: v})
-
-    # find all properties in the class and add to list as key value pairs
-    def __add_class_properties(self, props):
-        property_names = [p for p in dir(CameraProperties) if isinstance(
-            getattr(CameraProperties, p), property)]
-        for prop_name in property_names:
-            prop_val = self.__getattribute__(prop_name)
-            if prop_name in PROPERTY_NAME_MAP:
-                props.append({PROPERTY_NAME_MAP[prop_name]: prop_val})
-            else:
-                props.append({prop_name: prop_val})
-
     # turn off preview, overlay and analytics
     def __turn_camera_off(self, camera_client: CameraClient):
         camera_client.set_overlay_state(SETTING_OFF)
@@ -225,8 +246,8 @@ class CameraProperties:
         while camera_client.vam_running and count < 5:
             print("Retrying analytics off: %s" % count)
             camera_client.set_analytics_state(SETTING_OFF)
+            camera_client.wait_for(vam_running=False, timeout=1)
             count += 1
-            time.sleep(1)
 
     def __configure_preview(self, camera_client: CameraClient):
         if (camera_client.cur_resolution == self.resolution
@@ -237,14 +258,14 @@ class CameraProperties:
                 and camera_client.preview_running == self.preview_state):
             return
 
-        count = 0
         print("Turning preview off")
         if not camera_client.set_preview_state(SETTING_OFF):
             raise CameraClientError("Failed to stop preview")
-        while camera_client.preview_running and count < 5:
-            print("Waiting for preview to stop: %s" % count)
-            count += 1
-            time.sleep(1)
+        print("Waiting for preview to stop")
+        if not camera_client.wait_for(preview_running=False,
+                                      timeout=STATE_CHANGE_TIMEOUT_IN_SECONDS):
+            print("Preview still running after %s seconds" %
+                  STATE_CHANGE_TIMEOUT_IN_SECONDS)
 
         print(
             "Configure preview (%s, %s, %s, %s, %s)" %
@@ -266,6 +287,10 @@ class CameraProperties:
             raise CameraClientError(
                 ("failed to set the preview state to %s"
                     % self.__preview_state))
+        if not camera_client.wait_for(preview_running=self.preview_state,
+                                      timeout=STATE_CHANGE_TIMEOUT_IN_SECONDS):
+            print("Preview not %s after %s seconds" %
+                  (self.__preview_state, STATE_CHANGE_TIMEOUT_IN_SECONDS))
 
     def __has_preview_changed(self, camera_client: CameraClient):
         return (camera_client.cur_resolution != self.resolution
@@ -309,6 +334,8 @@ class CameraProperties:
     # update property and return bool to indicate if changed
     def __update_frame_rate(self, data):
         new_value = Properties.get_twin_property(data, FRAME_RATE_PROP)
+        if new_value is None:
+            return False
         try:
             if type(new_value) is str:
                 new_value = int(new_value)
@@ -362,6 +389,9 @@ class ModelProperties:
         self.message_delay_sec = 6
         self.objects_of_interest = ["All"]
         self.has_model_changed = False
+        self.label_rate_limits = {}
+        self.rate_limit_key = RATE_LIMIT_KEY_LABEL
+        self.rate_limiter = LabelRateLimiter(1.0 / self.message_delay_sec)
 
     def is_object_of_interest(self, label):
         # create a filter object to select a string the objects of interest list
@@ -371,17 +401,22 @@ class ModelProperties:
                                   self.objects_of_interest))
         return (len(list_filter) > 0)
 
+    def is_message_allowed(self, inference):
+        return self.rate_limiter.allow(inference.label, inference.id)
+
     def handle_twin_update(self, data):
         self.__handle_model_updates(data)
         self.__update_message_delay(data)
         self.__update_objects_of_interest(data)
+        self.__update_rate_limits(data)
 
     def get_reported_properties(self):
-        props = list()
-        props.append({MODEL_ZIP_URL_PROP: self.model_zip_url})
-        props.append({MESSAGE_DELAY_SECS_PROP: self.message_delay_sec})
-        props.append(
-            {OBJS_OF_INTEREST_PROP: json.dumps(self.objects_of_interest)})
+        props = dict()
+        props[MODEL_ZIP_URL_PROP] = self.model_zip_url
+        props[MESSAGE_DELAY_SECS_PROP] = self.message_delay_sec
+        props[OBJS_OF_INTEREST_PROP] = json.dumps(self.objects_of_interest)
+        props[LABEL_RATE_LIMITS_PROP] = json.dumps(self.label_rate_limits)
+        props[RATE_LIMIT_KEY_PROP] = self.rate_limit_key
         return props
 
     def update_inference_model(self):
@@ -412,6 +447,8 @@ class ModelProperties:
 
     def __update_message_delay(self, data):
         delay = Properties.get_twin_property(data, MESSAGE_DELAY_SECS_PROP)
+        if delay is None:
+            return
         try:
             if type(delay) is not int:
                 # convert from str and truncate to int
@@ -424,37 +461,233 @@ class ModelProperties:
             delay = MINIMUM_MESSAGE_DELAY_IN_SECONDS
         self.message_delay_sec = delay
 
+    def __update_rate_limits(self, data):
+        limits_json = Properties.get_twin_property(data, LABEL_RATE_LIMITS_PROP)
+        if limits_json is not None:
+            try:
+                limits = json.loads(limits_json) if type(limits_json) is str else limits_json
+                self.rate_limiter.set_limits(limits)
+                self.label_rate_limits = limits
+            except (TypeError, ValueError, AttributeError):
+                log_unknown_exception(
+                    "Label rate limits must be a JSON object got %s" % limits_json)
+
+        key_by = Properties.get_twin_property(data, RATE_LIMIT_KEY_PROP)
+        if key_by is not None and str(key_by).lower() in (RATE_LIMIT_KEY_LABEL,
+                                                           RATE_LIMIT_KEY_TRACK):
+            self.rate_limit_key = str(key_by).lower()
+
+        # labels without their own limit keep the old one-message-per-delay pace
+        default_rate = 1.0 / self.message_delay_sec
+        if (default_rate != self.rate_limiter.default_rate
+                or self.rate_limit_key != self.rate_limiter.key_by):
+            self.rate_limiter.configure(default_rate=default_rate,
+                                        key_by=self.rate_limit_key)
+
+
+class MessageProperties:
+    def __init__(self):
+        print("Init MessageProperties")
+        self.batch_size_bytes = DEFAULT_BATCH_SIZE_IN_BYTES
+        self.batch_interval_sec = BATCH_FLUSH_INTERVAL_IN_SECONDS
+        self.batch_format = BATCH_FORMAT_JSON
+        self.compression = ENCODING_NONE
+        self.compression_threshold_bytes = COMPRESSION_THRESHOLD_IN_BYTES
+        self.outbox_drain_rate = OUTBOX_DRAIN_RATE_PER_SECOND
+        self.send_queue_capacity = SEND_QUEUE_CAPACITY
+        self.send_queue_policy = SEND_POLICY_SPILL
+        self.telemetry_mode = TELEMETRY_MODE_DETECTIONS
+        self.summary_interval_sec = SUMMARY_INTERVAL_IN_SECONDS
+
+    @property
+    def is_summary_mode(self):
+        return self.telemetry_mode == TELEMETRY_MODE_SUMMARY
+
+    def handle_twin_update(self, data):
+        self.__update_batch_size(data)
+        self.__update_batch_interval(data)
+        self.__update_batch_format(data)
+        self.__update_compression(data)
+        self.__update_compression_threshold(data)
+        self.__update_outbox_drain_rate(data)
+        self.__update_send_queue(data)
+        self.__update_telemetry_mode(data)
+
+    def get_reported_properties(self):
+        props = dict()
+        props[BATCH_SIZE_PROP] = self.batch_size_bytes
+        props[BATCH_INTERVAL_PROP] = self.batch_interval_sec
+        props[BATCH_FORMAT_PROP] = self.batch_format
+        props[COMPRESSION_PROP] = self.compression
+        props[COMPRESSION_THRESHOLD_PROP] = self.compression_threshold_bytes
+        props[OUTBOX_DRAIN_RATE_PROP] = self.outbox_drain_rate
+        props[SEND_QUEUE_CAPACITY_PROP] = self.send_queue_capacity
+        props[SEND_QUEUE_POLICY_PROP] = self.send_queue_policy
+        props[TELEMETRY_MODE_PROP] = self.telemetry_mode
+        props[SUMMARY_INTERVAL_PROP] = self.summary_interval_sec
+        return props
+
+    def configure_batcher(self, batcher):
+        batcher.configure(max_size=self.batch_size_bytes,
+                          flush_interval=self.batch_interval_sec,
+                          body_format=self.batch_format)
+
+    def configure_drainer(self, drainer):
+        drainer.drain_rate = self.outbox_drain_rate
+
+    def configure_send_pipeline(self, send_pipeline):
+        send_pipeline.configure(capacity=self.send_queue_capacity,
+                                policy=self.send_queue_policy)
+
+    def configure_summarizer(self, summarizer):
+        summarizer.interval = self.summary_interval_sec
+
+    def __update_batch_size(self, data):
+        size = Properties.get_twin_property(data, BATCH_SIZE_PROP)
+        if size is None:
+            return
+        try:
+            size = int(size)
+        except (TypeError, ValueError):
+            print("Received unusable batch size %s" % size)
+            return
+        self.batch_size_bytes = max(1, min(size, HUB_MESSAGE_SIZE_LIMIT_IN_BYTES))
+
+    def __update_batch_interval(self, data):
+        interval = Properties.get_twin_property(data, BATCH_INTERVAL_PROP)
+        if interval is None:
+            return
+        try:
+            self.batch_interval_sec = max(0.0, float(interval))
+        except (TypeError, ValueError):
+            print("Received unusable batch interval %s" % interval)
+
+    def __update_batch_format(self, data):
+        body_format = Properties.get_twin_property(data, BATCH_FORMAT_PROP)
+        if body_format is None:
+            return
+        body_format = str(body_format).lower()
+        if body_format not in BATCH_FORMATS:
+            print("Received unknown batch format %s" % body_format)
+            return
+        self.batch_format = body_format
+
+    def __update_compression(self, data):
+        encoding = Properties.get_twin_property(data, COMPRESSION_PROP)
+        if encoding is None:
+            return
+        encoding = str(encoding).lower()
+        if encoding not in SUPPORTED_ENCODINGS:
+            print("Received unknown message compression %s" % encoding)
+            return
+        self.compression = encoding
+
+    def __update_compression_threshold(self, data):
+        threshold = Properties.get_twin_property(data, COMPRESSION_THRESHOLD_PROP)
+        if threshold is None:
+            return
+        try:
+            self.compression_threshold_bytes = max(0, int(threshold))
+        except (TypeError, ValueError):
+            print("Received unusable compression threshold %s" % threshold)
+
+    def __update_outbox_drain_rate(self, data):
+        rate = Properties.get_twin_property(data, OUTBOX_DRAIN_RATE_PROP)
+        if rate is None:
+            return
+        try:
+            self.outbox_drain_rate = max(0.0, float(rate))
+        except (TypeError, ValueError):
+            print("Received unusable outbox drain rate %s" % rate)
+
+    def __update_send_queue(self, data):
+        capacity = Properties.get_twin_property(data, SEND_QUEUE_CAPACITY_PROP)
+        if capacity is not None:
+            try:
+                self.send_queue_capacity = max(1, int(capacity))
+            except (TypeError, ValueError):
+                print("Received unusable send queue capacity %s" % capacity)
+
+        policy = Properties.get_twin_property(data, SEND_QUEUE_POLICY_PROP)
+        if policy is not None:
+            policy = str(policy).lower()
+            if policy in SEND_POLICIES:
+                self.send_queue_policy = policy
+            else:
+                print("Received unknown send queue policy %s" % policy)
+
+    def __update_telemetry_mode(self, data):
+        mode = Properties.get_twin_property(data, TELEMETRY_MODE_PROP)
+        if mode is not None:
+            mode = str(mode).lower()
+            if mode in (TELEMETRY_MODE_DETECTIONS, TELEMETRY_MODE_SUMMARY):
+                self.telemetry_mode = mode
+            else:
+                print("Received unknown telemetry mode %s" % mode)
+
+        interval = Properties.get_twin_property(data, SUMMARY_INTERVAL_PROP)
+        if interval is not None:
+            try:
+                self.summary_interval_sec = max(MINIMUM_SUMMARY_INTERVAL_IN_SECONDS,
+                                                float(interval))
+            except (TypeError, ValueError):
+                print("Received unusable summary interval %s" % interval)
+
 
 class Properties:
     def __init__(self):
         print("Init Properties")
         self.camera_properties = CameraProperties()
         self.model_properties = ModelProperties()
+        self.message_properties = MessageProperties()
+        # last value reported for each key, acknowledged or in flight
+        self.__reported = dict()
+        self.__pending_reports = dict()
+        self.__report_context = 0
+        self.__report_lock = threading.Lock()
 
     def handle_twin_update(self, payload):
         data = json.loads(payload)
         print("Received twin update: %s" % data)
         self.model_properties.handle_twin_update(data)
         self.camera_properties.handle_twin_update(data)
+        self.message_properties.handle_twin_update(data)
+
+    def get_reported_properties(self):
+        props = self.camera_properties.get_reported_properties()
+        props.update(self.model_properties.get_reported_properties())
+        props.update(self.message_properties.get_reported_properties())
+        return props
 
+    # sends the properties that changed since the last report as one patch
     def report_properties_to_hub(self, hub_manager):
         if (hub_manager is None):
             raise ValueError("hub_manager is None")
 
-        for prop in self.camera_properties.get_reported_properties():
-            self.__report_property(prop, hub_manager)
-
-        for prop in self.model_properties.get_reported_properties():
-            self.__report_property(prop, hub_manager)
-
-    def __report_property(self, prop, hub_manager):
-        json_prop = json.dumps(prop)
-        print("Send prop: %s" % json_prop)
-        hub_manager.client.send_reported_state(
-            json_prop,
-            len(json_prop),
-            Properties.send_reported_state_callback,
-            json_prop)
+        with self.__report_lock:
+            patch = {key: value
+                     for key, value in self.get_reported_properties().items()
+                     if key not in self.__reported or self.__reported[key] != value}
+            if not patch:
+                print("Reported properties are up to date")
+                return
+            # counted as reported while in flight, rolled back if it fails
+            self.__reported.update(patch)
+            self.__report_context += 1
+            context = self.__report_context
+            self.__pending_reports[context] = patch
+
+        json_patch = json.dumps(patch)
+        print("Send reported properties[%d]: %s" % (context, json_patch))
+        try:
+            hub_manager.client.send_reported_state(
+                json_patch,
+                len(json_patch),
+                self.__send_reported_state_callback,
+                context)
+        except Exception:
+            self.__send_reported_state_callback(500, context)
+            raise
 
     @staticmethod
     def get_twin_property(data, property_name):
@@ -472,7 +705,14 @@ class Properties:
 
         return result
 
-    @staticmethod
-    def send_reported_state_callback(status_code, user_context):
-        print("Confirmation of %d received for %s." %
+    def __send_reported_state_callback(self, status_code, user_context):
+        print("Confirmation of %d received for reported properties[%d]." %
               (status_code, user_context))
+        with self.__report_lock:
+            patch = self.__pending_reports.pop(user_context, None)
+            if patch is None or 200 <= status_code < 300:
+                return
+            # forget the failed keys so the next report sends them again
+            for key, value in patch.items():
+                if key in self.__reported and self.__reported[key] == value:
+                    del self.__reported[key]
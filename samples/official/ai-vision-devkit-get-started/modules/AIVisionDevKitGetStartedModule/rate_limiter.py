@@ -0,0 +1,106 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE file in the project root for
+# full license information.
+
+import threading
+import time
+from collections import OrderedDict
+from . constants import RATE_LIMIT_KEY_LABEL, \
+    RATE_LIMIT_KEY_TRACK, \
+    MAX_RATE_LIMIT_BUCKETS
+
+
+class TokenBucket(object):
+    """
+        Allows `burst` messages at once, refilled at `rate` messages per second
+    """
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def try_consume(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class LabelRateLimiter(object):
+    """
+        Admits detections through an independent token bucket per label, or
+        per label and track id. Labels without their own limit share the
+        default rate, each in a bucket of its own.
+    """
+
+    def __init__(self, default_rate, default_burst=1, label_limits=None,
+                 key_by=RATE_LIMIT_KEY_LABEL, max_buckets=MAX_RATE_LIMIT_BUCKETS):
+        self.default_rate = default_rate
+        self.default_burst = default_burst
+        self.key_by = key_by
+        self.max_buckets = max_buckets
+        self.admitted = 0
+        self.throttled = 0
+        # twin updates arrive on the hub client thread
+        self.__lock = threading.Lock()
+        # label -> (rate, burst)
+        self.__limits = {}
+        self.__buckets = OrderedDict()
+        self.set_limits(label_limits or {})
+
+    def set_limits(self, label_limits):
+        """
+            `label_limits` maps a label to {"rate": per second, "burst": count}
+        """
+        limits = {}
+        for label, limit in label_limits.items():
+            rate = float(limit.get("rate", self.default_rate))
+            burst = float(limit.get("burst", max(1, rate)))
+            if rate < 0 or burst < 0:
+                raise ValueError("Rate limit for %s must not be negative" % label)
+            limits[label.lower()] = (rate, burst)
+        with self.__lock:
+            self.__limits = limits
+            self.__buckets.clear()
+
+    def configure(self, default_rate=None, default_burst=None, key_by=None):
+        if key_by is not None and key_by not in (RATE_LIMIT_KEY_LABEL, RATE_LIMIT_KEY_TRACK):
+            raise ValueError("Unknown rate limit key %s" % key_by)
+        with self.__lock:
+            if default_rate is not None:
+                self.default_rate = default_rate
+            if default_burst is not None:
+                self.default_burst = default_burst
+            if key_by is not None:
+                self.key_by = key_by
+            self.__buckets.clear()
+
+    def allow(self, label, track_id=None, now=None):
+        if now is None:
+            now = time.monotonic()
+        label = label.lower()
+        key = label
+        if self.key_by == RATE_LIMIT_KEY_TRACK and track_id is not None:
+            key = (label, track_id)
+        with self.__lock:
+            bucket = self.__buckets.get(key)
+            if bucket is None:
+                rate, burst = self.__limits.get(
+                    label, (self.default_rate, self.default_burst))
+                bucket = TokenBucket(rate, burst, now)
+                self.__buckets[key] = bucket
+                # short-lived tracks would otherwise grow the table without bound
+                if len(self.__buckets) > self.max_buckets:
+                    self.__buckets.popitem(last=False)
+            else:
+                self.__buckets.move_to_end(key)
+            if bucket.try_consume(now):
+                self.admitted += 1
+                return True
+            self.throttled += 1
+            return False
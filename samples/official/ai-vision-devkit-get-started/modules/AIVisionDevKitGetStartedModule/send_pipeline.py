@@ -0,0 +1,119 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE file in the project root for
+# full license information.
+
+import threading
+from collections import deque
+from . constants import SEND_QUEUE_CAPACITY, \
+    SEND_POLICY_DROP, \
+    SEND_POLICY_BLOCK, \
+    SEND_POLICY_SPILL
+
+SEND_POLICIES = (SEND_POLICY_DROP, SEND_POLICY_BLOCK, SEND_POLICY_SPILL)
+
+
+class SendPipeline(object):
+    """
+        Bounded queue between the inference loop and the hub client. A
+        worker thread hands each item to `process(item)`. When the queue is
+        full the policy decides: drop the oldest queued item, block the
+        caller until there is room, or pass the new item to `spill(item)`.
+    """
+
+    def __init__(self, process, spill=None,
+                 capacity=SEND_QUEUE_CAPACITY,
+                 policy=SEND_POLICY_DROP):
+        self.__process = process
+        self.__spill = spill
+        self.__condition = threading.Condition()
+        self.__queue = deque()
+        self.__running = True
+        self.capacity = capacity
+        self.policy = policy
+        self.submitted = 0
+        self.processed = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.blocked = 0
+        self.errors = 0
+        self.__thread = threading.Thread(
+            target=self.__work_loop, name="send-pipeline", daemon=True)
+        self.__thread.start()
+
+    def __len__(self):
+        return len(self.__queue)
+
+    def configure(self, capacity=None, policy=None):
+        with self.__condition:
+            if capacity is not None:
+                self.capacity = max(1, int(capacity))
+            if policy is not None:
+                if policy not in SEND_POLICIES:
+                    raise ValueError("Unknown send queue policy %s" % policy)
+                if policy == SEND_POLICY_SPILL and self.__spill is None:
+                    raise ValueError("No spill target for the send queue")
+                self.policy = policy
+            self.__condition.notify_all()
+
+    def submit(self, item):
+        spill = False
+        with self.__condition:
+            if not self.__running:
+                raise RuntimeError("SendPipeline is stopped")
+            self.submitted += 1
+            if len(self.__queue) >= self.capacity:
+                if self.policy == SEND_POLICY_BLOCK:
+                    self.blocked += 1
+                    while self.__running and len(self.__queue) >= self.capacity:
+                        self.__condition.wait()
+                elif self.policy == SEND_POLICY_SPILL:
+                    spill = True
+                else:
+                    self.__queue.popleft()
+                    self.dropped += 1
+            if not spill:
+                self.__queue.append(item)
+                self.__condition.notify_all()
+                return
+        # disk writes happen outside the lock so the worker keeps going
+        self.__spill(item)
+        self.spilled += 1
+
+    def stop(self):
+        """
+            Processes whatever is still queued, then stops the worker
+        """
+        with self.__condition:
+            self.__running = False
+            self.__condition.notify_all()
+        self.__thread.join()
+
+    def stats(self):
+        return {
+            "queued": len(self.__queue),
+            "capacity": self.capacity,
+            "policy": self.policy,
+            "submitted": self.submitted,
+            "processed": self.processed,
+            "dropped": self.dropped,
+            "spilled": self.spilled,
+            "blocked": self.blocked,
+            "errors": self.errors
+        }
+
+    def __work_loop(self):
+        while True:
+            with self.__condition:
+                while self.__running and not self.__queue:
+                    self.__condition.wait()
+                if not self.__queue:
+                    return
+                item = self.__queue.popleft()
+                # wake a caller blocked on a full queue
+                self.__condition.notify_all()
+            try:
+                self.__process(item)
+                self.processed += 1
+            except Exception as ex:
+                self.errors += 1
+                print("Exception processing upstream message: %s" % ex)
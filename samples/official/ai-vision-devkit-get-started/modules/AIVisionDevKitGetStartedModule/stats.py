@@ -0,0 +1,136 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE file in the project root for
+# full license information.
+
+import os
+import resource
+import threading
+import time
+from . constants import STATS_PERCENTILES
+
+IPC_BUCKET_PREFIX = "ipc_le_"
+PAGE_SIZE = resource.getpagesize()
+
+
+class PipelineStats(object):
+    """
+        Counters of the inference loop, plus the baseline that ResetStats
+        leaves behind. Only the inference loop writes the counters, so they
+        are plain increments without a lock; a reset records the current
+        totals instead of zeroing anything, and snapshots report the
+        difference.
+    """
+
+    def __init__(self):
+        self.frames_received = 0
+        self.frames_parsed = 0
+        # frames whose VA metadata could not be parsed
+        self.frames_dropped = 0
+        self.detections_received = 0
+        # not an object of interest
+        self.detections_filtered = 0
+        # over the label's rate limit
+        self.detections_throttled = 0
+        self.detections_queued = 0
+        self.__baseline = {}
+        self.__reset_time = time.monotonic()
+        self.__reset_cpu = _cpu_seconds()
+
+    def counters(self):
+        return {
+            "frames_received": self.frames_received,
+            "frames_parsed": self.frames_parsed,
+            "frames_dropped": self.frames_dropped,
+            "detections_received": self.detections_received,
+            "detections_filtered": self.detections_filtered,
+            "detections_throttled": self.detections_throttled,
+            "detections_queued": self.detections_queued
+        }
+
+    def reset(self, counters):
+        """
+            Makes `counters`, the cumulative totals of the whole pipeline,
+            the new zero
+        """
+        self.__baseline = dict(counters)
+        self.__reset_time = time.monotonic()
+        self.__reset_cpu = _cpu_seconds()
+
+    def since_reset(self, counters):
+        return dict((name, value - self.__baseline.get(name, 0))
+                    for name, value in counters.items())
+
+    def window(self):
+        """
+            Seconds and CPU seconds since the last reset
+        """
+        return (time.monotonic() - self.__reset_time,
+                _cpu_seconds() - self.__reset_cpu)
+
+
+def ipc_counters(ipc_provider):
+    """
+        Cumulative request, error and latency bucket counts over all the
+        IPC endpoints; empty when the installed iotccsdk has no metrics
+    """
+    metrics = getattr(ipc_provider, "metrics", None)
+    if metrics is None:
+        return {}
+    counters = {"ipc_requests": 0, "ipc_errors": 0}
+    for endpoint in metrics.snapshot().values():
+        counters["ipc_requests"] += endpoint["count"]
+        counters["ipc_errors"] += endpoint["errors"]
+        for bound, seen in endpoint["latency"]["buckets"].items():
+            name = IPC_BUCKET_PREFIX + bound
+            counters[name] = counters.get(name, 0) + seen
+    return counters
+
+
+def ipc_latency(counters):
+    """
+        Latency percentiles in milliseconds from the cumulative buckets in
+        `counters`; the upper bound of the bucket holding each percentile,
+        None when it is past the last bucket or nothing was observed
+    """
+    buckets = sorted((float(name[len(IPC_BUCKET_PREFIX):]), seen)
+                     for name, seen in counters.items()
+                     if name.startswith(IPC_BUCKET_PREFIX))
+    count = buckets[-1][1] if buckets else 0
+    latency = {}
+    for q in STATS_PERCENTILES:
+        value = None
+        if count:
+            rank = q * count / 100.0
+            for bound, seen in buckets:
+                if seen >= rank:
+                    if bound != float("inf"):
+                        value = round(bound * 1000, 1)
+                    break
+        latency["p%d_ms" % q] = value
+    return latency
+
+
+def process_stats(window_sec, cpu_sec):
+    """
+        RSS, peak RSS, CPU use over the window and thread count of this
+        process, read from /proc and getrusage
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    try:
+        with open("/proc/self/statm") as statm:
+            rss = int(statm.read().split()[1]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        rss = None
+    return {
+        "rss_bytes": rss,
+        # kilobytes on Linux
+        "max_rss_bytes": usage.ru_maxrss * 1024,
+        "cpu_percent": round(100.0 * cpu_sec / window_sec, 1) if window_sec > 0 else 0.0,
+        "cpu_sec": round(usage.ru_utime + usage.ru_stime, 3),
+        "threads": threading.active_count()
+    }
+
+
+def _cpu_seconds():
+    times = os.times()
+    return times[0] + times[1]
@@ -0,0 +1,171 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE file in the project root for
+# full license information.
+
+import json
+import threading
+import time
+from . constants import SUMMARY_INTERVAL_IN_SECONDS, \
+    SUMMARY_MESSAGE_TYPE
+from . inference import Inference
+
+
+class _LabelStats(object):
+    __slots__ = ("count", "confidence_sum", "confidence_max",
+                 "frames_present", "max_per_frame")
+
+    def __init__(self):
+        self.count = 0
+        self.confidence_sum = 0.0
+        self.confidence_max = 0.0
+        self.frames_present = 0
+        self.max_per_frame = 0
+
+    def to_dict(self, frames):
+        return {
+            "count": self.count,
+            "mean_confidence": round(self.confidence_sum / self.count, 2),
+            "max_confidence": self.confidence_max,
+            # share of frames in which the label was seen at all
+            "occupancy": round(self.frames_present / frames, 3),
+            "mean_per_frame": round(self.count / frames, 3),
+            "max_per_frame": self.max_per_frame
+        }
+
+
+class InferenceSummarizer(object):
+    """
+        Aggregates inference frames over fixed windows and hands one summary
+        JSON message per window to `emit(message)`. Each detection only
+        updates a few running totals for its label. A timer thread closes
+        the window when `interval` is over, also when the VA stream stalls.
+    """
+
+    def __init__(self, emit, interval=SUMMARY_INTERVAL_IN_SECONDS):
+        self.__emit = emit
+        self.__condition = threading.Condition()
+        self.__interval = interval
+        self.__running = True
+        self.summaries_sent = 0
+        self.__reset(time.monotonic())
+        self.__thread = threading.Thread(
+            target=self.__flush_loop, name="inference-summarizer", daemon=True)
+        self.__thread.start()
+
+    @property
+    def interval(self):
+        return self.__interval
+
+    @interval.setter
+    def interval(self, value):
+        with self.__condition:
+            self.__interval = value
+            self.__condition.notify()
+
+    @property
+    def pending_frames(self):
+        return self.__frames
+
+    def add_frame(self, objects, is_object_of_interest=None):
+        """
+            Adds one CameraInference frame given its `objects`, first
+            closing the current window when it is over
+        """
+        detections = []
+        for inf_obj in objects or ():
+            inference = Inference(inf_obj)
+            label = inference.label
+            if is_object_of_interest is not None and not is_object_of_interest(label):
+                continue
+            detections.append((label, inference.confidence))
+        now = time.monotonic()
+        with self.__condition:
+            summary = None
+            if now - self.__window_start >= self.__interval:
+                summary = self.__take(now)
+            if not self.__frames:
+                # the timer waits for the first frame of a window
+                self.__condition.notify()
+            self.__frames += 1
+            frame_counts = {}
+            for label, confidence in detections:
+                stats = self.__labels.get(label)
+                if stats is None:
+                    stats = self.__labels[label] = _LabelStats()
+                stats.count += 1
+                stats.confidence_sum += confidence
+                if confidence > stats.confidence_max:
+                    stats.confidence_max = confidence
+                frame_counts[label] = frame_counts.get(label, 0) + 1
+            for label, count in frame_counts.items():
+                stats = self.__labels[label]
+                stats.frames_present += 1
+                if count > stats.max_per_frame:
+                    stats.max_per_frame = count
+        self.__send(summary)
+
+    def flush(self, now=None):
+        """
+            Emits the summary of the current window, if it saw any frames,
+            and starts a new one
+        """
+        if now is None:
+            now = time.monotonic()
+        with self.__condition:
+            summary = self.__take(now)
+        self.__send(summary)
+
+    def stop(self):
+        """
+            Stops the timer and emits the current window
+        """
+        with self.__condition:
+            self.__running = False
+            self.__condition.notify()
+        self.__thread.join()
+        self.flush()
+
+    # called with the condition held; the summary of the current window,
+    # None if it saw no frames, and a new window
+    def __take(self, now):
+        frames = self.__frames
+        summary = None
+        if frames:
+            summary = {
+                "type": SUMMARY_MESSAGE_TYPE,
+                "window_start": round(self.__window_start_epoch, 3),
+                "window_sec": round(now - self.__window_start, 3),
+                "frames": frames,
+                "labels": {label: stats.to_dict(frames)
+                           for label, stats in self.__labels.items()}
+            }
+        self.__reset(now)
+        return summary
+
+    def __send(self, summary):
+        if summary is None:
+            return
+        self.__emit(json.dumps(summary))
+        self.summaries_sent += 1
+
+    def __reset(self, now):
+        self.__window_start = now
+        self.__window_start_epoch = time.time()
+        self.__frames = 0
+        self.__labels = {}
+
+    def __flush_loop(self):
+        while True:
+            with self.__condition:
+                while self.__running:
+                    if not self.__frames:
+                        self.__condition.wait()
+                        continue
+                    remaining = self.__window_start + self.__interval - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.__condition.wait(remaining)
+                if not self.__running:
+                    return
+                summary = self.__take(time.monotonic())
+            self.__send(summary)
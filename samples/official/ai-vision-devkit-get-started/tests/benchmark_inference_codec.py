@@ -0,0 +1,83 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE file in the project root for
+# full license information.
+
+# Compares encode time and bytes per detection of the JSON and binary
+# upstream formats, with and without compression.
+#
+#   python3 tests/benchmark_inference_codec.py [detections] [per_batch]
+
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "modules"))
+
+from AIVisionDevKitGetStartedModule.inference import Inference  # noqa: E402
+from AIVisionDevKitGetStartedModule.inference_codec import encode_inferences, \
+    decode_inferences  # noqa: E402
+from AIVisionDevKitGetStartedModule.message_encoding import compress  # noqa: E402
+
+LABELS = ["person", "car", "bicycle", "dog", "truck", "traffic light"]
+
+
+class _Position(object):
+    def __init__(self):
+        self.x = random.uniform(0, 1920)
+        self.y = random.uniform(0, 1080)
+        self.width = random.uniform(20, 400)
+        self.height = random.uniform(20, 400)
+
+
+class _InferenceObject(object):
+    def __init__(self, id):
+        self.id = id
+        self.label = random.choice(LABELS) + "."
+        self.confidence = random.randint(50, 99)
+        self.position = _Position()
+
+
+def _json_batch(batch):
+    return ("[" + ",".join(inference.to_json() for inference in batch) + "]").encode("utf-8")
+
+
+def _binary_batch(batch):
+    return encode_inferences(batch)
+
+
+def _measure(name, encode, batches, detections):
+    start = time.perf_counter()
+    bodies = [encode(batch) for batch in batches]
+    elapsed = time.perf_counter() - start
+    size = sum(len(body) for body in bodies)
+    gzip_size = sum(len(compress(body, "gzip")) for body in bodies)
+    print("%-8s %8.2f us/detection %8.1f bytes/detection %8.1f gzip bytes/detection" % (
+        name, elapsed / detections * 1e6, size / detections, gzip_size / detections))
+    return bodies
+
+
+def main(detections=100000, per_batch=40):
+    random.seed(1)
+    inferences = [Inference(_InferenceObject(i)) for i in range(detections)]
+    batches = [inferences[i:i + per_batch] for i in range(0, detections, per_batch)]
+    print("%d detections in batches of %d" % (detections, per_batch))
+
+    json_bodies = _measure("json", _json_batch, batches, detections)
+    binary_bodies = _measure("binary", _binary_batch, batches, detections)
+
+    start = time.perf_counter()
+    for body in json_bodies:
+        json.loads(body.decode("utf-8"))
+    json_decode = time.perf_counter() - start
+    start = time.perf_counter()
+    for body in binary_bodies:
+        decode_inferences(body)
+    binary_decode = time.perf_counter() - start
+    print("decode   json %.2f us/detection, binary %.2f us/detection" % (
+        json_decode / detections * 1e6, binary_decode / detections * 1e6))
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:3]))
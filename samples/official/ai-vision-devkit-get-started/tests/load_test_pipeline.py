@@ -0,0 +1,171 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE file in the project root for
+# full license information.
+
+# Runs the whole edge pipeline in one process, off-device: the fake camera
+# from camera-sdk/tests streams synthetic inferences, this module filters and
+# batches them, the local edgeHub in tests/local_iothub routes them to the
+# BusinessLogicModule and on to $upstream. Prints throughput, the upstream
+# send statistics and the GetStats snapshot at the end.
+#
+#   python3 tests/load_test_pipeline.py --fps 60 --objects 10 --seconds 30 \
+#       --label-rate 100 --latency 0.02 --failure-rate 0.01
+
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.abspath(os.path.join(HERE, "..", "..", "..", ".."))
+CAMERA_SDK = os.path.join(ROOT, "camera-sdk")
+BUSINESS_LOGIC_MAIN = os.path.join(
+    ROOT, "samples", "research", "VisionSample", "CreateAndDeployEdgeContainer",
+    "modules", "BusinessLogicModule", "main.py")
+DEPLOYMENT = os.path.join(
+    ROOT, "samples", "research", "VisionSample", "CreateAndDeployEdgeContainer",
+    "02-businesslogic-deployment.template.json")
+
+# the local iothub_client must shadow any installed native one
+sys.path[:0] = [os.path.join(HERE, "local_iothub"),
+                os.path.join(HERE, "..", "modules"),
+                CAMERA_SDK,
+                os.path.join(CAMERA_SDK, "tests")]
+
+import iothub_client  # noqa: E402
+from iotccsdk import CameraClient  # noqa: E402
+from fake_ipc_webserver import FakeIpcWebserver, LABELS  # noqa: E402
+from AIVisionDevKitGetStartedModule import main as get_started  # noqa: E402
+from AIVisionDevKitGetStartedModule.iot_hub_manager import IotHubManager  # noqa: E402
+from AIVisionDevKitGetStartedModule.properties import Properties  # noqa: E402
+
+MODULE_ID = "AIVisionDevKitGetStartedModule"
+BUSINESS_LOGIC_ID = "BusLogicModule"
+VA_SOURCE_CMD = '"%s" "%s" va --url {url} --fps %s --objects %s'
+
+
+def _routes():
+    with open(DEPLOYMENT) as deployment:
+        manifest = json.load(deployment)
+    routes = manifest["modulesContent"]["$edgeHub"]["properties.desired"]["routes"]
+    return [route.replace("${MODULE_NAME}", MODULE_ID) for route in routes.values()]
+
+
+def _start_module(module_id, start):
+    # each client takes its identity from the environment, as on a device
+    os.environ["IOTEDGE_MODULEID"] = module_id
+    return start()
+
+
+def _load_business_logic():
+    spec = importlib.util.spec_from_file_location("business_logic_main", BUSINESS_LOGIC_MAIN)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ip', help='address of the fake camera', default='127.0.0.1')
+    parser.add_argument('--fps', help='synthetic VA fps', type=float, default=30.0)
+    parser.add_argument('--objects', help='synthetic objects per frame', type=int, default=5)
+    parser.add_argument('--seconds', help='seconds to run', type=float, default=10.0)
+    parser.add_argument('--latency', help='edgeHub send latency in seconds',
+                        type=float, default=0.0)
+    parser.add_argument('--jitter', help='extra random send latency in seconds',
+                        type=float, default=0.0)
+    parser.add_argument('--failure-rate', help='share of sends that fail',
+                        type=float, default=0.0)
+    parser.add_argument('--desired', help='JSON desired properties for this module',
+                        default='{}')
+    parser.add_argument('--label-rate', help='messages per second allowed for each label',
+                        type=float, default=None)
+    parser.add_argument('--object-of-interest', help='label the business logic forwards',
+                        default='person')
+    parser.add_argument('--verbose', help='keep the modules\' per message output',
+                        action='store_true')
+    args = parser.parse_args()
+
+    hub = iothub_client.hub
+    hub.configure(latency=args.latency, jitter=args.jitter,
+                  failure_rate=args.failure_rate)
+    hub.set_routes(_routes())
+    desired = json.loads(args.desired)
+    if args.label_rate is not None:
+        limit = {"rate": args.label_rate, "burst": max(1, args.label_rate)}
+        desired["LabelRateLimits"] = json.dumps(dict((label, limit) for label in LABELS))
+    hub.set_desired(MODULE_ID, desired)
+    hub.set_desired(BUSINESS_LOGIC_ID, {"ObjectOfInterest": args.object_of_interest})
+
+    business_logic = _load_business_logic()
+    _start_module(BUSINESS_LOGIC_ID, business_logic.HubManager)
+
+    server = FakeIpcWebserver(args.ip).start()
+    source_cmd = VA_SOURCE_CMD % (
+        sys.executable, os.path.join(CAMERA_SDK, "tests", "fake_ipc_webserver.py"),
+        args.fps, args.objects)
+    outbox = tempfile.TemporaryDirectory()
+    stdout = sys.stdout
+    if not args.verbose:
+        sys.stdout = open(os.devnull, "w")
+    frames = 0
+    objects = 0
+    try:
+        with CameraClient.connect(ip_address=args.ip, username='admin',
+                                  password='admin') as camera_client:
+            camera_client.set_preview_state("on")
+            camera_client.set_analytics_state("on")
+            get_started.properties = properties = Properties()
+            manager = _start_module(MODULE_ID, lambda: IotHubManager(
+                iothub_client.IoTHubTransportProvider.MQTT, camera_client, properties,
+                outbox_directory=outbox.name))
+            manager.subscribe_to_events()
+
+            start = time.time()
+            with camera_client.get_inferences(source_cmd=source_cmd) as results:
+                for result in results:
+                    frames += 1
+                    objects += len(result.objects or [])
+                    get_started.print_inference(result, manager)
+                    if time.time() - start > args.seconds:
+                        break
+            elapsed = time.time() - start
+            while manager.send_pipeline.stats()["queued"]:
+                time.sleep(0.05)
+            manager.batcher.flush()
+            # let the last sends through the edgeHub; the stats are taken
+            # before close() so the outbox backlog is still readable
+            time.sleep(args.latency + args.jitter + 0.5)
+            stats = manager.send_stats()
+            status, pipeline_stats = hub.invoke_method(MODULE_ID, "GetStats")
+            manager.close()
+    finally:
+        if sys.stdout is not stdout:
+            sys.stdout.close()
+            sys.stdout = stdout
+        server.stop()
+        outbox.cleanup()
+
+    forwarded = hub.messages_to(BUSINESS_LOGIC_ID)
+    upstream = [sent for sent in hub.upstream if sent.module_id == BUSINESS_LOGIC_ID]
+    delays = sorted(sent.delivered_time - sent.sent_time for sent in forwarded
+                    if sent.delivered_time is not None)
+    print("camera:         %d frames, %d objects in %.2fs (%.1f fps)" % (
+        frames, objects, elapsed, frames / elapsed))
+    print("module output:  %d messages, %d bytes" % (
+        len(forwarded), sum(len(sent.body) for sent in forwarded)))
+    if delays:
+        print("edgeHub delay:  p50 %.1f ms, p99 %.1f ms" % (
+            delays[len(delays) // 2] * 1000, delays[int(len(delays) * 0.99)] * 1000))
+    print("business logic: %d received, %d sent upstream" % (
+        business_logic.RECEIVE_CALLBACKS, len(upstream)))
+    print("send stats:     %s" % json.dumps(stats, sort_keys=True))
+    print("GetStats (%d):  %s" % (status, pipeline_stats))
+    print("reported:       %d properties" % len(hub.get_reported(MODULE_ID)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,488 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE file in the project root for
+# full license information.
+
+"""
+Local, in-process stand-in for the native azure-iothub-device-client module.
+
+Put this directory first on PYTHONPATH and `import iothub_client` resolves
+here, so edge modules run off-device. Every client talks to one in-memory
+`LocalEdgeHub` (the module level `hub`) that routes module outputs to other
+modules' inputs or to $upstream with the edgeHub route syntax, delivers twin
+patches and direct method calls, captures every message sent, and can add
+latency and failures to sends.
+
+Each client takes its module id from IOTEDGE_MODULEID when it is created,
+as on a device, so several modules can share one process by setting it
+before creating each one. The defaults can be set with LOCAL_IOTHUB_LATENCY,
+LOCAL_IOTHUB_JITTER and LOCAL_IOTHUB_FAILURE_RATE.
+"""
+
+import copy
+import heapq
+import itertools
+import json
+import os
+import random
+import re
+import threading
+import time
+
+UPSTREAM = "$upstream"
+DEFAULT_MODULE_ID = "module"
+
+
+class IoTHubError(Exception):
+    pass
+
+
+class IoTHubClientError(IoTHubError):
+    pass
+
+
+class IoTHubMessageError(IoTHubError):
+    pass
+
+
+class IoTHubMapError(IoTHubError):
+    pass
+
+
+class _Enum(object):
+    """
+        Named value that prints like the native enums
+    """
+
+    def __init__(self, name, value):
+        self.name = name
+        self.value = value
+
+    def __repr__(self):
+        return self.name
+
+    __str__ = __repr__
+
+    def __int__(self):
+        return self.value
+
+
+def _enum(name, *names):
+    members = dict((member, _Enum(member, value)) for value, member in enumerate(names))
+    return type(name, (object,), members)
+
+
+IoTHubTransportProvider = _enum(
+    "IoTHubTransportProvider", "HTTP", "AMQP", "MQTT", "AMQP_WS", "MQTT_WS")
+IoTHubClientResult = _enum(
+    "IoTHubClientResult", "OK", "INVALID_ARG", "ERROR", "INVALID_SIZE", "INDEFINITE_TIME")
+IoTHubClientConfirmationResult = _enum(
+    "IoTHubClientConfirmationResult", "OK", "BECAUSE_DESTROY", "MESSAGE_TIMEOUT", "ERROR")
+IoTHubMessageDispositionResult = _enum(
+    "IoTHubMessageDispositionResult", "ACCEPTED", "REJECTED", "ABANDONED")
+IoTHubClientStatus = _enum("IoTHubClientStatus", "IDLE", "BUSY")
+IoTHubTwinUpdateState = _enum("IoTHubTwinUpdateState", "COMPLETE", "PARTIAL")
+IoTHubMessageContent = _enum("IoTHubMessageContent", "BYTEARRAY", "STRING", "UNKNOWN")
+
+
+class IoTHubMap(object):
+    def __init__(self, properties=None):
+        self.__properties = dict(properties or {})
+
+    def add(self, key, value):
+        if key in self.__properties:
+            raise IoTHubMapError("Key %s already exists" % key)
+        self.__properties[key] = value
+
+    def add_or_update(self, key, value):
+        self.__properties[key] = value
+
+    def contains_key(self, key):
+        return key in self.__properties
+
+    def contains_value(self, value):
+        return value in self.__properties.values()
+
+    def get_value_from_key(self, key):
+        return self.__properties[key]
+
+    def delete(self, key):
+        del self.__properties[key]
+
+    def get_internals(self):
+        return dict(self.__properties)
+
+
+class IoTHubMessage(object):
+    def __init__(self, source):
+        if isinstance(source, str):
+            self.__content_type = IoTHubMessageContent.STRING
+            self.__body = source.encode("utf-8")
+        elif isinstance(source, (bytes, bytearray)):
+            self.__content_type = IoTHubMessageContent.BYTEARRAY
+            self.__body = bytes(source)
+        else:
+            raise IoTHubMessageError("Message source must be a str or bytearray")
+        self.__properties = IoTHubMap()
+        self.message_id = None
+        self.correlation_id = None
+        self.input_name = None
+        self.output_name = None
+        self.connection_module_id = None
+
+    def get_bytearray(self):
+        return bytearray(self.__body)
+
+    def get_string(self):
+        if self.__content_type is not IoTHubMessageContent.STRING:
+            return None
+        return self.__body.decode("utf-8")
+
+    def get_content_type(self):
+        return self.__content_type
+
+    def properties(self):
+        return self.__properties
+
+    def _copy(self):
+        message = IoTHubMessage(bytes(self.__body))
+        message.__content_type = self.__content_type
+        message.__properties = IoTHubMap(self.__properties.get_internals())
+        message.message_id = self.message_id
+        message.correlation_id = self.correlation_id
+        return message
+
+
+class DeviceMethodReturnValue(object):
+    def __init__(self):
+        self.response = None
+        self.status = None
+
+
+class SentMessage(object):
+    """
+        A message captured by the hub, with where it came from and went
+    """
+
+    def __init__(self, module_id, output_name, message, destinations, sent_time):
+        self.module_id = module_id
+        self.output_name = output_name
+        self.message = message
+        self.destinations = destinations
+        self.sent_time = sent_time
+        self.delivered_time = None
+        self.result = None
+
+    @property
+    def properties(self):
+        return self.message.properties().get_internals()
+
+    @property
+    def body(self):
+        return bytes(self.message.get_bytearray())
+
+
+class _Route(object):
+    PATTERN = re.compile(
+        r'^\s*FROM\s+/messages/(?:modules/(?P<module>[^/\s]+)/)?'
+        r'(?:outputs/(?P<output>[^/\s]+)(?:/\*)?|\*)\s+'
+        r'INTO\s+(?:(?P<upstream>\$upstream)|'
+        r'BrokeredEndpoint\(\s*"/modules/(?P<target>[^/]+)/inputs/(?P<input>[^/"]+)"\s*\))\s*$',
+        re.IGNORECASE)
+
+    def __init__(self, route):
+        match = self.PATTERN.match(route)
+        if match is None:
+            raise ValueError("Unsupported route %s" % route)
+        self.module = match.group("module")
+        output = match.group("output")
+        self.output = None if output in (None, "*") else output
+        if match.group("upstream"):
+            self.destination = (UPSTREAM, None)
+        else:
+            self.destination = (match.group("target"), match.group("input"))
+
+    def matches(self, module_id, output_name):
+        return ((self.module is None or self.module == module_id)
+                and (self.output is None or self.output == output_name))
+
+
+class LocalEdgeHub(object):
+    """
+        In-memory edgeHub shared by every client in the process
+    """
+
+    def __init__(self):
+        self.__lock = threading.RLock()
+        self.__wake = threading.Condition(self.__lock)
+        self.__events = []
+        self.__sequence = itertools.count()
+        self.__thread = None
+        self.__clients = {}
+        self.__routes = []
+        self.__desired = {}
+        self.__reported = {}
+        self.sent = []
+        self.upstream = []
+        self.latency = float(os.environ.get("LOCAL_IOTHUB_LATENCY", 0))
+        self.jitter = float(os.environ.get("LOCAL_IOTHUB_JITTER", 0))
+        self.failure_rate = float(os.environ.get("LOCAL_IOTHUB_FAILURE_RATE", 0))
+        self.capture = True
+        self.random = random.Random()
+
+    def configure(self, latency=None, jitter=None, failure_rate=None, capture=None, seed=None):
+        with self.__lock:
+            if latency is not None:
+                self.latency = latency
+            if jitter is not None:
+                self.jitter = jitter
+            if failure_rate is not None:
+                self.failure_rate = failure_rate
+            if capture is not None:
+                self.capture = capture
+            if seed is not None:
+                self.random.seed(seed)
+
+    def set_routes(self, routes):
+        """
+            Takes edgeHub route strings, as a list or the `routes` dict of a
+            deployment manifest. WHERE clauses are not supported.
+        """
+        if isinstance(routes, dict):
+            routes = list(routes.values())
+        parsed = [_Route(route) for route in routes]
+        with self.__lock:
+            self.__routes = parsed
+
+    def reset(self):
+        """
+            Forgets clients, routes, twins and captured messages
+        """
+        with self.__lock:
+            self.__events = []
+            self.__clients = {}
+            self.__routes = []
+            self.__desired = {}
+            self.__reported = {}
+            self.sent = []
+            self.upstream = []
+
+    def set_desired(self, module_id, desired, version=None):
+        """
+            Patches a module's desired properties and notifies the module
+        """
+        with self.__lock:
+            current = self.__desired.setdefault(module_id, {"$version": 1})
+            current.update(copy.deepcopy(desired))
+            current["$version"] = version or current["$version"] + 1
+            client = self.__clients.get(module_id)
+            patch = dict(desired, **{"$version": current["$version"]})
+        if client is not None:
+            client._twin_update(IoTHubTwinUpdateState.PARTIAL, patch)
+
+    def get_twin(self, module_id):
+        with self.__lock:
+            return {"desired": copy.deepcopy(self.__desired.get(module_id, {"$version": 1})),
+                    "reported": copy.deepcopy(self.__reported.get(module_id, {}))}
+
+    def get_reported(self, module_id):
+        return self.get_twin(module_id)["reported"]
+
+    def invoke_method(self, module_id, method_name, payload=None, timeout=None):
+        """
+            Calls a direct method and returns (status, response)
+        """
+        with self.__lock:
+            client = self.__clients.get(module_id)
+        if client is None:
+            return 404, json.dumps({"message": "Module %s is not connected" % module_id})
+        return client._invoke_method(method_name, json.dumps(payload))
+
+    def messages_to(self, module_id, input_name=None):
+        return [sent for sent in self.sent
+                if any(target == module_id and (input_name is None or name == input_name)
+                       for target, name in sent.destinations)]
+
+    def _register(self, client):
+        with self.__lock:
+            self.__clients[client.module_id] = client
+            if self.__thread is None or not self.__thread.is_alive():
+                self.__thread = threading.Thread(
+                    target=self.__dispatch_loop, name="local-edgehub", daemon=True)
+                self.__thread.start()
+
+    def _unregister(self, client):
+        with self.__lock:
+            if self.__clients.get(client.module_id) is client:
+                del self.__clients[client.module_id]
+
+    def _send(self, client, output_name, message, callback, context):
+        message = message._copy()
+        message.output_name = output_name
+        message.connection_module_id = client.module_id
+        with self.__lock:
+            destinations = [route.destination for route in self.__routes
+                            if route.matches(client.module_id, output_name)]
+            sent = SentMessage(client.module_id, output_name, message,
+                               destinations, time.time())
+            if self.capture:
+                self.sent.append(sent)
+            delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+            failed = self.failure_rate > 0 and self.random.random() < self.failure_rate
+            self.__schedule(delay, self.__deliver, sent, callback, context, failed)
+
+    def _report(self, client, reported_state, callback, context):
+        patch = json.loads(reported_state)
+        with self.__lock:
+            failed = self.failure_rate > 0 and self.random.random() < self.failure_rate
+            if not failed:
+                self.__reported.setdefault(client.module_id, {}).update(patch)
+            self.__schedule(self.latency, callback, 500 if failed else 204, context)
+
+    def _call_soon(self, function, *args):
+        with self.__lock:
+            self.__schedule(0, function, *args)
+
+    def __schedule(self, delay, function, *args):
+        # events with equal due times keep their order, like the native
+        # client's single DoWork thread
+        heapq.heappush(self.__events, (time.monotonic() + delay, next(self.__sequence),
+                                       function, args))
+        self.__wake.notify()
+
+    def __deliver(self, sent, callback, context, failed):
+        result = IoTHubClientConfirmationResult.OK
+        if failed:
+            result = IoTHubClientConfirmationResult.ERROR
+        else:
+            for target, input_name in sent.destinations:
+                if target == UPSTREAM:
+                    if self.capture:
+                        self.upstream.append(sent)
+                    continue
+                with self.__lock:
+                    client = self.__clients.get(target)
+                if client is not None:
+                    message = sent.message._copy()
+                    message.input_name = input_name
+                    client._receive(input_name, message)
+            sent.delivered_time = time.time()
+        sent.result = result
+        if callback is not None:
+            callback(sent.message, result, context)
+
+    def __dispatch_loop(self):
+        while True:
+            with self.__lock:
+                while not self.__events or self.__events[0][0] > time.monotonic():
+                    timeout = None
+                    if self.__events:
+                        timeout = self.__events[0][0] - time.monotonic()
+                    self.__wake.wait(timeout)
+                _, _, function, args = heapq.heappop(self.__events)
+            try:
+                function(*args)
+            except Exception as ex:
+                print("Exception in local edgeHub callback: %s" % ex)
+
+
+hub = LocalEdgeHub()
+
+
+class IoTHubModuleClient(object):
+    def __init__(self, connection_string=None, protocol=None):
+        self.module_id = None
+        self.protocol = None
+        self.options = {}
+        self.__message_callbacks = {}
+        self.__twin_callback = None
+        self.__method_callback = None
+        if connection_string is not None:
+            self.create_from_connection_string(connection_string, protocol)
+
+    def create_from_environment(self, protocol):
+        self.__connect(os.environ.get("IOTEDGE_MODULEID", DEFAULT_MODULE_ID), protocol)
+
+    def create_from_connection_string(self, connection_string, protocol):
+        parts = dict(part.split("=", 1) for part in connection_string.split(";") if "=" in part)
+        module_id = parts.get("ModuleId") or parts.get("DeviceId") or DEFAULT_MODULE_ID
+        self.__connect(module_id, protocol)
+
+    def set_option(self, option_name, option):
+        self.options[option_name] = option
+
+    def send_event_async(self, output_name, message, message_callback, user_context):
+        if not isinstance(message, IoTHubMessage):
+            raise IoTHubClientError("send_event_async takes an IoTHubMessage")
+        hub._send(self, output_name, message, message_callback, user_context)
+        return IoTHubClientResult.OK
+
+    def set_message_callback(self, input_name, callback, user_context):
+        self.__message_callbacks[input_name] = (callback, user_context)
+        return IoTHubClientResult.OK
+
+    def set_module_twin_callback(self, callback, user_context):
+        self.__twin_callback = (callback, user_context)
+        # the native client delivers the whole twin once subscribed
+        self._twin_update(IoTHubTwinUpdateState.COMPLETE, hub.get_twin(self.module_id))
+        return IoTHubClientResult.OK
+
+    def set_module_method_callback(self, callback, user_context):
+        self.__method_callback = (callback, user_context)
+        return IoTHubClientResult.OK
+
+    def send_reported_state(self, reported_state, size, callback, user_context):
+        hub._report(self, reported_state, callback, user_context)
+        return IoTHubClientResult.OK
+
+    def get_send_status(self):
+        return IoTHubClientStatus.IDLE
+
+    def get_last_message_receive_time(self):
+        return time.time()
+
+    def destroy(self):
+        hub._unregister(self)
+
+    def __connect(self, module_id, protocol):
+        self.module_id = module_id
+        self.protocol = protocol
+        hub._register(self)
+
+    def _receive(self, input_name, message):
+        registered = self.__message_callbacks.get(input_name)
+        if registered is None:
+            # the native client drops messages on inputs nobody listens to
+            return None
+        callback, context = registered
+        return callback(message, context)
+
+    def _twin_update(self, update_state, twin):
+        if self.__twin_callback is None:
+            return
+        callback, context = self.__twin_callback
+        hub._call_soon(callback, update_state, json.dumps(twin), context)
+
+    def _invoke_method(self, method_name, payload):
+        if self.__method_callback is None:
+            return 501, json.dumps({"message": "No method handler registered"})
+        callback, context = self.__method_callback
+        try:
+            retval = callback(method_name, payload, context)
+        except Exception as ex:
+            return 500, json.dumps({"message": "Method handler raised %r" % ex})
+        return retval.status, retval.response
+
+
+class IoTHubClient(IoTHubModuleClient):
+    """
+        Device client; sends go to the default output
+    """
+
+    def __init__(self, connection_string=None, protocol=None):
+        IoTHubModuleClient.__init__(self)
+        if connection_string is not None:
+            self.create_from_connection_string(connection_string, protocol)
+
+    def send_event_async(self, message, message_callback, user_context):
+        return IoTHubModuleClient.send_event_async(
+            self, None, message, message_callback, user_context)
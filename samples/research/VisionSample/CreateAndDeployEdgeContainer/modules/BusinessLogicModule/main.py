@@ -5,7 +5,9 @@
 import json
 import random
 import time
+import struct
 import sys
+import zlib
 import iothub_client
 # pylint: disable=E0611
 from iothub_client import IoTHubModuleClient, IoTHubClientError, IoTHubTransportProvider
@@ -24,6 +26,22 @@ TWIN_CALLBACKS = 0
 OBJECT_OF_INTEREST = "scissors"
 TWIN_CALLBACKS = 0
 
+# upstream modules compress large payloads and name the codec in this property
+CONTENT_ENCODING_PROPERTY = "contentEncoding"
+# zlib window bits for each supported content encoding
+CONTENT_ENCODING_WBITS = {
+    "gzip": 16 + zlib.MAX_WBITS,
+    "deflate": zlib.MAX_WBITS
+}
+
+# binary inference batches, see inference_codec.py in the get-started module
+BATCH_FORMAT_PROPERTY = "batchFormat"
+BATCH_FORMAT_BINARY = "binary"
+INFERENCE_BATCH_MAGIC = b"IV"
+INFERENCE_BATCH_SCHEMA_VERSION = 1
+INFERENCE_BATCH_HEADER = struct.Struct("<2sBBH")
+INFERENCE_BATCH_RECORD = struct.Struct("<IBHffff")
+
 # Choose HTTP, AMQP or MQTT as transport protocol.  Currently only MQTT is supported.
 PROTOCOL = IoTHubTransportProvider.MQTT
 
@@ -38,6 +56,43 @@ def send_confirmation_callback(message, result, user_context):
     print ( "    Total calls confirmed: %d" % SEND_CALLBACKS )
 
 
+# Unpacks a binary inference batch into a list of inference dicts.
+def decode_inference_batch(data):
+    magic, version, _, count = INFERENCE_BATCH_HEADER.unpack_from(data, 0)
+    if magic != INFERENCE_BATCH_MAGIC:
+        raise ValueError("Not an inference batch")
+    if version != INFERENCE_BATCH_SCHEMA_VERSION:
+        raise ValueError("Unsupported inference batch schema version %d" % version)
+    offset = INFERENCE_BATCH_HEADER.size
+    labels = []
+    for _ in range(data[offset]):
+        length = data[offset + 1]
+        labels.append(data[offset + 2:offset + 2 + length].decode('utf-8'))
+        offset += 1 + length
+    offset += 1
+    inferences = []
+    for _ in range(count):
+        id, index, confidence, x, y, width, height = INFERENCE_BATCH_RECORD.unpack_from(data, offset)
+        offset += INFERENCE_BATCH_RECORD.size
+        inferences.append({"id": id, "label": labels[index], "confidence": confidence / 100,
+                           "position_x": x, "position_y": y, "width": width, "height": height})
+    return inferences
+
+
+# Returns the message body as text, undoing any content encoding set by the sender.
+# Binary inference batches are turned into the equivalent JSON array.
+def decode_message_body(message_buffer, key_value_pair):
+    encoding = key_value_pair.get(CONTENT_ENCODING_PROPERTY)
+    data = bytes(message_buffer)
+    if encoding not in (None, "", "none", "identity"):
+        if encoding not in CONTENT_ENCODING_WBITS:
+            raise ValueError("Unsupported content encoding %s" % encoding)
+        data = zlib.decompress(data, CONTENT_ENCODING_WBITS[encoding])
+    if key_value_pair.get(BATCH_FORMAT_PROPERTY) == BATCH_FORMAT_BINARY:
+        return json.dumps(decode_inference_batch(data))
+    return data.decode('utf-8')
+
+
 # receive_message_callback is invoked when an incoming message arrives on the specified 
 # input queue (in the case of this sample, "input1").  Because this is a filter module, 
 # we forward this message to the "output1" queue.
@@ -45,12 +100,15 @@ def receive_message_callback(message, hubManager):
     global RECEIVE_CALLBACKS
     global OBJECT_OF_INTEREST
     message_buffer = message.get_bytearray()
-    size = len(message_buffer)
-    message_text = message_buffer[:size].decode('utf-8')
-    print ( "\n***  New received message  ***")
-    print ( "    Message body: {}" .format(message_text) )
     map_properties = message.properties()
     key_value_pair = map_properties.get_internals()
+    print ( "\n***  New received message  ***")
+    try:
+        message_text = decode_message_body(message_buffer, key_value_pair)
+    except (ValueError, IndexError, struct.error, zlib.error) as decode_error:
+        print ( "    Could not decode message body: {}" .format(decode_error) )
+        return IoTHubMessageDispositionResult.REJECTED
+    print ( "    Message body: {}" .format(message_text) )
     print ( "    Message properties: {}" .format(key_value_pair) )
     RECEIVE_CALLBACKS += 1
     print ( "    Total calls received: %d" % RECEIVE_CALLBACKS )
@@ -59,6 +117,8 @@ def receive_message_callback(message, hubManager):
     if OBJECT_OF_INTEREST in data:
         map_properties.add("MessageSender", "BusinessLogicModule")
         print( "    Found:  {} " .format(OBJECT_OF_INTEREST))
+        # the original, still compressed, message is forwarded so the
+        # upstream hop keeps the smaller payload
         hubManager.forward_event_to_output("output1", message, 0)
     return IoTHubMessageDispositionResult.ACCEPTED
 
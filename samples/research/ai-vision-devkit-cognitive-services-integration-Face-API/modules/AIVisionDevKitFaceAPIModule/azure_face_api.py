@@ -4,47 +4,22 @@
 
 import requests
 from PIL import Image, ImageFile, ImageFont, ImageDraw
+import io
 import os
 import json
-from pathlib import Path
 from . iot_hub_manager import IotHubManager
 from iotccsdk import CameraClient
 
 subscription_key = os.environ['FACE_API_SUBSCRIPTION_KEY']
 face_api_url = os.environ['FACE_API_URL']
-dir_name = os.path.dirname(os.path.abspath(__name__))
-file_name = "qmmf_snapshot*.jpg"
-# remove_file_name_type1 = "snapshot*.jpg"
-# remove_file_name_type2 = "qmmf_snapshot*.jpg"
-remove_file_name = "*napshot*.jpg"
-
-
-def remove_old_snapshots(dir_name, remove_file_name):
-    snapshot_files = list(Path(dir_name).glob("**/%s" % remove_file_name))
-    for file in snapshot_files:
-        str_file = str(file)
-        os.chmod(str_file, 0o777)
-        os.remove(str_file)
-
-
-def get_snapshot_name(file_name=file_name):
-    selected_files = list(Path(dir_name).glob("**/%s" % file_name))
-
-    if len(selected_files) != 1:
-        print("Expected 1 file but got %s" %
-              (selected_files))
-        return
-
-    str_file = str(selected_files[0])
-    print(str_file)
-    os.chmod(str_file, 0o777)
-    return str_file
 
 
 def azure_face_api_detect(camera_client=None, iot_hub_manager=None):
     # sends snapshot to azure face api to detect faces and features
-    remove_old_snapshots(dir_name, file_name)
-    camera_client.captureimage()
+    snapshot = camera_client.capture_image_bytes()
+    if snapshot is None:
+        print("Snapshot failed")
+        return False
 
     detect_face_api_url = face_api_url + '/face/v1.0/detect'
 
@@ -57,14 +32,13 @@ def azure_face_api_detect(camera_client=None, iot_hub_manager=None):
             'emotion,hair,makeup,occlusion,accessories,blur,exposure,noise'
     }
 
-    image_data = open(get_snapshot_name(), "rb")
-    response = requests.post(detect_face_api_url, params=params, headers=headers, data=image_data)
+    response = requests.post(detect_face_api_url, params=params, headers=headers, data=snapshot)
     response.raise_for_status()
     faces = response.json()
 
     # Open the original image and overlay it with the face information.
     ImageFile.LOAD_TRUNCATED_IMAGES = True
-    source_img = Image.open(image_data)
+    source_img = Image.open(io.BytesIO(snapshot))
 
     font = ImageFont.truetype('/usr/share/fonts/truetype/dejavu/DejaVuSansMono.ttf', 84)
     for face in faces:
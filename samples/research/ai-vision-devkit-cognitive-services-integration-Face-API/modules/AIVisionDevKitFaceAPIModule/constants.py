@@ -12,3 +12,6 @@ TURN_CAMERA_OFF_METHOD_NAME = "StopCamera"
 TO_UPSTREAM_MESSAGE_QUEUE_NAME = "ToUpstream"
 
 MINIMUM_MESSAGE_DELAY_IN_SECONDS = 6
+
+# maximum time to wait for the camera to report a preview/analytics transition
+STATE_CHANGE_TIMEOUT_IN_SECONDS = 5
@@ -1,12 +1,12 @@
 import json
 import math
-import time
 from iotccsdk import CameraClient
 from . error_utils import log_unknown_exception, CameraClientError
 from . model_utility import ModelUtility
 from . constants import SETTING_ON, \
     SETTING_OFF, \
-    MINIMUM_MESSAGE_DELAY_IN_SECONDS
+    MINIMUM_MESSAGE_DELAY_IN_SECONDS, \
+    STATE_CHANGE_TIMEOUT_IN_SECONDS
 
 
 MODEL_ZIP_URL_PROP = "ModelZipUrl"
@@ -151,6 +151,12 @@ class CameraProperties:
                   self.analytics_state)
             raise CameraClientError(
                 "VAM failed to start in configure_camera_client")
+        # the camera reports the new state asynchronously, wait for it
+        # before reading it back below
+        if not camera_client.wait_for(vam_running=self.analytics_state,
+                                      timeout=STATE_CHANGE_TIMEOUT_IN_SECONDS):
+            print("VAM not %s after %s seconds" %
+                  (self.__analytics_state, STATE_CHANGE_TIMEOUT_IN_SECONDS))
 
         # update properties from the camera
         self.update_camera_properties(camera_client)
@@ -225,8 +231,8 @@ class CameraProperties:
         while camera_client.vam_running and count < 5:
             print("Retrying analytics off: %s" % count)
             camera_client.set_analytics_state(SETTING_OFF)
+            camera_client.wait_for(vam_running=False, timeout=1)
             count += 1
-            time.sleep(1)
 
     def __configure_preview(self, camera_client: CameraClient):
         if (camera_client.cur_resolution == self.resolution
@@ -237,14 +243,14 @@ class CameraProperties:
                 and camera_client.preview_running == self.preview_state):
             return
 
-        count = 0
         print("Turning preview off")
         if not camera_client.set_preview_state(SETTING_OFF):
             raise CameraClientError("Failed to stop preview")
-        while camera_client.preview_running and count < 5:
-            print("Waiting for preview to stop: %s" % count)
-            count += 1
-            time.sleep(1)
+        print("Waiting for preview to stop")
+        if not camera_client.wait_for(preview_running=False,
+                                      timeout=STATE_CHANGE_TIMEOUT_IN_SECONDS):
+            print("Preview still running after %s seconds" %
+                  STATE_CHANGE_TIMEOUT_IN_SECONDS)
 
         print(
             "Configure preview (%s, %s, %s, %s, %s)" %
@@ -266,6 +272,10 @@ class CameraProperties:
             raise CameraClientError(
                 ("failed to set the preview state to %s"
                     % self.__preview_state))
+        if not camera_client.wait_for(preview_running=self.preview_state,
+                                      timeout=STATE_CHANGE_TIMEOUT_IN_SECONDS):
+            print("Preview not %s after %s seconds" %
+                  (self.__preview_state, STATE_CHANGE_TIMEOUT_IN_SECONDS))
 
     def __has_preview_changed(self, camera_client: CameraClient):
         return (camera_client.cur_resolution != self.resolution
@@ -34,7 +34,9 @@ import base64
 import logging
 import os
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, wait
 from contextlib import contextmanager
 from ipcprovider import IpcProvider
 from frame_iterators import VideoInferenceIterator
@@ -605,7 +607,65 @@ class CameraClient():
         self.logger.info("Storing snapshot: {}".format(file_name))
         with open(file_name,"wb") as f:
             f.write(base64.b64decode(response["Data"]))
-        return True    
+        return True
+
+    def captureImagesWithFolder(self, folder, tag1, nums, in_flight=4, writers=2):
+        """
+        This method is for taking many snapshots as fast as possible.
+
+        `in_flight` snapshot requests are kept running while `writers`
+        threads decode and store the images as
+        <folder>/<tag1>/<tag1><timestamp>_<index>.jpg.
+
+        Returns
+        -------
+        dict
+            Number of captured, failed and written snapshots, seconds spent
+            and achieved captures_per_second.
+
+        """
+        tag_folder = os.path.join(os.path.dirname(os.path.abspath(__name__)), folder, tag1)
+        if not os.path.exists(tag_folder):
+            os.makedirs(tag_folder)
+        stats = {"captured": 0, "failed": 0, "written": 0}
+        lock = threading.Lock()
+        backlog = threading.BoundedSemaphore(in_flight + 2 * writers)
+
+        def store(index, response):
+            try:
+                file_name = os.path.join(
+                    tag_folder, "{}{}_{:05d}.jpg".format(tag1, response["Timestamp"], index))
+                with open(file_name, "wb") as f:
+                    f.write(base64.b64decode(response["Data"]))
+                with lock:
+                    stats["written"] += 1
+            finally:
+                backlog.release()
+
+        def capture(index):
+            try:
+                response = self.ipc_provider.post("/captureimage", '{ }')
+            except Exception as e:
+                response = {"Error": str(e)}
+            with lock:
+                if response["Error"] != "none":
+                    self.logger.error(response["Error"])
+                    stats["failed"] += 1
+                    return
+                stats["captured"] += 1
+            backlog.acquire()
+            writer_pool.submit(store, index, response)
+
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=writers) as writer_pool:
+            with ThreadPoolExecutor(max_workers=in_flight) as capture_pool:
+                wait([capture_pool.submit(capture, index) for index in range(nums)])
+            stats["seconds"] = time.time() - start
+        stats["captures_per_second"] = stats["captured"] / max(stats["seconds"], 1e-6)
+        self.logger.info("Captured {} snapshots at {:.1f}/s".format(
+            stats["captured"], stats["captures_per_second"]))
+        return stats
+
     @contextmanager
     def logout(self):
         """
@@ -12,13 +12,9 @@ def capture(camera, nums, tag):
         time.sleep(1)
 
         print("Start capture images: " + str(nums))
-        for x in range(nums):
-            if camera.captureImageWithFolder('pictures', tag):
-                pass
-                #print("capture well and image index:" + str(x))
-            else:
-                pass
-                #print("image capture error and image index:" + str(x))
+        stats = camera.captureImagesWithFolder('pictures', tag, nums)
+        print("captured {} images, {} failed, at {:.1f} images/s".format(
+            stats["captured"], stats["failed"], stats["captures_per_second"]))
         print("capture end!")
         time.sleep(10)
 